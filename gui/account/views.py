@@ -35,10 +35,6 @@ from django.contrib.auth import REDIRECT_FIELD_NAME
 from django.contrib.auth.forms import AuthenticationForm
 
 from freenasUI.account import forms, models
-from freenasUI.common.freenascache import (
-    FLAGS_CACHE_READ_USER, FLAGS_CACHE_WRITE_USER, FLAGS_CACHE_READ_GROUP,
-    FLAGS_CACHE_WRITE_GROUP
-)
 from freenasUI.common.freenasldap import (
     FLAGS_DBINIT,
     FreeNAS_ActiveDirectory_Groups,
@@ -50,7 +46,10 @@ from freenasUI.common.freenasnis import (
     FreeNAS_NIS_Groups,
     FreeNAS_NIS_Users,
 )
-from freenasUI.common.freenasusers import FreeNAS_Users, FreeNAS_Groups
+from freenasUI.common.freenasusers import (
+    FreeNAS_Groups_Index,
+    FreeNAS_Users_Index,
+)
 from freenasUI.common.system import get_sw_login_version, get_sw_name
 from freenasUI.freeadmin.views import JsonResp
 import json
@@ -113,22 +112,12 @@ def json_users(request, exclude=None):
         exclude = exclude.split(',')
     else:
         exclude = []
-    idx = 1
-    for user in FreeNAS_Users(
-        flags=FLAGS_DBINIT | FLAGS_CACHE_READ_USER | FLAGS_CACHE_WRITE_USER
-    ):
-        if idx > 50:
-            break
-        if (
-            (query is None or user.pw_name.startswith(query)) and
-            user.pw_name not in exclude
-        ):
-            json_user['items'].append({
-                'id': user.pw_name,
-                'name': user.pw_name,
-                'label': user.pw_name,
-            })
-            idx += 1
+    for name in FreeNAS_Users_Index.search(query, exclude=exclude):
+        json_user['items'].append({
+            'id': name,
+            'name': name,
+            'label': name,
+        })
 
     # Show users for the directory service provided in the wizard
     wizard_ds = request.session.get('wizard_ds')
@@ -197,19 +186,12 @@ def json_groups(request):
         'items': [],
     }
 
-    idx = 1
-    for grp in FreeNAS_Groups(
-        flags=FLAGS_DBINIT | FLAGS_CACHE_READ_GROUP | FLAGS_CACHE_WRITE_GROUP
-    ):
-        if idx > 50:
-            break
-        if query is None or grp.gr_name.startswith(query):
-            json_group['items'].append({
-                'id': grp.gr_name,
-                'name': grp.gr_name,
-                'label': grp.gr_name,
-            })
-            idx += 1
+    for name in FreeNAS_Groups_Index.search(query):
+        json_group['items'].append({
+            'id': name,
+            'name': name,
+            'label': name,
+        })
 
     # Show groups for the directory service provided in the wizard
     wizard_ds = request.session.get('wizard_ds')
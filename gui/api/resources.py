@@ -49,7 +49,7 @@ from freenasUI.account.forms import (
 from freenasUI.account.forms import bsdUserToGroupForm
 from freenasUI.account.models import bsdUsers, bsdGroups, bsdGroupMembership
 from freenasUI.api.utils import DojoResource
-from freenasUI.common import humanize_size, humanize_number_si
+from freenasUI.common import humanize_size, humanize_number_si, perf
 from freenasUI.common.system import (
     get_sw_login_version,
     get_sw_name,
@@ -77,7 +77,11 @@ from freenasUI.storage.forms import (
     VolumeManagerForm,
     ZFSDiskReplacementForm,
 )
-from freenasUI.storage.models import Disk, Replication
+from freenasUI.storage.models import (
+    Disk,
+    Replication,
+    repl_remote_snapshots,
+)
 from freenasUI.system.alert import alertPlugins, Alert
 from freenasUI.system.forms import (
     BootEnvAddForm,
@@ -929,6 +933,23 @@ class ReplicationResourceMixin(object):
     def dehydrate(self, bundle):
         bundle = super(ReplicationResourceMixin, self).dehydrate(bundle)
         bundle.data['repl_status'] = bundle.obj.status
+        stats = bundle.obj.repl_laststats
+        bundle.data['repl_laststats'] = stats
+        if self.is_webclient(bundle.request):
+            transfer = ''
+            if stats and stats.get('bytes') is not None:
+                transfer = _(
+                    '%(snapshots)d snapshot(s), %(size)s in %(seconds)ds'
+                ) % {
+                    'snapshots': stats['snapshots'],
+                    'size': humanize_size(stats['bytes']),
+                    'seconds': stats['seconds'],
+                }
+                if stats['seconds'] > 0:
+                    transfer += ' (%s/s)' % humanize_size(
+                        stats['bytes'] / stats['seconds']
+                    )
+            bundle.data['repl_lasttransfer'] = transfer
         bundle.data['repl_remote_hostname'] = (
             bundle.obj.repl_remote.ssh_remote_hostname
         )
@@ -1852,47 +1873,40 @@ class SnapshotResource(DojoResource):
 
     def get_list(self, request, **kwargs):
 
-        # Get a list of snapshots in remote sides to show whether it has been
-        # transfered already or not
+        # Snapshots on the remote sides, as last seen by autorepl, to show
+        # whether it has been transfered already or not
+        remote = repl_remote_snapshots()
         repli = {}
-        for repl in Replication.objects.all():
-            """
-            Multiple replications tasks can have the same remote host.
-            We can't get the list of snapshots on the remote side multiple
-            times, make sure we don't do that.
-            """
-            found = False
-            for _repl, snaps in repli.items():
-                if _repl.repl_remote.ssh_remote_hostname == \
-                    repl.repl_remote.ssh_remote_hostname and \
-                    _repl.repl_remote.ssh_remote_port == \
-                    repl.repl_remote.ssh_remote_port:
-                    found = True
-                    repli[repl] = snaps
-                    break
-            if found is False:
-                repli[repl] = notifier().repl_remote_snapshots(repl)
-
-        snapshots = notifier().zfs_snapshot_list(replications=repli)
+        for repl in Replication.objects.select_related('repl_remote'):
+            snaps = remote.get(repl.remote_snapshots_key())
+            if snaps:
+                repli.setdefault(repl.repl_filesystem, []).append(snaps)
 
-        results = []
-        for snaps in snapshots.values():
-            results.extend(snaps)
         FIELD_MAP = {
             'extra': 'mostrecent',
         }
+        # Fields zfs list is able to sort by itself
+        ZFS_SORT_MAP = {
+            'id': 'name',
+            'fullname': 'name',
+            'filesystem': 'name',
+            'used': 'used',
+            'refer': 'refer',
+        }
 
-        for sfield in self._apply_sorting(request.GET):
-            if sfield.startswith('-'):
-                field = sfield[1:]
-                reverse = True
-            else:
-                field = sfield
-                reverse = False
-            field = FIELD_MAP.get(field, field)
-            results.sort(
-                key=lambda item: getattr(item, field),
-                reverse=reverse)
+        zfs_sort = []
+        sorting = self._apply_sorting(request.GET)
+        for sfield in sorting:
+            field = sfield.lstrip('-')
+            if field not in ZFS_SORT_MAP:
+                zfs_sort = None
+                break
+            zfs_sort.append('%s%s' % (
+                '-' if sfield.startswith('-') else '',
+                ZFS_SORT_MAP[field],
+            ))
+
+        filesystem = request.GET.get('filesystem')
 
         limit = self._meta.limit
         if 'HTTP_X_RANGE' in request.META:
@@ -1902,31 +1916,78 @@ class SnapshotResource(DojoResource):
 
         paginator = self._meta.paginator_class(
             request,
-            results,
+            [],
             resource_uri=self.get_resource_uri(),
             limit=limit,
             max_limit=self._meta.max_limit,
             collection_name=self._meta.collection_name,
         )
-        to_be_serialized = paginator.page()
+        limit = paginator.get_limit()
+        offset = paginator.get_offset()
+
+        if zfs_sort is not None:
+            """
+            zfs list takes care of the ordering, only the requested
+            page is turned into Snapshot objects, everything else is
+            just counted as it streams by.
+            """
+            page = []
+            count = 0
+            for row in zfs.zfs_snapshot_iter(
+                filesystem, recursive=False, sort=zfs_sort
+            ):
+                if count >= offset and (not limit or count < offset + limit):
+                    page.append(row)
+                count += 1
+            results = notifier().zfs_snapshot_objects(
+                page, replications=repli
+            )
+        else:
+            snapshots = notifier().zfs_snapshot_list(
+                path=filesystem, replications=repli
+            )
+
+            results = []
+            for snaps in snapshots.values():
+                results.extend(snaps)
+            if filesystem:
+                results = [i for i in results if i.filesystem == filesystem]
+
+            for sfield in sorting:
+                if sfield.startswith('-'):
+                    field = sfield[1:]
+                    reverse = True
+                else:
+                    field = sfield
+                    reverse = False
+                field = FIELD_MAP.get(field, field)
+                results.sort(
+                    key=lambda item: getattr(item, field),
+                    reverse=reverse)
+
+            count = len(results)
+            if limit:
+                results = results[offset:offset + limit]
+            else:
+                results = results[offset:]
+
         # Dehydrate the bundles in preparation for serialization.
         bundles = []
 
-        for obj in to_be_serialized[self._meta.collection_name]:
+        for obj in results:
             bundle = self.build_bundle(obj=obj, request=request)
             bundles.append(self.full_dehydrate(bundle))
 
         length = len(bundles)
-        to_be_serialized[self._meta.collection_name] = bundles
         to_be_serialized = self.alter_list_data_to_serialize(
             request,
-            to_be_serialized
+            {self._meta.collection_name: bundles},
         )
         response = self.create_response(request, to_be_serialized)
         response['Content-Range'] = 'items %d-%d/%d' % (
-            paginator.offset,
-            paginator.offset+length-1,
-            len(results)
+            offset,
+            offset+length-1,
+            count
         )
         return response
 
@@ -2159,6 +2220,16 @@ class ShutdownResource(DojoResource):
         return HttpResponse('Shutdown process started.', status=202)
 
 
+class PerfResource(DojoResource):
+
+    class Meta:
+        allowed_methods = ['get']
+        resource_name = 'system/perf'
+
+    def get_list(self, request, **kwargs):
+        return self.create_response(request, perf.snapshot())
+
+
 class VersionResource(DojoResource):
 
     class Meta:
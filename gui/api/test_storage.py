@@ -415,6 +415,7 @@ class ReplicationResourceTest(APITestCase):
             u'repl_remote_port': 22,
             u'repl_compression': u'lz4',
             u'repl_status': u'Waiting',
+            u'repl_laststats': None,
         })
 
     def test_Retrieve(self):
@@ -453,6 +454,7 @@ class ReplicationResourceTest(APITestCase):
             u'repl_remote_port': 22,
             u'repl_compression': u'lz4',
             u'repl_status': u'Waiting',
+            u'repl_laststats': None,
         }])
 
     def test_Update(self):
@@ -0,0 +1,199 @@
+#+
+# Copyright 2015 iXsystems, Inc.
+# All rights reserved
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted providing that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR ``AS IS'' AND ANY EXPRESS OR
+# IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS
+# OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT,
+# STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING
+# IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+#####################################################################
+
+"""
+Memoized read-only commands
+
+Most of what notifier runs only reads state (`zpool list`, `zfs get`,
+`ifconfig -l`) and a single page often runs the very same command a
+number of times. Commands matching READONLY are run once and their
+output served for the next TTL seconds; concurrent identical commands
+wait for the one already running instead of forking again.
+
+Every other command is taken as changing the state: it bypasses the
+cache and drops whatever was memoized so far (see observe). So do the
+commands run through os.system by notifier._system and pipesubr.system.
+"""
+import logging
+import re
+import threading
+import time
+from cStringIO import StringIO
+
+from freenasUI.common import perf
+
+log = logging.getLogger('common.cmdcache')
+
+TTL = 3
+
+# Commands (each side of a pipe) which do not change anything. Process
+# listings (pgrep, ps) are left out on purpose, they are polled waiting
+# for a service to come up or go away.
+READONLY = [re.compile(r'^(/[\w/]+/)?%s$' % p) for p in (
+    r'zpool (list|status|get|iostat)( .*)?',
+    r'zpool import',
+    r'zfs (list|get)( .*)?',
+    r"ifconfig( -l|( '?[\w.:-]+'?( (ether|inet|inet6))?))",
+    r'sysctl( -[bdhnN]+)*( [\w.%]+)+',
+    r'kldstat( -v)?',
+    r'camcontrol (devlist|inquiry|identify)( .*)?',
+    r'diskinfo( -v)? [\w/.-]+',
+    r'geli (dump|list|status)( .*)?',
+    r'(gpart|glabel|gmultipath|gmirror) (show|list|status)( .*)?',
+    r'mount( -p)?',
+    r'route -nv show( -inet6)? default',
+    r'tw_cli /c\d+ show',
+    r'ipmitool lan print( \d+)?',
+    # Filters on the right side of a pipe
+    r'(grep|egrep|awk|head|tail|sort|uniq|wc|cut)( .*)?',
+)]
+
+# Sequences, redirections and substitutions are never read-only
+_UNSAFE = re.compile(r'[;&<>`\n]|\$\(')
+
+
+def is_readonly(command):
+    """
+    Whether a command line only reads state, see READONLY
+    """
+    if not isinstance(command, basestring) or _UNSAFE.search(command):
+        return False
+    for part in command.split('|'):
+        part = part.strip()
+        if not any(r.match(part) for r in READONLY):
+            return False
+    return True
+
+
+class CachedProcess(object):
+    """
+    Stands in for the subprocess.Popen of a memoized command
+    """
+
+    pid = None
+    stdin = None
+
+    def __init__(self, returncode, out, err):
+        self.returncode = returncode
+        self._out = out
+        self._err = err
+        self.stdout = StringIO(out)
+        self.stderr = StringIO(err)
+
+    def communicate(self, input=None):
+        return self._out, self._err
+
+    def wait(self):
+        return self.returncode
+
+    def poll(self):
+        return self.returncode
+
+
+class _Run(object):
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+
+
+class CommandCache(object):
+
+    def __init__(self, ttl=TTL):
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._entries = {}
+        self._running = {}
+        self._generation = 0
+
+    def invalidate(self):
+        with self._lock:
+            self._generation += 1
+            self._entries.clear()
+            # Whatever runs now may have read the old state
+            self._running.clear()
+
+    def observe(self, command):
+        """
+        Drop the cache unless the command is read-only
+
+        Returns:
+            bool - command is read-only
+        """
+        if is_readonly(command):
+            return True
+        self.invalidate()
+        return False
+
+    def run(self, command, spawn):
+        """
+        Output of a read-only command, memoized
+
+        Arguments:
+            spawn - callable starting the command, returns a Popen
+
+        Returns:
+            CachedProcess
+        """
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(command)
+            if entry is not None and now - entry[0] < self.ttl:
+                perf.stats.subprocess_cached(command)
+                return CachedProcess(*entry[1])
+            run = self._running.get(command)
+            leader = run is None
+            if leader:
+                run = self._running[command] = _Run()
+                generation = self._generation
+
+        if not leader:
+            run.done.wait()
+            if run.result is not None:
+                perf.stats.subprocess_cached(command)
+                return CachedProcess(*run.result)
+            # The one running it failed, run it ourselves
+            proc = spawn()
+            out, err = proc.communicate()
+            return CachedProcess(proc.returncode, out, err)
+
+        try:
+            proc = spawn()
+            out, err = proc.communicate()
+            run.result = (proc.returncode, out, err)
+        finally:
+            with self._lock:
+                if self._running.get(command) is run:
+                    del self._running[command]
+                if run.result is not None and \
+                        generation == self._generation:
+                    self._entries[command] = (now, run.result)
+            run.done.set()
+        return CachedProcess(*run.result)
+
+
+cache = CommandCache()
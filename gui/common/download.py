@@ -0,0 +1,395 @@
+#+
+# Copyright 2015 iXsystems, Inc.
+# All rights reserved
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted providing that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR ``AS IS'' AND ANY EXPRESS OR
+# IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS
+# OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT,
+# STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING
+# IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+#####################################################################
+
+"""
+Download a file from a number of mirrors at once
+
+The file is split in segments fetched with HTTP range requests, spread
+over the mirrors. The SHA-256 is computed while the data comes in (a
+segment finished ahead of the ones before it is read back once those
+are in). Progress is kept next to the file so an interrupted download
+carries on where it stopped.
+"""
+import Queue
+import hashlib
+import json
+import logging
+import os
+import re
+import tempfile
+import threading
+import time
+import urllib2
+
+log = logging.getLogger('common.download')
+
+BLOCKSIZE = 64 * 1024
+SEGMENT_SIZE = 4 * 1024 * 1024
+# Requests each mirror gets at a time
+MIRROR_CONNECTIONS = 2
+# A mirror is not used anymore after failing that many times
+MIRROR_FAILURES = 2
+# Seconds between saving the progress for a later resume
+STATE_INTERVAL = 2
+TIMEOUT = 30
+
+_CONTENT_RANGE_RE = re.compile(r'^bytes (\d+)-(\d+)/(\d+)$')
+
+
+class DownloadError(Exception):
+    pass
+
+
+class Segment(object):
+
+    def __init__(self, start, end, pos=None):
+        self.start = start
+        self.end = end
+        self.pos = start if pos is None else pos
+
+    @property
+    def done(self):
+        return self.end is not None and self.pos >= self.end
+
+
+class ParallelDownload(object):
+    """
+    Arguments:
+        urls - the same file on every mirror
+        path - where it ends up, the download goes to path.part until
+               it is complete (and verified)
+        sha256 - hex digest to verify the file against
+        progress - called with the percentage downloaded when it changes
+        segment - segment size
+    """
+
+    def __init__(self, urls, path, sha256=None, progress=None,
+                 segment=SEGMENT_SIZE, timeout=TIMEOUT):
+        self.urls = list(urls)
+        self.path = path
+        self.partial = "%s.part" % path
+        self.statefile = "%s.state" % path
+        self.sha256 = sha256.lower() if sha256 else None
+        self.progress = progress
+        self.segment = segment
+        self.timeout = timeout
+        self.size = None
+        self.ranged = False
+        self._segments = []
+        self._mirrors = []
+        self._next_mirror = 0
+        self._hash = None
+        self._hashed = 0
+        self._percent = None
+        self._saved = 0
+        self._error = None
+        self._lock = threading.Lock()
+
+    def _open(self, url, start=None, end=None):
+        request = urllib2.Request(url)
+        if start is not None:
+            request.add_header('Range', 'bytes=%d-%s' % (
+                start, '' if end is None else end - 1,
+            ))
+        return urllib2.urlopen(request, timeout=self.timeout)
+
+    def _probe(self):
+        """
+        Size of the file and whether range requests work
+
+        Mirrors are asked in order until one honors range requests, the
+        ones which do not are only used if none does.
+        """
+        plain = []
+        unreachable = []
+        for url in self.urls:
+            try:
+                response = self._open(url, 0, 1)
+            except Exception, e:
+                log.debug("Failed to reach %s: %s", url, e)
+                unreachable.append(url)
+                continue
+            try:
+                m = _CONTENT_RANGE_RE.match(
+                    response.info().getheader('Content-Range') or ''
+                )
+                if response.getcode() == 206 and m:
+                    self.size = int(m.group(3))
+                    self.ranged = True
+                    break
+                if not plain:
+                    length = response.info().getheader('Content-Length')
+                    self.size = int(length) if length else None
+                plain.append(url)
+            finally:
+                response.close()
+
+        if self.ranged:
+            urls = [u for u in self.urls if u not in plain + unreachable]
+            # Mirrors after the one answering were not asked, those
+            # failing range requests are dropped as they go
+            urls.extend(u for u in unreachable if u not in urls)
+        else:
+            urls = plain
+        if not urls:
+            raise DownloadError("None of the mirrors could be reached")
+        self._mirrors = [{'url': url, 'failures': 0} for url in urls]
+
+    def _load_state(self):
+        try:
+            with open(self.statefile, 'r') as f:
+                state = json.load(f)
+            if (
+                state['size'] == self.size and
+                state['sha256'] == self.sha256 and
+                os.path.getsize(self.partial) == self.size
+            ):
+                return [Segment(*seg) for seg in state['segments']]
+        except (IOError, OSError, ValueError, KeyError, TypeError):
+            pass
+        return None
+
+    def _save_state(self):
+        if not self.ranged:
+            return
+        state = {
+            'size': self.size,
+            'sha256': self.sha256,
+            'segments': [
+                [seg.start, seg.end, seg.pos] for seg in self._segments
+            ],
+        }
+        try:
+            fd, tmp = tempfile.mkstemp(dir=os.path.dirname(self.statefile))
+            with os.fdopen(fd, 'w') as f:
+                json.dump(state, f)
+            os.rename(tmp, self.statefile)
+        except (IOError, OSError), e:
+            log.debug("Failed to save %s: %s", self.statefile, e)
+        self._saved = time.time()
+
+    def _setup(self):
+        segments = None
+        if self.ranged:
+            segments = self._load_state()
+            if segments:
+                log.debug("Resuming download of %s", self.path)
+        if not segments:
+            with open(self.partial, 'wb') as f:
+                if self.size:
+                    f.truncate(self.size)
+            if self.ranged:
+                segments = [
+                    Segment(start, min(start + self.segment, self.size))
+                    for start in xrange(0, self.size, self.segment)
+                ]
+            else:
+                segments = [Segment(0, self.size)]
+        self._segments = segments
+        if self.sha256:
+            self._hash = hashlib.sha256()
+
+    def _report(self):
+        if not self.progress or not self.size:
+            return
+        done = sum(seg.pos - seg.start for seg in self._segments)
+        percent = int(done * 100 / self.size)
+        if percent != self._percent:
+            self._percent = percent
+            self.progress(percent)
+
+    def _advance(self):
+        """
+        Hash whatever was written right after the data hashed so far
+        """
+        if self._hash is None:
+            return
+        with open(self.partial, 'rb') as f:
+            for seg in self._segments:
+                if seg.end is not None and seg.end <= self._hashed:
+                    continue
+                if seg.pos > self._hashed:
+                    f.seek(self._hashed)
+                    while self._hashed < seg.pos:
+                        block = f.read(min(BLOCKSIZE, seg.pos - self._hashed))
+                        if not block:
+                            raise DownloadError("Short read of %s" % (
+                                self.partial,
+                            ))
+                        self._hash.update(block)
+                        self._hashed += len(block)
+                if not seg.done:
+                    break
+
+    def _written(self, seg, block):
+        with self._lock:
+            start = seg.pos
+            seg.pos += len(block)
+            if self._hash is not None and start == self._hashed:
+                self._hash.update(block)
+                self._hashed = seg.pos
+                if seg.done:
+                    self._advance()
+            self._report()
+            if time.time() - self._saved > STATE_INTERVAL:
+                self._save_state()
+
+    def _pick_mirror(self):
+        with self._lock:
+            mirrors = [
+                m for m in self._mirrors if m['failures'] < MIRROR_FAILURES
+            ]
+            if not mirrors:
+                return None
+            self._next_mirror += 1
+            return mirrors[self._next_mirror % len(mirrors)]
+
+    def _fetch(self, f, seg, mirror):
+        if self.ranged:
+            response = self._open(mirror['url'], seg.pos, seg.end)
+        else:
+            # No way to carry on in the middle, start over
+            seg.pos = seg.start
+            response = self._open(mirror['url'])
+        try:
+            if self.ranged:
+                m = _CONTENT_RANGE_RE.match(
+                    response.info().getheader('Content-Range') or ''
+                )
+                if (
+                    response.getcode() != 206 or not m or
+                    int(m.group(1)) != seg.pos or
+                    int(m.group(3)) != self.size
+                ):
+                    raise DownloadError("Range request not honored")
+
+            f.seek(seg.pos)
+            while not seg.done:
+                want = BLOCKSIZE
+                if seg.end is not None:
+                    want = min(want, seg.end - seg.pos)
+                block = response.read(want)
+                if not block:
+                    break
+                f.write(block)
+                self._written(seg, block)
+        finally:
+            response.close()
+
+        if seg.end is None:
+            # Size was not known in advance, the end of the stream is it
+            with self._lock:
+                seg.end = self.size = seg.pos
+                self._advance()
+        elif not seg.done:
+            raise DownloadError("Connection closed at %d of %d" % (
+                seg.pos, seg.end,
+            ))
+
+    def _worker(self, pending):
+        # Unbuffered, what _advance reads back has to be on the file
+        with open(self.partial, 'r+b', 0) as f:
+            while self._error is None:
+                try:
+                    seg = pending.get_nowait()
+                except Queue.Empty:
+                    return
+
+                mirror = self._pick_mirror()
+                if mirror is None:
+                    self._error = DownloadError(
+                        "Download failed on every mirror"
+                    )
+                    return
+
+                try:
+                    self._fetch(f, seg, mirror)
+                except Exception, e:
+                    log.debug("Failed to download from %s: %s",
+                        mirror['url'], e)
+                    with self._lock:
+                        mirror['failures'] += 1
+                    pending.put(seg)
+
+    def run(self):
+        """
+        Returns:
+            True once the file is at path, False if it did not match the
+            SHA-256 (the download is thrown away then)
+
+        Raises:
+            DownloadError if no mirror could provide the whole file, what
+            was downloaded is kept to be resumed
+        """
+        self._probe()
+        self._setup()
+
+        with self._lock:
+            self._report()
+            self._advance()
+
+        pending = Queue.Queue()
+        for seg in self._segments:
+            if not seg.done:
+                pending.put(seg)
+
+        threads = []
+        workers = min(
+            len(self._mirrors) * MIRROR_CONNECTIONS, pending.qsize()
+        )
+        for i in xrange(workers):
+            thread = threading.Thread(target=self._worker, args=(pending, ))
+            thread.daemon = True
+            thread.start()
+            threads.append(thread)
+
+        for thread in threads:
+            thread.join()
+
+        if self._error is None and not all(s.done for s in self._segments):
+            self._error = DownloadError("Download failed on every mirror")
+        if self._error is not None:
+            self._save_state()
+            raise self._error
+
+        if self._hash is not None:
+            with self._lock:
+                self._advance()
+            if (
+                self._hashed != self.size or
+                self._hash.hexdigest() != self.sha256
+            ):
+                log.debug("SHA256 failed for %s", self.path)
+                for path in (self.partial, self.statefile):
+                    if os.path.exists(path):
+                        os.unlink(path)
+                return False
+
+        os.rename(self.partial, self.path)
+        if os.path.exists(self.statefile):
+            os.unlink(self.statefile)
+        return True
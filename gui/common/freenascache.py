@@ -27,7 +27,10 @@
 
 import os
 import cPickle as pickle
+import grp
 import logging
+import pwd
+import sqlite3
 
 from bsddb3 import db
 from freenasUI.common.system import (
@@ -43,6 +46,7 @@ log = logging.getLogger('common.frenascache')
 
 FREENAS_CACHEDIR = get_freenas_var("FREENAS_CACHEDIR", "/var/tmp/.cache")
 FREENAS_CACHEEXPIRE = int(get_freenas_var("FREENAS_CACHEEXPIRE", 60))
+FREENAS_CACHEBACKEND = get_freenas_var("FREENAS_CACHEBACKEND", "bsddb")
 
 FREENAS_USERCACHE = os.path.join(FREENAS_CACHEDIR, ".users")
 FREENAS_GROUPCACHE = os.path.join(FREENAS_CACHEDIR, ".groups")
@@ -92,16 +96,83 @@ FLAGS_CACHE_WRITE_GROUP  = 0x00000008
 FLAGS_CACHE_READ_QUERY   = 0x00000010
 FLAGS_CACHE_WRITE_QUERY  = 0x00000020
 
-class FreeNAS_BaseCache(object):
+
+class FreeNAS_NSS_Resolver(object):
+    """
+    Turn many account names into passwd or group entries
+
+    getpwnam/getgrnam go through nsswitch (winbind, nss_ldap, NIS) one
+    round trip per name. The first resolve instead enumerates the whole
+    database once with getpwall/getgrall and looks names up in that;
+    names the enumeration did not return (enumeration disabled, entry
+    added meanwhile) fall back to a single lookup.
+
+    Arguments:
+        kind - 'passwd' or 'group'
+        casefold - names are case insensitive (winbind)
+    """
+
+    def __init__(self, kind='passwd', casefold=False):
+        if kind == 'group':
+            self.__enumerate = grp.getgrall
+            self.__lookup = grp.getgrnam
+            self.__name = lambda entry: entry.gr_name
+        else:
+            self.__enumerate = pwd.getpwall
+            self.__lookup = pwd.getpwnam
+            self.__name = lambda entry: entry.pw_name
+        self.kind = kind
+        self.casefold = casefold
+        self.hits = 0
+        self.misses = 0
+        self.__entries = None
+
+    def __sweep(self):
+        self.__entries = {}
+        try:
+            entries = self.__enumerate()
+
+        except Exception, e:
+            log.debug("FreeNAS_NSS_Resolver: unable to enumerate %s: %s",
+                self.kind, e)
+            entries = []
+
+        for entry in entries:
+            name = self.__name(entry)
+            if self.casefold:
+                name = name.lower()
+            self.__entries.setdefault(name, entry)
+
+        log.debug("FreeNAS_NSS_Resolver: %d %s entries enumerated",
+            len(self.__entries), self.kind)
+
+    def resolve(self, name):
+        """
+        Like getpwnam/getgrnam, raises KeyError for unknown names
+        """
+        if self.__entries is None:
+            self.__sweep()
+
+        entry = self.__entries.get(name.lower() if self.casefold else name)
+        if entry is not None:
+            self.hits += 1
+            return entry
+
+        self.misses += 1
+        return self.__lookup(name)
+
+
+class FreeNAS_BerkeleyDBCache(object):
+    """
+    Pickled entries in a BerkeleyDB hash
+    """
+
     def __init__(self, cachedir=FREENAS_CACHEDIR):
-        log.debug("FreeNAS_BaseCache._init__: enter")
+        log.debug("FreeNAS_BerkeleyDBCache.__init__: enter")
 
         self.cachedir = cachedir
         self.__cachefile = os.path.join(self.cachedir, ".cache.db")
 
-        if not self.__dir_exists(self.cachedir):
-            os.makedirs(self.cachedir)
-
         self.__dbenv = db.DBEnv()
         self.__dbenv.open(self.cachedir,
             db.DB_INIT_CDB | db.DB_INIT_MPOOL | db.DB_CREATE, 0700)
@@ -109,21 +180,10 @@ class FreeNAS_BaseCache(object):
         self.__cache = db.DB(self.__dbenv)
         self.__cache.open(self.__cachefile, None, db.DB_HASH, db.DB_CREATE)
 
-        log.debug("FreeNAS_BaseCache._init__: cachedir = %s", self.cachedir)
-        log.debug("FreeNAS_BaseCache._init__: cachefile = %s",
+        log.debug("FreeNAS_BerkeleyDBCache.__init__: cachedir = %s", self.cachedir)
+        log.debug("FreeNAS_BerkeleyDBCache.__init__: cachefile = %s",
             self.__cachefile)
-        log.debug("FreeNAS_BaseCache._init__: leave")
-
-    def __dir_exists(self, path):
-        path_exists = False
-        try:
-            os.stat(path)
-            path_exists = True
-
-        except OSError:
-            path_exists = False
-
-        return path_exists
+        log.debug("FreeNAS_BerkeleyDBCache.__init__: leave")
 
     def __len__(self):
         return len(self.__cache)
@@ -192,10 +252,335 @@ class FreeNAS_BaseCache(object):
         self.__cache.delete(key)
         return True
 
+    def bulk_load(self, items, overwrite=False):
+        for key, entry in items:
+            self.write(key, entry, overwrite=overwrite)
+
+    # Entries are only indexed by key, unpickling all of them to find
+    # one costs more than asking the directory
+    def lookup_uid(self, uid):
+        return None
+
+    def lookup_gid(self, gid):
+        return None
+
+    def lookup_name(self, name):
+        if self.has_key(name):
+            return self.read(name)
+        return None
+
     def close(self):
         self.__cache.close()
 
 
+class FreeNAS_SQLiteCache(object):
+    """
+    Entries in an indexed sqlite table
+
+    passwd and group entries are stored as fixed records (name, uid or
+    gid, primary gid, then gecos, home, shell or the members) instead of
+    pickles, indexed by name, uid and gid, and only decoded when read.
+    Anything else (directory entries, query results) is pickled.
+    """
+
+    KIND_PICKLE = 0
+    KIND_PASSWD = 1
+    KIND_GROUP = 2
+
+    def __init__(self, cachedir=FREENAS_CACHEDIR):
+        log.debug("FreeNAS_SQLiteCache.__init__: enter")
+
+        self.cachedir = cachedir
+        self.__cachefile = os.path.join(self.cachedir, ".cache.sqlite")
+
+        # autocommit, the cache can always be filled again so there is
+        # no need to wait for the disk on every write
+        self.__db = sqlite3.connect(self.__cachefile, isolation_level=None)
+        self.__db.text_factory = str
+        self.__db.execute("PRAGMA journal_mode=WAL")
+        self.__db.execute("PRAGMA synchronous=OFF")
+        # Not executescript, unlike execute it does not prepare a
+        # statement again when another process (or a thread of the LDAP
+        # connection pool) opening the same cache changed the schema
+        for sql in (
+            """CREATE TABLE IF NOT EXISTS cache (
+                key TEXT PRIMARY KEY,
+                kind INTEGER NOT NULL,
+                name TEXT,
+                id INTEGER,
+                gid INTEGER,
+                data BLOB
+            )""",
+            "CREATE INDEX IF NOT EXISTS cache_name ON cache (name)",
+            # uid of passwd entries, gid of group entries
+            "CREATE INDEX IF NOT EXISTS cache_id ON cache (kind, id)",
+        ):
+            self.__db.execute(sql)
+
+        log.debug("FreeNAS_SQLiteCache.__init__: cachedir = %s", self.cachedir)
+        log.debug("FreeNAS_SQLiteCache.__init__: cachefile = %s",
+            self.__cachefile)
+        log.debug("FreeNAS_SQLiteCache.__init__: leave")
+
+    def __encode(self, key, value):
+        if isinstance(value, pwd.struct_passwd):
+            return (key, self.KIND_PASSWD, value.pw_name, value.pw_uid,
+                value.pw_gid, buffer('\0'.join([
+                    value.pw_passwd, value.pw_gecos, value.pw_dir,
+                    value.pw_shell,
+                ])))
+        if isinstance(value, grp.struct_group):
+            return (key, self.KIND_GROUP, value.gr_name, value.gr_gid,
+                value.gr_gid, buffer('\0'.join(
+                    [value.gr_passwd] + list(value.gr_mem)
+                )))
+        return (key, self.KIND_PICKLE, None, None, None,
+            buffer(pickle.dumps(value, pickle.HIGHEST_PROTOCOL)))
+
+    def __decode(self, kind, name, number, gid, data):
+        data = str(data)
+        if kind == self.KIND_PASSWD:
+            passwd, gecos, home, shell = data.split('\0')
+            return pwd.struct_passwd(
+                (name, passwd, number, gid, gecos, home, shell)
+            )
+        if kind == self.KIND_GROUP:
+            fields = data.split('\0')
+            return grp.struct_group((name, fields[0], number, fields[1:]))
+        return pickle.loads(data)
+
+    def __query(self, sql, args=()):
+        return self.__db.execute(sql, args)
+
+    def __one(self, sql, args=()):
+        row = self.__query(sql, args).fetchone()
+        if row is None:
+            return None
+        return self.__decode(*row)
+
+    def __len__(self):
+        return self.__query("SELECT count(*) FROM cache").fetchone()[0]
+
+    def __iter__(self):
+        # In key order straight from the primary key index
+        for row in self.__query(
+            "SELECT kind, name, id, gid, data FROM cache ORDER BY key"
+        ):
+            yield self.__decode(*row)
+
+    def __getitem__(self, key):
+        obj = self.__one(
+            "SELECT kind, name, id, gid, data FROM cache WHERE key = ?",
+            (key, ))
+        if obj is None and not self.has_key(key):
+            raise KeyError(key)
+        return obj
+
+    def __setitem__(self, key, value, overwrite=False):
+        self.write(key, value, overwrite)
+
+    def has_key(self, key):
+        return self.__query(
+            "SELECT 1 FROM cache WHERE key = ?", (key, )
+        ).fetchone() is not None
+
+    def keys(self):
+        return [row[0] for row in self.__query("SELECT key FROM cache")]
+
+    def values(self):
+        return [
+            self.__decode(*row) for row in self.__query(
+                "SELECT kind, name, id, gid, data FROM cache"
+            )
+        ]
+
+    def items(self):
+        return [
+            (row[0], self.__decode(*row[1:])) for row in self.__query(
+                "SELECT key, kind, name, id, gid, data FROM cache"
+            )
+        ]
+
+    def empty(self):
+        return self.__query("SELECT 1 FROM cache LIMIT 1").fetchone() is None
+
+    def expire(self):
+        self.__db.close()
+        for suffix in ('', '-wal', '-shm'):
+            try:
+                os.unlink(self.__cachefile + suffix)
+            except OSError:
+                pass
+
+    def read(self, key):
+        if not key:
+            return None
+
+        return self[key]
+
+    def write(self, key, entry, overwrite=False):
+        if not key:
+            return False
+
+        self.__query(
+            "INSERT OR %s INTO cache VALUES (?, ?, ?, ?, ?, ?)" % (
+                'REPLACE' if overwrite else 'IGNORE',
+            ), self.__encode(key, entry))
+        return True
+
+    def delete(self, key):
+        if not key:
+            return False
+
+        self.__query("DELETE FROM cache WHERE key = ?", (key, ))
+        return True
+
+    def bulk_load(self, items, overwrite=False):
+        self.__query("BEGIN")
+        try:
+            self.__db.executemany(
+                "INSERT OR %s INTO cache VALUES (?, ?, ?, ?, ?, ?)" % (
+                    'REPLACE' if overwrite else 'IGNORE',
+                ), (
+                    self.__encode(key, entry)
+                    for key, entry in items if key
+                ))
+        except:
+            self.__query("ROLLBACK")
+            raise
+        self.__query("COMMIT")
+
+    def lookup_uid(self, uid):
+        return self.__one(
+            "SELECT kind, name, id, gid, data FROM cache "
+            "WHERE kind = ? AND id = ? LIMIT 1", (self.KIND_PASSWD, uid))
+
+    def lookup_gid(self, gid):
+        return self.__one(
+            "SELECT kind, name, id, gid, data FROM cache "
+            "WHERE kind = ? AND id = ? LIMIT 1", (self.KIND_GROUP, gid))
+
+    def lookup_name(self, name):
+        if self.has_key(name):
+            return self[name]
+        return self.__one(
+            "SELECT kind, name, id, gid, data FROM cache "
+            "WHERE name = ? LIMIT 1", (name, ))
+
+    def close(self):
+        self.__db.close()
+
+
+CACHE_BACKENDS = {
+    'bsddb': FreeNAS_BerkeleyDBCache,
+    'sqlite': FreeNAS_SQLiteCache,
+}
+
+
+class FreeNAS_BaseCache(object):
+    """
+    User, group and query cache stored in cachedir
+
+    The storage is picked by FREENAS_CACHEBACKEND (bsddb or sqlite).
+    Switching backends starts from an empty cache, expire it afterwards
+    (cachetool.py expire) so it gets filled again.
+    """
+
+    def __init__(self, cachedir=FREENAS_CACHEDIR, backend=None):
+        log.debug("FreeNAS_BaseCache.__init__: enter")
+
+        self.cachedir = cachedir
+        if not self.__dir_exists(self.cachedir):
+            os.makedirs(self.cachedir)
+
+        backend = backend or FREENAS_CACHEBACKEND
+        if backend not in CACHE_BACKENDS:
+            log.warn("Unknown cache backend %s, using bsddb", backend)
+            backend = 'bsddb'
+        self.__store = CACHE_BACKENDS[backend](cachedir)
+
+        log.debug("FreeNAS_BaseCache.__init__: cachedir = %s", self.cachedir)
+        log.debug("FreeNAS_BaseCache.__init__: backend = %s", backend)
+        log.debug("FreeNAS_BaseCache.__init__: leave")
+
+    def __dir_exists(self, path):
+        path_exists = False
+        try:
+            os.stat(path)
+            path_exists = True
+
+        except OSError:
+            path_exists = False
+
+        return path_exists
+
+    def __len__(self):
+        return len(self.__store)
+
+    def __iter__(self):
+        return iter(self.__store)
+
+    def __getitem__(self, key):
+        return self.__store[key]
+
+    def __setitem__(self, key, value, overwrite=False):
+        self.__store.__setitem__(key, value, overwrite)
+
+    def has_key(self, key):
+        return self.__store.has_key(key)
+
+    def keys(self):
+        return self.__store.keys()
+
+    def values(self):
+        return self.__store.values()
+
+    def items(self):
+        return self.__store.items()
+
+    def empty(self):
+        return self.__store.empty()
+
+    def expire(self):
+        self.__store.expire()
+
+    def read(self, key):
+        return self.__store.read(key)
+
+    def write(self, key, entry, overwrite=False):
+        return self.__store.write(key, entry, overwrite)
+
+    def delete(self, key):
+        return self.__store.delete(key)
+
+    def bulk_load(self, items, overwrite=False):
+        """
+        Write (key, entry) pairs at once
+        """
+        self.__store.bulk_load(items, overwrite)
+
+    def lookup_uid(self, uid):
+        """
+        Cached passwd entry for uid, or None
+        """
+        return self.__store.lookup_uid(uid)
+
+    def lookup_gid(self, gid):
+        """
+        Cached group entry for gid, or None
+        """
+        return self.__store.lookup_gid(gid)
+
+    def lookup_name(self, name):
+        """
+        Cached entry stored under, or named (pw_name/gr_name), name
+        """
+        return self.__store.lookup_name(name)
+
+    def close(self):
+        self.__store.close()
+
+
 class FreeNAS_LDAP_UserCache(FreeNAS_BaseCache):
     def __init__(self, **kwargs):
         log.debug("FreeNAS_LDAP_UserCache.__init__: enter")
@@ -293,6 +293,7 @@ class FreeNAS_DomainController_Users(FreeNAS_DomainController):
                 return 
 
         self._save()
+        resolver = FreeNAS_NSS_Resolver('passwd', casefold=True)
         for d in self.__domains:
             self.__users[d] = []
 
@@ -314,7 +315,7 @@ class FreeNAS_DomainController_Users(FreeNAS_DomainController):
 
                 sAMAccountName = u['sAMAccountName']
                 try:
-                    pw = pwd.getpwnam(sAMAccountName)
+                    pw = resolver.resolve(sAMAccountName)
 
                 except Exception, e:
                     log.debug("Error on getpwname: %s",  e)
@@ -431,6 +432,7 @@ class FreeNAS_DomainController_Groups(FreeNAS_DomainController):
                 return
 
         self._save()
+        resolver = FreeNAS_NSS_Resolver('group', casefold=True)
         for d in self.__domains:
             self.__groups[d] = []
 
@@ -451,7 +453,7 @@ class FreeNAS_DomainController_Groups(FreeNAS_DomainController):
                     self.__dgcache[d][sAMAccountName.upper()] = g
 
                 try:
-                    gr = grp.getgrnam(sAMAccountName)
+                    gr = resolver.resolve(sAMAccountName)
 
                 except:
                     continue
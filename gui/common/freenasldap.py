@@ -25,14 +25,17 @@
 #
 #####################################################################
 import asyncore
+import cPickle as pickle
 import grp
 import hashlib
 import ldap
 import logging
 import os
 import pwd
+import Queue
 import socket
 import sqlite3
+import threading
 import time
 import types
 
@@ -74,6 +77,13 @@ FREENAS_LDAP_REFERRALS = get_freenas_var("FREENAS_LDAP_REFERRALS", 0)
 
 FREENAS_LDAP_PAGESIZE = get_freenas_var("FREENAS_LDAP_PAGESIZE", 1024)
 
+# Connections used to run independent searches at the same time
+FREENAS_LDAP_POOLSIZE = int(get_freenas_var("FREENAS_LDAP_POOLSIZE", 4))
+
+# Seconds a modifyTimestamp high-water mark is moved back to allow for
+# clock skew between us and the LDAP server
+FREENAS_LDAP_CACHE_SKEW = int(get_freenas_var("FREENAS_LDAP_CACHE_SKEW", 300))
+
 ldap.protocol_version = FREENAS_LDAP_VERSION
 ldap.set_option(ldap.OPT_REFERRALS, FREENAS_LDAP_REFERRALS)
 
@@ -317,60 +327,15 @@ class FreeNAS_LDAP_Directory(object):
 
         result = []
         results = []
-        paged = SimplePagedResultsControl(
-            True,
-            size=self.pagesize,
-            cookie=''
-        )
-
-        paged_ctrls = {
-            SimplePagedResultsControl.controlType: SimplePagedResultsControl,
-        }
 
         if self.pagesize > 0:
             log.debug("FreeNAS_LDAP_Directory._search: pagesize = %d",
                 self.pagesize)
 
-            page = 0
-            while True:
-                log.debug("FreeNAS_LDAP_Directory._search: getting page %d",
-                    page)
-                serverctrls = [paged]
-
-                id = self._handle.search_ext(
-                   basedn,
-                   scope,
-                   filterstr=filter,
-                   attrlist=attributes,
-                   attrsonly=attrsonly,
-                   serverctrls=serverctrls,
-                   clientctrls=clientctrls,
-                   timeout=timeout,
-                   sizelimit=sizelimit
-                )
-
-                (rtype, rdata, rmsgid, serverctrls) = self._handle.result3(
-                    id, resp_ctrl_classes=paged_ctrls
-                )
-
-                result.extend(rdata)
-
-                paged.size = 0
-                paged.cookie = cookie = None
-                for sc in serverctrls:
-                    if sc.controlType == \
-                        SimplePagedResultsControl.controlType:
-                        cookie = sc.cookie
-                        if cookie:
-                            paged.cookie = cookie
-                            paged.size = self.pagesize
-
-                        break
-
-                if not cookie:
-                    break
-
-                page += 1
+            for page in self._search_pages(basedn, scope, filter,
+                attributes, attrsonly, serverctrls, clientctrls, timeout,
+                sizelimit):
+                result.extend(page)
         else:
             log.debug("FreeNAS_LDAP_Directory._search: pagesize = 0")
 
@@ -407,6 +372,92 @@ class FreeNAS_LDAP_Directory(object):
         log.debug("FreeNAS_LDAP_Directory._search: leave")
         return result
 
+    def _search_pages(self, basedn="", scope=ldap.SCOPE_SUBTREE,
+        filter=None, attributes=None, attrsonly=0, serverctrls=None,
+        clientctrls=None, timeout=-1, sizelimit=0, pagesize=None):
+        """
+        Paged search handing out one page of results at a time
+
+        The request for the next page goes out as soon as a page is
+        complete, before it is handed out, so the server works on the
+        next page while the caller processes the current one.
+        """
+        if not self._isopen:
+            return
+
+        if pagesize is None:
+            pagesize = self.pagesize
+        if not filter:
+            filter = ''
+
+        controls = list(serverctrls or [])
+        paged_ctrls = {
+            SimplePagedResultsControl.controlType: SimplePagedResultsControl,
+        }
+
+        def request(cookie):
+            paged = SimplePagedResultsControl(
+                True,
+                size=pagesize,
+                cookie=cookie
+            )
+            return self._handle.search_ext(
+                basedn,
+                scope,
+                filterstr=filter,
+                attrlist=attributes,
+                attrsonly=attrsonly,
+                serverctrls=controls + [paged],
+                clientctrls=clientctrls,
+                timeout=timeout,
+                sizelimit=sizelimit
+            )
+
+        msgid = request('')
+        page = 0
+        try:
+            while msgid is not None:
+                log.debug("FreeNAS_LDAP_Directory._search_pages: "
+                    "getting page %d", page)
+                (rtype, rdata, rmsgid, rctrls) = self._handle.result3(
+                    msgid, resp_ctrl_classes=paged_ctrls
+                )
+
+                cookie = None
+                for sc in rctrls:
+                    if sc.controlType == \
+                        SimplePagedResultsControl.controlType:
+                        cookie = sc.cookie
+                        break
+
+                msgid = request(cookie) if cookie else None
+                page += 1
+                yield rdata
+
+        finally:
+            # The caller stopped early, do not leave the server working
+            if msgid is not None:
+                self._handle.abandon(msgid)
+
+    def search_pages(self, searches, poolsize=None):
+        """
+        Run independent searches at the same time, handing out their
+        pages as they arrive
+
+        Arguments:
+            searches - list of dicts of _search_pages arguments
+
+        Returns:
+            generator of (index of the search, page)
+        """
+        pool = FreeNAS_LDAP_ConnectionPool(self, size=poolsize)
+        try:
+            for result in pool.search_pages(searches):
+                yield result
+
+        finally:
+            pool.close()
+
     def search(self):
         log.debug("FreeNAS_LDAP_Directory.search: enter")
         isopen = self._isopen
@@ -420,6 +471,99 @@ class FreeNAS_LDAP_Directory(object):
         return results
 
 
+class FreeNAS_LDAP_ConnectionPool(object):
+    """
+    Up to size connections bound like the directory handle they are
+    created for, handed out to one thread at a time
+    """
+
+    def __init__(self, directory, size=None):
+        self.directory = directory
+        self.size = size or FREENAS_LDAP_POOLSIZE
+        self.__free = []
+        self.__count = 0
+        self.__cond = threading.Condition()
+
+    def _connect(self):
+        d = self.directory
+        conn = FreeNAS_LDAP_Directory(
+            host=d.host, port=d.port, binddn=d.binddn, bindpw=d.bindpw,
+            basedn=d.basedn, ssl=d.ssl, certfile=d.certfile,
+            pagesize=d.pagesize or FREENAS_LDAP_PAGESIZE, flags=d.flags)
+        conn.open()
+        return conn
+
+    def get(self):
+        with self.__cond:
+            while not self.__free and self.__count >= self.size:
+                self.__cond.wait()
+            if self.__free:
+                return self.__free.pop()
+            self.__count += 1
+
+        try:
+            return self._connect()
+
+        except:
+            with self.__cond:
+                self.__count -= 1
+                self.__cond.notify()
+            raise
+
+    def put(self, conn):
+        with self.__cond:
+            self.__free.append(conn)
+            self.__cond.notify()
+
+    def close(self):
+        with self.__cond:
+            while self.__free:
+                self.__free.pop().close()
+                self.__count -= 1
+
+    def search_pages(self, searches):
+        """
+        One thread per search fetching its pages into a queue, the
+        caller processes a page while the servers work on the next ones
+        """
+        pages = Queue.Queue()
+        errors = []
+
+        def run(i, args):
+            try:
+                conn = self.get()
+                try:
+                    for page in conn._search_pages(**args):
+                        pages.put((i, page))
+
+                finally:
+                    self.put(conn)
+
+            except Exception as e:
+                log.debug("FreeNAS_LDAP_ConnectionPool.search_pages: "
+                    "search %s failed: %s", args, e)
+                errors.append(e)
+
+            finally:
+                pages.put((i, None))
+
+        for i, args in enumerate(searches):
+            thread = threading.Thread(target=run, args=(i, args))
+            thread.daemon = True
+            thread.start()
+
+        running = len(searches)
+        while running:
+            i, page = pages.get()
+            if page is None:
+                running -= 1
+            elif not errors:
+                yield i, page
+
+        if errors:
+            raise errors[0]
+
+
 class FreeNAS_LDAP_Base(FreeNAS_LDAP_Directory):
 
     def __keys(self):
@@ -570,21 +714,71 @@ class FreeNAS_LDAP_Base(FreeNAS_LDAP_Directory):
         log.debug("FreeNAS_LDAP_Base.get_user: leave")
         return ldap_user
 
-    def get_users(self):
-        log.debug("FreeNAS_LDAP_Base.get_users: enter")
-        isopen = self._isopen
-        self.open()
-
-        users = []
-        scope = ldap.SCOPE_SUBTREE
+    def _users_query(self, changed=None):
         filter = '(&(|(objectclass=person)(objectclass=account))(uid=*))'
+        if changed:
+            filter = '(&%s(modifyTimestamp>=%s))' % (filter, changed)
 
         if self.usersuffix:
             basedn = "%s,%s" % (self.usersuffix, self.basedn)
         else:
             basedn = "%s" % self.basedn
-	
-        results = self._search(basedn, scope, filter, self.attributes)
+
+        return {
+            'basedn': basedn,
+            'scope': ldap.SCOPE_SUBTREE,
+            'filter': filter,
+            'attributes': ['uid'],
+        }
+
+    def _groups_query(self, changed=None):
+        filter = '(&(objectclass=posixgroup)(gidnumber=*))'
+        if changed:
+            filter = '(&%s(modifyTimestamp>=%s))' % (filter, changed)
+
+        if self.groupsuffix:
+            basedn = "%s,%s" % (self.groupsuffix, self.basedn)
+        else:
+            basedn = "%s" % self.basedn
+
+        return {
+            'basedn': basedn,
+            'scope': ldap.SCOPE_SUBTREE,
+            'filter': filter,
+            'attributes': ['cn'],
+        }
+
+    def get_user_and_group_pages(self, changed=None):
+        """
+        Pages of get_users() and get_groups(), searched at the same time
+        over separate connections, as they arrive
+
+        Returns:
+            generator of (0 for users or 1 for groups, page)
+        """
+        log.debug("FreeNAS_LDAP_Base.get_user_and_group_pages: enter")
+
+        for i, page in self.search_pages([
+            self._users_query(changed),
+            self._groups_query(changed),
+        ]):
+            yield i, [r for r in page if r[0]]
+
+        log.debug("FreeNAS_LDAP_Base.get_user_and_group_pages: leave")
+
+    def get_users(self, changed=None):
+        """
+        Users in the directory, or only those modified since the
+        generalized time in changed
+        """
+        log.debug("FreeNAS_LDAP_Base.get_users: enter")
+        isopen = self._isopen
+        self.open()
+
+        users = []
+        query = self._users_query(changed)
+        results = self._search(query['basedn'], query['scope'],
+            query['filter'], self.attributes)
         if results:
             for r in results:
                 if r[0]:
@@ -637,21 +831,19 @@ class FreeNAS_LDAP_Base(FreeNAS_LDAP_Directory):
         log.debug("FreeNAS_LDAP_Base.get_group: leave")
         return ldap_group
 
-    def get_groups(self):
+    def get_groups(self, changed=None):
+        """
+        Groups in the directory, or only those modified since the
+        generalized time in changed
+        """
         log.debug("FreeNAS_LDAP_Base.get_groups: enter")
         isopen = self._isopen
         self.open()
 
         groups = []
-        scope = ldap.SCOPE_SUBTREE
-        filter = '(&(objectclass=posixgroup)(gidnumber=*))'
-
-        if self.groupsuffix:
-            basedn = "%s,%s" % (self.groupsuffix, self.basedn)
-        else:
-            basedn = "%s" % self.basedn
-	
-        results = self._search(basedn, scope, filter, self.attributes)
+        query = self._groups_query(changed)
+        results = self._search(query['basedn'], query['scope'],
+            query['filter'], self.attributes)
         if results:
             for r in results:
                 if r[0]:
@@ -1531,29 +1723,56 @@ class FreeNAS_ActiveDirectory_Base(object):
         log.debug("FreeNAS_ActiveDirectory_Base.get_user: leave")
         return ad_user
 
-    def get_users(self):
+    def get_users(self, changed=None):
+        """
+        Users in the domain, or only those with a uSNChanged of at
+        least changed
+        """
         log.debug("FreeNAS_ActiveDirectory_Base.get_users: enter")
 
         users = []
         scope = ldap.SCOPE_SUBTREE
-        filter = '(&(|(objectclass=user)(objectclass=person))' \
-            '(sAMAccountName=*))'
         if self.attributes and 'sAMAccountType' not in self.attributes:
             self.attributes.append('sAMAccountType')
 
         results = self._search(self.dchandle, self.basedn, scope,
-            filter, self.attributes)
+            self._users_filter(changed), self.attributes)
         if results:
-            for r in results:
-                if r[0] and r[1] and r[1].has_key('sAMAccountType'):
-                    type = int(r[1]['sAMAccountType'][0])
-                    if not (type & 0x1):
-                        users.append(r)
+            users = filter(self._is_user, results)
 
         self.ucount = len(users)
         log.debug("FreeNAS_ActiveDirectory_Base.get_users: leave")
         return users
 
+    def get_user_pages(self, changed=None):
+        """
+        get_users() one page at a time, the next page is fetched while
+        the caller processes the current one
+        """
+        for page in self.dchandle._search_pages(
+            basedn=self.basedn,
+            scope=ldap.SCOPE_SUBTREE,
+            filter=self._users_filter(changed),
+            attributes=['sAMAccountName', 'sAMAccountType'],
+            pagesize=int(getattr(self, 'pagesize', None) or
+                FREENAS_LDAP_PAGESIZE),
+        ):
+            yield filter(self._is_user, page)
+
+    def _users_filter(self, changed=None):
+        filter = '(&(|(objectclass=user)(objectclass=person))' \
+            '(sAMAccountName=*))'
+        if changed is not None:
+            filter = '(&%s(uSNChanged>=%d))' % (filter, changed)
+        return filter
+
+    @staticmethod
+    def _is_user(r):
+        if r[0] and r[1] and r[1].has_key('sAMAccountType'):
+            type = int(r[1]['sAMAccountType'][0])
+            return not (type & 0x1)
+        return False
+
     def get_groupDN(self, group):
         log.debug("FreeNAS_ActiveDirectory_Base.get_groupDN: enter")
         log.debug("FreeNAS_ActiveDirectory_Base.get_groupDN: group = %s",
@@ -1602,28 +1821,54 @@ class FreeNAS_ActiveDirectory_Base(object):
         log.debug("FreeNAS_ActiveDirectory_Base.get_group: leave")
         return ad_group
 
-    def get_groups(self):
+    def get_groups(self, changed=None):
+        """
+        Groups in the domain, or only those with a uSNChanged of at
+        least changed
+        """
         log.debug("FreeNAS_ActiveDirectory_Base.get_groups: enter")
 
         groups = []
         scope = ldap.SCOPE_SUBTREE
-        filter = '(&(objectclass=group)(sAMAccountName=*))'
         if self.attributes and 'groupType' not in self.attributes:
             self.attributes.append('groupType')
 
         results = self._search(self.dchandle, self.basedn, scope,
-            filter, self.attributes)
+            self._groups_filter(changed), self.attributes)
         if results:
-            for r in results:
-                if r[0]:
-                    type = int(r[1]['groupType'][0])
-                    if not (type & 0x1):
-                        groups.append(r)
+            groups = filter(self._is_group, results)
 
         self.ucount = len(groups)
         log.debug("FreeNAS_ActiveDirectory_Base.get_groups: leave")
         return groups
 
+    def get_group_pages(self, changed=None):
+        """
+        get_groups() one page at a time, see get_user_pages
+        """
+        for page in self.dchandle._search_pages(
+            basedn=self.basedn,
+            scope=ldap.SCOPE_SUBTREE,
+            filter=self._groups_filter(changed),
+            attributes=['sAMAccountName', 'groupType'],
+            pagesize=int(getattr(self, 'pagesize', None) or
+                FREENAS_LDAP_PAGESIZE),
+        ):
+            yield filter(self._is_group, page)
+
+    def _groups_filter(self, changed=None):
+        filter = '(&(objectclass=group)(sAMAccountName=*))'
+        if changed is not None:
+            filter = '(&%s(uSNChanged>=%d))' % (filter, changed)
+        return filter
+
+    @staticmethod
+    def _is_group(r):
+        if r[0]:
+            type = int(r[1]['groupType'][0])
+            return not (type & 0x1)
+        return False
+
     def get_user_count(self):
         count = 0
 
@@ -1752,10 +1997,12 @@ class FreeNAS_LDAP_Users(FreeNAS_LDAP):
 
         parts = self.host.split('.')
         host = parts[0].upper()
+        resolver = FreeNAS_NSS_Resolver('passwd')
+        dcached, cached = [], []
         for u in ldap_users:
             CN = str(u[0])
             if self.flags & FLAGS_CACHE_WRITE_USER:
-                self.__ducache[CN] = u
+                dcached.append((CN, u))
 
             u = u[1]
             if self.use_default_domain:
@@ -1770,18 +2017,20 @@ class FreeNAS_LDAP_Users(FreeNAS_LDAP):
             self.__usernames.append(uid)
 
             try:
-                pw = pwd.getpwnam(uid)
+                pw = resolver.resolve(uid)
 
             except:
                 continue
 
             self.__users.append(pw)
             if self.flags & FLAGS_CACHE_WRITE_USER:
-                self.__ucache[uid] = pw
+                cached.append((uid, pw))
 
             pw = None
 
         if self.flags & FLAGS_CACHE_WRITE_USER:
+            self.__ducache.bulk_load(dcached)
+            self.__ucache.bulk_load(cached)
             self.__loaded('u', True)
             self.__loaded('du', True)
 
@@ -1883,6 +2132,8 @@ class FreeNAS_ActiveDirectory_Users(FreeNAS_ActiveDirectory):
                 log.debug("FreeNAS_ActiveDirectory_Users.__get_users: leave")
                 return
 
+        # One enumeration covers every domain
+        resolver = FreeNAS_NSS_Resolver('passwd', casefold=True)
         for d in self.__domains:
             n = d['nETBIOSName']
             self.__users[n] = []
@@ -1908,11 +2159,12 @@ class FreeNAS_ActiveDirectory_Users(FreeNAS_ActiveDirectory):
                     "AD [%s] users not in cache" % n)
                 ad_users = self.get_users()
 
+            dcached, cached = [], []
             for u in ad_users:
                 CN = str(u[0])
 
                 if self.flags & FLAGS_CACHE_WRITE_USER:
-                    self.__ducache[n][CN] = u
+                    dcached.append((CN, u))
 
                 u = u[1]
                 if self.use_default_domain:
@@ -1927,7 +2179,7 @@ class FreeNAS_ActiveDirectory_Users(FreeNAS_ActiveDirectory):
                 self.__usernames.append(sAMAccountName)
 
                 try:
-                    pw = pwd.getpwnam(sAMAccountName)
+                    pw = resolver.resolve(sAMAccountName)
 
                 except Exception, e:
                     log.debug("Error on getpwnam: %s", e)
@@ -1935,11 +2187,13 @@ class FreeNAS_ActiveDirectory_Users(FreeNAS_ActiveDirectory):
 
                 self.__users[n].append(pw)
                 if self.flags & FLAGS_CACHE_WRITE_USER:
-                    self.__ucache[n][sAMAccountName] = pw
+                    cached.append((sAMAccountName, pw))
 
                 pw = None
 
             if self.flags & FLAGS_CACHE_WRITE_USER:
+                self.__ducache[n].bulk_load(dcached)
+                self.__ucache[n].bulk_load(cached)
                 self.__loaded('u', n, True)
                 self.__loaded('du', n, True)
 
@@ -2050,10 +2304,12 @@ class FreeNAS_LDAP_Groups(FreeNAS_LDAP):
 
         parts = self.host.split('.') 
         host = parts[0].upper()
+        resolver = FreeNAS_NSS_Resolver('group')
+        dcached, cached = [], []
         for g in ldap_groups:
             CN = str(g[0])
             if self.flags & FLAGS_CACHE_WRITE_GROUP:
-                self.__dgcache[CN] = g
+                dcached.append((CN, g))
 
             g = g[1]
             if self.use_default_domain:
@@ -2068,7 +2324,7 @@ class FreeNAS_LDAP_Groups(FreeNAS_LDAP):
             self.__groupnames.append(cn)
 
             try:
-                gr = grp.getgrnam(cn)
+                gr = resolver.resolve(cn)
 
             except:
                 continue
@@ -2076,11 +2332,13 @@ class FreeNAS_LDAP_Groups(FreeNAS_LDAP):
             self.__groups.append(gr)
 
             if self.flags & FLAGS_CACHE_WRITE_GROUP:
-                self.__gcache[cn] = gr
+                cached.append((cn, gr))
 
             gr = None
 
         if self.flags & FLAGS_CACHE_WRITE_GROUP:
+            self.__dgcache.bulk_load(dcached)
+            self.__gcache.bulk_load(cached)
             self.__loaded('g', True)
             self.__loaded('dg', True)
 
@@ -2183,6 +2441,8 @@ class FreeNAS_ActiveDirectory_Groups(FreeNAS_ActiveDirectory):
                     "leave")
                 return
 
+        # One enumeration covers every domain
+        resolver = FreeNAS_NSS_Resolver('group', casefold=True)
         for d in self.__domains:
             n = d['nETBIOSName']
             self.__groups[n] = []
@@ -2208,6 +2468,7 @@ class FreeNAS_ActiveDirectory_Groups(FreeNAS_ActiveDirectory):
                     "AD [%s] groups not in cache", n)
                 ad_groups = self.get_groups()
 
+            dcached, cached = [], []
             for g in ad_groups:
                 CN = str(g[0])
 
@@ -2223,10 +2484,10 @@ class FreeNAS_ActiveDirectory_Groups(FreeNAS_ActiveDirectory):
                 self.__groupnames.append(sAMAccountName)
 
                 if self.flags & FLAGS_CACHE_WRITE_GROUP:
-                    self.__dgcache[n][CN] = g
+                    dcached.append((CN, g))
 
                 try:
-                    gr = grp.getgrnam(sAMAccountName)
+                    gr = resolver.resolve(sAMAccountName)
 
                 except Exception as e:
                     log.debug("Error on getgrnam: %s", e)
@@ -2234,11 +2495,13 @@ class FreeNAS_ActiveDirectory_Groups(FreeNAS_ActiveDirectory):
 
                 self.__groups[n].append(gr)
                 if self.flags & FLAGS_CACHE_WRITE_GROUP:
-                    self.__gcache[n][sAMAccountName] = gr
+                    cached.append((sAMAccountName, gr))
 
                 gr = None
 
             if self.flags & FLAGS_CACHE_WRITE_GROUP:
+                self.__dgcache[n].bulk_load(dcached)
+                self.__gcache[n].bulk_load(cached)
                 self.__loaded('g', n, True)
                 self.__loaded('dg', n, True)
 
@@ -2264,6 +2527,283 @@ class FreeNAS_Directory_Groups(object):
         return obj
 
 
+def _is_id(name):
+    """
+    A uid or gid rather than an account name
+    """
+    return type(name) in (types.IntType, types.LongType) or name.isdigit()
+
+
+def _cache_watermark(cachedir):
+    """
+    High-water mark of the last refresh of a directory cache
+    """
+    try:
+        with open(os.path.join(cachedir, ".hwm"), 'rb') as f:
+            return pickle.load(f)
+    except Exception:
+        return {}
+
+
+def _cache_set_watermark(cachedir, mark):
+    path = os.path.join(cachedir, ".hwm")
+    with open(path + ".tmp", 'wb') as f:
+        pickle.dump(mark, f, pickle.HIGHEST_PROTOCOL)
+    os.rename(path + ".tmp", path)
+
+
+def _cache_loaded(*paths):
+    for path in paths:
+        with open(path, 'w+') as f:
+            f.close()
+
+
+class _CacheSync(object):
+    """
+    Merge pages of directory entries into a directory cache and the
+    matching passwd/group cache, as the pages arrive
+
+    Arguments:
+        name - maps the attributes of an entry to its account name
+        lookup - pwd.getpwnam, grp.getgrnam or FreeNAS_NSS_Resolver.resolve
+    """
+
+    def __init__(self, cache, dcache, name, lookup):
+        self.cache = cache
+        self.dcache = dcache
+        self.name = name
+        self.lookup = lookup
+        self.dkeys = set()
+        self.keys = set()
+
+    def merge(self, page):
+        # A bulk load per page keeps the caches' write transactions short
+        dcached, cached = [], []
+        for entry in page:
+            CN = str(entry[0])
+            dcached.append((CN, entry))
+            self.dkeys.add(CN)
+
+            key = self.name(entry[1])
+            try:
+                obj = self.lookup(key)
+
+            except Exception as e:
+                log.debug("Error looking up %s: %s", key, e)
+                continue
+
+            cached.append((key, obj))
+            self.keys.add(key)
+
+        self.dcache.bulk_load(dcached, overwrite=True)
+        self.cache.bulk_load(cached, overwrite=True)
+
+    def finish(self, full=False):
+        """
+        Arguments:
+            full - the pages were the whole directory, drop everything else
+
+        Returns:
+            number of entries merged
+        """
+        if full:
+            for c, seen in (
+                (self.dcache, self.dkeys),
+                (self.cache, self.keys),
+            ):
+                for key in c.keys():
+                    if key not in seen:
+                        c.delete(key)
+
+        return len(self.dkeys)
+
+
+class FreeNAS_LDAP_CacheRefresh(FreeNAS_LDAP):
+    """
+    Bring the LDAP user and group caches up to date in place
+
+    Only entries with a modifyTimestamp newer than the last refresh are
+    fetched. A full refresh fetches everything and drops entries which
+    are gone from the directory (a delta refresh can not see those),
+    without the caches ever being empty in between.
+    """
+
+    def __init__(self, **kwargs):
+        log.debug("FreeNAS_LDAP_CacheRefresh.__init__: enter")
+
+        super(FreeNAS_LDAP_CacheRefresh, self).__init__(**kwargs)
+
+        self.__ucache = FreeNAS_UserCache()
+        self.__ducache = FreeNAS_Directory_UserCache()
+        self.__gcache = FreeNAS_GroupCache()
+        self.__dgcache = FreeNAS_Directory_GroupCache()
+
+        log.debug("FreeNAS_LDAP_CacheRefresh.__init__: leave")
+
+    def refresh(self, full=False):
+        """
+        Returns:
+            tuple of the number of users and groups fetched
+        """
+        log.debug("FreeNAS_LDAP_CacheRefresh.refresh: enter")
+
+        mark = _cache_watermark(self.__ducache.cachedir)
+        changed = None
+        if not full and mark.get('host') == self.host and \
+            mark.get('basedn') == self.basedn:
+            changed = mark.get('timestamp')
+        log.debug("FreeNAS_LDAP_CacheRefresh.refresh: changed = %s", changed)
+
+        started = time.time()
+        self.pagesize = FREENAS_LDAP_PAGESIZE
+        host = self.host.split('.')[0].upper()
+
+        def qualify(name):
+            if self.use_default_domain:
+                return name
+            return "{}{}{}".format(host, FREENAS_AD_SEPARATOR, name)
+
+        # A delta only has a handful of names to look up, enumerating
+        # the whole passwd/group database is only worth it for a full one
+        getpwnam, getgrnam = pwd.getpwnam, grp.getgrnam
+        if changed is None:
+            getpwnam = FreeNAS_NSS_Resolver('passwd').resolve
+            getgrnam = FreeNAS_NSS_Resolver('group').resolve
+
+        syncs = (
+            _CacheSync(self.__ucache, self.__ducache,
+                lambda u: qualify(u['uid'][0]), getpwnam),
+            _CacheSync(self.__gcache, self.__dgcache,
+                lambda g: qualify(g['cn'][0]), getgrnam),
+        )
+        for i, page in self.get_user_and_group_pages(changed=changed):
+            syncs[i].merge(page)
+        users, groups = [sync.finish(full=changed is None) for sync in syncs]
+
+        _cache_loaded(
+            os.path.join(self.__ucache.cachedir, ".ul"),
+            os.path.join(self.__ducache.cachedir, ".dul"),
+            os.path.join(self.__gcache.cachedir, ".gl"),
+            os.path.join(self.__dgcache.cachedir, ".dgl"),
+        )
+        _cache_set_watermark(self.__ducache.cachedir, {
+            'host': self.host,
+            'basedn': self.basedn,
+            'timestamp': time.strftime('%Y%m%d%H%M%SZ',
+                time.gmtime(started - FREENAS_LDAP_CACHE_SKEW)),
+        })
+
+        log.debug("FreeNAS_LDAP_CacheRefresh.refresh: leave")
+        return users, groups
+
+
+class FreeNAS_ActiveDirectory_CacheRefresh(FreeNAS_ActiveDirectory):
+    """
+    Bring the Active Directory user and group caches up to date in place
+
+    Only entries with a uSNChanged above the domain controller's
+    highestCommittedUSN at the last refresh are fetched. USNs are local
+    to a domain controller, a different one means a full refresh. A
+    full refresh also drops entries which are gone from the domain.
+    """
+
+    def __init__(self, **kwargs):
+        log.debug("FreeNAS_ActiveDirectory_CacheRefresh.__init__: enter")
+
+        super(FreeNAS_ActiveDirectory_CacheRefresh, self).__init__(**kwargs)
+
+        if kwargs.has_key('netbiosname') and kwargs['netbiosname']:
+            self.__domains = self.get_domains(
+                netbiosname=kwargs['netbiosname'])
+        else:
+            self.__domains = self.get_domains()
+
+        log.debug("FreeNAS_ActiveDirectory_CacheRefresh.__init__: leave")
+
+    def refresh(self, full=False):
+        """
+        Returns:
+            tuple of the number of users and groups fetched
+        """
+        log.debug("FreeNAS_ActiveDirectory_CacheRefresh.refresh: enter")
+
+        users = groups = 0
+        # Shared by the domains getting a full refresh, see
+        # FreeNAS_LDAP_CacheRefresh.refresh
+        uresolver = FreeNAS_NSS_Resolver('passwd', casefold=True)
+        gresolver = FreeNAS_NSS_Resolver('group', casefold=True)
+        for d in self.__domains:
+            n = d['nETBIOSName']
+            ucache = FreeNAS_UserCache(dir=n)
+            ducache = FreeNAS_Directory_UserCache(dir=n)
+            gcache = FreeNAS_GroupCache(dir=n)
+            dgcache = FreeNAS_Directory_GroupCache(dir=n)
+
+            dcs = self.get_domain_controllers(d['dnsRoot'])
+            if not dcs:
+                raise FreeNAS_ActiveDirectory_Exception(
+                    "Unable to find domain controllers for %s" % d['dnsRoot'])
+            (self.host, self.port) = self.get_best_host(dcs)
+
+            self.basedn = d['nCName']
+            self.pagesize = FREENAS_LDAP_PAGESIZE
+
+            # Read the USN before searching, whatever changes meanwhile
+            # is picked up by the next refresh
+            server = usn = None
+            try:
+                rootDSE = self.get_rootDSE()[0][1]
+                server = rootDSE['dsServiceName'][0]
+                usn = long(rootDSE['highestCommittedUSN'][0])
+
+            except Exception as e:
+                log.debug("Unable to get highestCommittedUSN: %s", e)
+
+            mark = _cache_watermark(ducache.cachedir)
+            changed = None
+            if not full and server and mark.get('server') == server and \
+                mark.get('basedn') == self.basedn and \
+                mark.get('usn') is not None:
+                changed = mark['usn'] + 1
+            log.debug("FreeNAS_ActiveDirectory_CacheRefresh.refresh: "
+                "[%s] changed = %s", n, changed)
+
+            def qualify(name):
+                if self.use_default_domain:
+                    return name
+                return "{}{}{}".format(n, FREENAS_AD_SEPARATOR, name)
+
+            sync = _CacheSync(ucache, ducache,
+                lambda u: qualify(u['sAMAccountName'][0]),
+                uresolver.resolve if changed is None else pwd.getpwnam)
+            for page in self.get_user_pages(changed=changed):
+                sync.merge(page)
+            users += sync.finish(full=changed is None)
+
+            sync = _CacheSync(gcache, dgcache,
+                lambda g: qualify(g['sAMAccountName'][0]),
+                gresolver.resolve if changed is None else grp.getgrnam)
+            for page in self.get_group_pages(changed=changed):
+                sync.merge(page)
+            groups += sync.finish(full=changed is None)
+
+            _cache_loaded(
+                os.path.join(ucache.cachedir, ".ul"),
+                os.path.join(ducache.cachedir, ".dul"),
+                os.path.join(gcache.cachedir, ".gl"),
+                os.path.join(dgcache.cachedir, ".dgl"),
+            )
+            if usn is not None:
+                _cache_set_watermark(ducache.cachedir, {
+                    'server': server,
+                    'basedn': self.basedn,
+                    'usn': usn,
+                })
+
+        log.debug("FreeNAS_ActiveDirectory_CacheRefresh.refresh: leave")
+        return users, groups
+
+
 class FreeNAS_LDAP_Group(FreeNAS_LDAP):
     def __init__(self, group, **kwargs):
         log.debug("FreeNAS_LDAP_Group.__init__: enter")
@@ -2296,10 +2836,14 @@ class FreeNAS_LDAP_Group(FreeNAS_LDAP):
         gr = None
         self.attributes = ['cn']
 
-        if (self.flags & FLAGS_CACHE_READ_GROUP) \
-            and self.__gcache.has_key(group):
-            log.debug("FreeNAS_LDAP_Group.__get_group: group in cache")
-            return self.__gcache[group]
+        if self.flags & FLAGS_CACHE_READ_GROUP:
+            gr = self.__gcache.lookup_name(group)
+            if gr is None and _is_id(group):
+                gr = self.__gcache.lookup_gid(int(group))
+            if gr is not None:
+                log.debug("FreeNAS_LDAP_Group.__get_group: group in cache")
+                self._gr = gr
+                return gr
 
         if (self.flags & FLAGS_CACHE_READ_GROUP) \
             and self.__dgcache.has_key(self.__key):
@@ -2405,12 +2949,15 @@ class FreeNAS_ActiveDirectory_Group(FreeNAS_ActiveDirectory):
         log.debug("FreeNAS_ActiveDirectory_Group.__get_group: " \
             "netbiosname = %s", netbiosname)
 
-        if (self.flags & FLAGS_CACHE_READ_GROUP) \
-            and self.__gcache.has_key(self.__gkey):
-            log.debug("FreeNAS_ActiveDirectory_User.__get_group: " \
-                "group in cache")
-            self._gr = self.__gcache[self.__gkey]
-            return self.__gcache[self.__gkey]
+        if self.flags & FLAGS_CACHE_READ_GROUP:
+            gr = self.__gcache.lookup_name(self.__gkey)
+            if gr is None and _is_id(group):
+                gr = self.__gcache.lookup_gid(int(group))
+            if gr is not None:
+                log.debug("FreeNAS_ActiveDirectory_User.__get_group: " \
+                    "group in cache")
+                self._gr = gr
+                return gr
 
         g = gr = None
         self.basedn = self.get_baseDN()
@@ -2508,10 +3055,14 @@ class FreeNAS_LDAP_User(FreeNAS_LDAP):
         pw = None
         self.attributes = ['uid']
 
-        if (self.flags & FLAGS_CACHE_READ_USER) \
-            and self.__ucache.has_key(user):
-            log.debug("FreeNAS_LDAP_User.__get_user: user in cache")
-            return self.__ucache[user]
+        if self.flags & FLAGS_CACHE_READ_USER:
+            pw = self.__ucache.lookup_name(user)
+            if pw is None and _is_id(user):
+                pw = self.__ucache.lookup_uid(int(user))
+            if pw is not None:
+                log.debug("FreeNAS_LDAP_User.__get_user: user in cache")
+                self._pw = pw
+                return pw
 
         if (self.flags & FLAGS_CACHE_READ_USER) \
             and self.__ducache.has_key(self.__key):
@@ -2617,12 +3168,15 @@ class FreeNAS_ActiveDirectory_User(FreeNAS_ActiveDirectory):
         log.debug("FreeNAS_ActiveDirectory_User.__get_user: " \
             "netbiosname = %s", netbiosname)
 
-        if (self.flags & FLAGS_CACHE_READ_USER) \
-            and self.__ucache.has_key(self.__ukey):
-            log.debug("FreeNAS_ActiveDirectory_User.__get_user: " \
-                "user in cache")
-            self._pw = self.__ucache[self.__ukey]
-            return self.__ucache[self.__ukey]
+        if self.flags & FLAGS_CACHE_READ_USER:
+            pw = self.__ucache.lookup_name(self.__ukey)
+            if pw is None and _is_id(user):
+                pw = self.__ucache.lookup_uid(int(user))
+            if pw is not None:
+                log.debug("FreeNAS_ActiveDirectory_User.__get_user: " \
+                    "user in cache")
+                self._pw = pw
+                return pw
 
         pw = None
         self.basedn = self.get_baseDN()
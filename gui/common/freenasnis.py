@@ -272,6 +272,7 @@ class FreeNAS_NIS_Users(FreeNAS_NIS):
                 return
 
         self._save()
+        resolver = FreeNAS_NSS_Resolver('passwd')
         for d in self.__domains:
             self.__users[d] = []
 
@@ -294,7 +295,7 @@ class FreeNAS_NIS_Users(FreeNAS_NIS):
                     self.__ducache[d][uid] = u
 
                 try:
-                    pw = pwd.getpwnam(uid)
+                    pw = resolver.resolve(uid)
 
                 except Exception, e:
                     log.debug("Error on getpwname: %s",  e)
@@ -407,6 +408,7 @@ class FreeNAS_NIS_Groups(FreeNAS_NIS):
                 return
 
         self._save()
+        resolver = FreeNAS_NSS_Resolver('group')
         for d in self.__domains:
             self.__groups[d] = []
 
@@ -429,7 +431,7 @@ class FreeNAS_NIS_Groups(FreeNAS_NIS):
                 self.__groupnames.append(group)
 
                 try:
-                    gr = grp.getgrnam(group)
+                    gr = resolver.resolve(group)
 
                 except:
                     continue
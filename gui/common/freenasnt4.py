@@ -299,6 +299,7 @@ class FreeNAS_NT4_Users(FreeNAS_NT4):
                 return 
 
         self._save()
+        resolver = FreeNAS_NSS_Resolver('passwd', casefold=True)
         for d in self.__domains:
             self.__users[d] = []
 
@@ -321,7 +322,7 @@ class FreeNAS_NT4_Users(FreeNAS_NT4):
                 sAMAccountName = u['sAMAccountName']
                 usernames.append(sAMAccountName)
                 try:
-                    pw = pwd.getpwnam(sAMAccountName)
+                    pw = resolver.resolve(sAMAccountName)
 
                 except Exception, e:
                     log.debug("Error on getpwname: %s",  e)
@@ -444,6 +445,7 @@ class FreeNAS_NT4_Groups(FreeNAS_NT4):
                 return
 
         self._save()
+        resolver = FreeNAS_NSS_Resolver('group', casefold=True)
         for d in self.__domains:
             self.__groups[d] = []
 
@@ -465,7 +467,7 @@ class FreeNAS_NT4_Groups(FreeNAS_NT4):
                     self.__dgcache[d][sAMAccountName.upper()] = g
 
                 try:
-                    gr = grp.getgrnam(sAMAccountName)
+                    gr = resolver.resolve(sAMAccountName)
 
                 except:
                     continue
@@ -24,9 +24,13 @@
 # POSSIBILITY OF SUCH DAMAGE.
 #
 #####################################################################
+import bisect
 import grp
 import logging
+import os
 import pwd
+import threading
+import time
 
 from freenasUI.common.system import (
     activedirectory_enabled,
@@ -36,7 +40,16 @@ from freenasUI.common.system import (
     nt4_enabled,
 )
 
+from freenasUI.common.freenascache import (
+    FLAGS_CACHE_READ_GROUP,
+    FLAGS_CACHE_READ_USER,
+    FLAGS_CACHE_WRITE_GROUP,
+    FLAGS_CACHE_WRITE_USER,
+    FREENAS_CACHEDIR,
+)
+
 from freenasUI.common.freenasldap import (
+    FLAGS_DBINIT,
     FreeNAS_ActiveDirectory_Group,
     FreeNAS_ActiveDirectory_User,
     FreeNAS_ActiveDirectory_Groups,
@@ -405,3 +418,127 @@ class FreeNAS_Users(object):
             yield pw
         for pw in self.__users:
             yield pw
+
+
+# How often at most the name indexes look for changes
+NAME_INDEX_INTERVAL = 2
+
+# Files touched whenever a user/group cache has been (re)loaded
+NAME_INDEX_MARKERS = ('.ul', '.dul', '.gl', '.dgl')
+
+
+def _name_index_signature():
+    """
+    Anything that changes the user and group lists changes this: the
+    database (local accounts, directory service settings) or one of the
+    cache loaded markers (directory cache filled, refreshed or expired)
+    """
+    from django.conf import settings
+
+    paths = [settings.DATABASES['default']['NAME']]
+    for root, dirs, files in os.walk(FREENAS_CACHEDIR):
+        for f in files:
+            if f in NAME_INDEX_MARKERS:
+                paths.append(os.path.join(root, f))
+
+    signature = []
+    for path in sorted(paths):
+        try:
+            st = os.stat(path)
+        except OSError:
+            continue
+        signature.append((path, st.st_mtime, st.st_size))
+
+    return signature
+
+
+def _to_unicode(name):
+    if isinstance(name, unicode):
+        return name
+    return str(name).decode('utf-8', 'replace')
+
+
+class FreeNAS_NameIndex(object):
+    """
+    Sorted account names for prefix searches (typeahead)
+
+    The index lives as long as the process, it is rebuilt only when
+    _name_index_signature changes, so a search is a bisect into the
+    sorted names instead of walking the whole directory cache.
+
+    Arguments:
+        names - callable returning the names to index
+    """
+
+    def __init__(self, names):
+        self.__names = names
+        self.__sorted = []
+        self.__signature = None
+        self.__checked = 0
+        self.__lock = threading.Lock()
+
+    def __refresh(self):
+        if (
+            self.__signature is not None and
+            time.time() - self.__checked < NAME_INDEX_INTERVAL
+        ):
+            return
+
+        with self.__lock:
+            if time.time() - self.__checked < NAME_INDEX_INTERVAL:
+                return
+            signature = _name_index_signature()
+            if signature != self.__signature:
+                log.debug("FreeNAS_NameIndex.__refresh: rebuilding")
+                self.__sorted = sorted(
+                    set(_to_unicode(name) for name in self.__names())
+                )
+                self.__signature = signature
+            self.__checked = time.time()
+
+    def invalidate(self):
+        with self.__lock:
+            self.__signature = None
+            self.__checked = 0
+
+    def __len__(self):
+        self.__refresh()
+        return len(self.__sorted)
+
+    def search(self, prefix=None, limit=50, exclude=None):
+        """
+        Returns:
+            up to limit names starting with prefix, in order
+        """
+        self.__refresh()
+        names = self.__sorted
+
+        if prefix:
+            prefix = _to_unicode(prefix)
+            i = bisect.bisect_left(names, prefix)
+        else:
+            i = 0
+
+        found = []
+        while i < len(names) and len(found) < limit:
+            name = names[i]
+            if prefix and not name.startswith(prefix):
+                break
+            if not exclude or name not in exclude:
+                found.append(name)
+            i += 1
+
+        return found
+
+
+FreeNAS_Users_Index = FreeNAS_NameIndex(lambda: (
+    user.pw_name for user in FreeNAS_Users(
+        flags=FLAGS_DBINIT | FLAGS_CACHE_READ_USER | FLAGS_CACHE_WRITE_USER
+    )
+))
+
+FreeNAS_Groups_Index = FreeNAS_NameIndex(lambda: (
+    group.gr_name for group in FreeNAS_Groups(
+        flags=FLAGS_DBINIT | FLAGS_CACHE_READ_GROUP | FLAGS_CACHE_WRITE_GROUP
+    )
+))
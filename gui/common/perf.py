@@ -0,0 +1,438 @@
+#+
+# Copyright 2015 iXsystems, Inc.
+# All rights reserved
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted providing that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR ``AS IS'' AND ANY EXPRESS OR
+# IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS
+# OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT,
+# STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING
+# IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+#####################################################################
+
+"""
+Per-request performance counters
+
+Every request served by the GUI or the API (see
+freeadmin.middleware.PerfMiddleware) is accounted to its view: latency,
+SQL queries and the processes it spawned through pipeopen or
+notifier._pipeopen. Each process keeps its own counters and writes them
+to PERF_PATH every now and then, snapshot() merges the files of all the
+processes serving the GUI.
+"""
+import cPickle as pickle
+import glob
+import logging
+import os
+import random
+import subprocess
+import tempfile
+import threading
+import time
+from collections import deque
+
+log = logging.getLogger('common.perf')
+
+PERF_PATH = '/var/tmp/.perf'
+# Upper bounds of the latency histogram buckets, in milliseconds
+BUCKETS = (5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000, 30000)
+# Write the counters of this process at most that often, in seconds
+FLUSH_INTERVAL = 10
+# Slow requests kept per process
+SLOW_KEEP = 50
+# Commands kept per slow request
+SLOW_COMMANDS = 20
+
+_local = threading.local()
+
+
+def _command_name(args):
+    if isinstance(args, basestring):
+        args = args.split(None, 1)
+    if not args:
+        return ''
+    return os.path.basename(str(args[0]))
+
+
+class RequestStats(object):
+    """
+    Counters of the request being served
+    """
+
+    def __init__(self, path, method):
+        self.path = path
+        self.method = method
+        self.view = None
+        self.started = time.time()
+        self.subprocesses = 0
+        self.subprocess_time = 0.0
+        self.sql_queries = 0
+        self.sql_time = 0.0
+        self.commands = []
+
+    def subprocess_started(self, args):
+        self.subprocesses += 1
+        if len(self.commands) < SLOW_COMMANDS:
+            if isinstance(args, basestring):
+                self.commands.append(args)
+            else:
+                self.commands.append(' '.join(str(a) for a in args))
+
+    def subprocess_done(self, elapsed):
+        self.subprocess_time += elapsed
+
+
+def begin(path, method='GET'):
+    """
+    Start accounting the request served by this thread
+    """
+    _local.request = RequestStats(path, method)
+    return _local.request
+
+
+def current():
+    """
+    Counters of the request served by this thread, None if there is none
+    """
+    return getattr(_local, 'request', None)
+
+
+def end():
+    stats = current()
+    _local.request = None
+    return stats
+
+
+class TracedCursor(object):
+    """
+    Database cursor counting and timing the queries of a request
+
+    Only the count and time are kept, unlike the debug cursor which
+    holds on to every SQL statement.
+    """
+
+    def __init__(self, cursor, request):
+        self.cursor = cursor
+        self.request = request
+
+    def __account(self, started):
+        self.request.sql_queries += 1
+        self.request.sql_time += time.time() - started
+
+    def execute(self, *args, **kwargs):
+        started = time.time()
+        try:
+            return self.cursor.execute(*args, **kwargs)
+        finally:
+            self.__account(started)
+
+    def executemany(self, *args, **kwargs):
+        started = time.time()
+        try:
+            return self.cursor.executemany(*args, **kwargs)
+        finally:
+            self.__account(started)
+
+    def __getattr__(self, attr):
+        return getattr(self.cursor, attr)
+
+    def __iter__(self):
+        return iter(self.cursor)
+
+
+def trace_queries(connection):
+    """
+    Have the cursors of a database connection accounted to the request
+    being served by the thread using them, see TracedCursor
+    """
+    if getattr(connection, '_perf_traced', False):
+        return
+    cursor = connection.cursor
+
+    def traced(*args, **kwargs):
+        c = cursor(*args, **kwargs)
+        request = current()
+        if request is None:
+            return c
+        return TracedCursor(c, request)
+
+    connection.cursor = traced
+    connection._perf_traced = True
+
+
+class TracedPopen(subprocess.Popen):
+    """
+    subprocess.Popen accounted to the request being served
+
+    The time is taken from the fork until the exit status is collected
+    (wait, poll or communicate).
+    """
+
+    def __init__(self, args, *pargs, **kwargs):
+        self._perf_request = current()
+        self._perf_started = time.time()
+        self._perf_done = False
+        self._perf_args = args
+        super(TracedPopen, self).__init__(args, *pargs, **kwargs)
+        stats.subprocess_started(args)
+        if self._perf_request is not None:
+            self._perf_request.subprocess_started(args)
+
+    def __done(self):
+        if self._perf_done:
+            return
+        self._perf_done = True
+        elapsed = time.time() - self._perf_started
+        stats.subprocess_done(self._perf_args, elapsed)
+        if self._perf_request is not None:
+            self._perf_request.subprocess_done(elapsed)
+
+    def wait(self):
+        returncode = super(TracedPopen, self).wait()
+        self.__done()
+        return returncode
+
+    def poll(self):
+        returncode = super(TracedPopen, self).poll()
+        if returncode is not None:
+            self.__done()
+        return returncode
+
+
+class system_call(object):
+    """
+    Account a command run through os.system
+
+        with system_call(command):
+            os.system(command)
+    """
+
+    def __init__(self, command):
+        self.command = command
+
+    def __enter__(self):
+        self.request = current()
+        self.started = time.time()
+        stats.subprocess_started(self.command)
+        if self.request is not None:
+            self.request.subprocess_started(self.command)
+
+    def __exit__(self, *exc_info):
+        elapsed = time.time() - self.started
+        stats.subprocess_done(self.command, elapsed)
+        if self.request is not None:
+            self.request.subprocess_done(elapsed)
+
+
+def _new_view():
+    return {
+        'count': 0,
+        'time': 0.0,
+        'max': 0.0,
+        'histogram': [0] * (len(BUCKETS) + 1),
+        'sql_queries': 0,
+        'sql_time': 0.0,
+        'subprocesses': 0,
+        'subprocess_time': 0.0,
+    }
+
+
+class PerfStats(object):
+    """
+    Counters of this process
+    """
+
+    def __init__(self, path=PERF_PATH):
+        self.path = path
+        self.since = time.time()
+        self.views = {}
+        self.commands = {}
+        self.slow = deque(maxlen=SLOW_KEEP)
+        self._lock = threading.Lock()
+        self._flushed = 0
+
+    def subprocess_started(self, args):
+        name = _command_name(args)
+        with self._lock:
+            self.commands.setdefault(name, [0, 0.0, 0])[0] += 1
+
+    def subprocess_done(self, args, elapsed):
+        with self._lock:
+            self.commands.setdefault(_command_name(args), [0, 0.0, 0])[1] += \
+                elapsed
+
+    def subprocess_cached(self, args):
+        """
+        A command served from common.cmdcache instead of forking
+        """
+        with self._lock:
+            self.commands.setdefault(_command_name(args), [0, 0.0, 0])[2] += 1
+
+    def record(self, request, sql_queries=0, sql_time=0.0, slow=None,
+               sample=1.0):
+        """
+        Account a finished request to its view
+
+        Arguments:
+            request - RequestStats
+            slow - requests taking longer than that (seconds) are slow
+            sample - fraction of the slow requests logged and kept
+        """
+        elapsed = time.time() - request.started
+        ms = elapsed * 1000
+        view = request.view or request.path
+        with self._lock:
+            entry = self.views.get(view)
+            if entry is None:
+                entry = self.views[view] = _new_view()
+            entry['count'] += 1
+            entry['time'] += elapsed
+            entry['max'] = max(entry['max'], elapsed)
+            for i, bound in enumerate(BUCKETS):
+                if ms <= bound:
+                    break
+            else:
+                i = len(BUCKETS)
+            entry['histogram'][i] += 1
+            entry['sql_queries'] += sql_queries
+            entry['sql_time'] += sql_time
+            entry['subprocesses'] += request.subprocesses
+            entry['subprocess_time'] += request.subprocess_time
+
+            if slow is not None and elapsed > slow and \
+                    random.random() < sample:
+                log.warn(
+                    "Slow request %s %s (%s): %.3fs, %d queries (%.3fs), "
+                    "%d processes (%.3fs)",
+                    request.method, request.path, view, elapsed,
+                    sql_queries, sql_time, request.subprocesses,
+                    request.subprocess_time,
+                )
+                self.slow.append({
+                    'time': request.started,
+                    'method': request.method,
+                    'path': request.path,
+                    'view': view,
+                    'elapsed': elapsed,
+                    'sql_queries': sql_queries,
+                    'sql_time': sql_time,
+                    'subprocesses': request.subprocesses,
+                    'subprocess_time': request.subprocess_time,
+                    'commands': list(request.commands),
+                })
+        self.flush()
+
+    def data(self):
+        with self._lock:
+            return {
+                'pid': os.getpid(),
+                'since': self.since,
+                'views': dict(
+                    (k, dict(v, histogram=list(v['histogram'])))
+                    for k, v in self.views.items()
+                ),
+                'commands': dict(
+                    (k, list(v)) for k, v in self.commands.items()
+                ),
+                'slow': list(self.slow),
+            }
+
+    def flush(self, force=False):
+        """
+        Write the counters of this process for snapshot()
+        """
+        now = time.time()
+        if not force and now - self._flushed < FLUSH_INTERVAL:
+            return
+        self._flushed = now
+        try:
+            if not os.path.isdir(self.path):
+                os.makedirs(self.path)
+            fd, tmp = tempfile.mkstemp(dir=self.path)
+            with os.fdopen(fd, 'wb') as f:
+                pickle.dump(self.data(), f, pickle.HIGHEST_PROTOCOL)
+            os.rename(tmp, os.path.join(self.path, str(os.getpid())))
+        except (IOError, OSError), e:
+            log.debug("Failed to write perf counters: %s", e)
+
+
+stats = PerfStats()
+
+
+def _alive(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError:
+        return False
+    return True
+
+
+def snapshot(path=PERF_PATH):
+    """
+    Counters of all the processes serving the GUI, merged
+
+    Returns:
+        dict with the buckets of the histograms, the counters per view,
+        the number and total time of the processes spawned per command
+        (and the number of times it was served from common.cmdcache)
+        and the slow requests kept, newest first
+    """
+    stats.flush(force=True)
+    merged = {
+        'buckets': list(BUCKETS),
+        'processes': [],
+        'views': {},
+        'commands': {},
+        'slow': [],
+    }
+    for name in glob.glob(os.path.join(path, '[0-9]*')):
+        pid = int(os.path.basename(name))
+        if not _alive(pid):
+            try:
+                os.unlink(name)
+            except OSError:
+                pass
+            continue
+        try:
+            with open(name, 'rb') as f:
+                data = pickle.load(f)
+        except Exception, e:
+            log.debug("Failed to read perf counters %s: %s", name, e)
+            continue
+
+        merged['processes'].append({'pid': pid, 'since': data['since']})
+        for view, entry in data['views'].items():
+            into = merged['views'].get(view)
+            if into is None:
+                merged['views'][view] = entry
+                continue
+            for key in ('count', 'time', 'sql_queries', 'sql_time',
+                        'subprocesses', 'subprocess_time'):
+                into[key] += entry[key]
+            into['max'] = max(into['max'], entry['max'])
+            into['histogram'] = [
+                a + b for a, b in zip(into['histogram'], entry['histogram'])
+            ]
+        for command, counters in data['commands'].items():
+            into = merged['commands'].setdefault(command, [0, 0.0, 0])
+            for i, value in enumerate(counters):
+                into[i] += value
+        merged['slow'].extend(data['slow'])
+
+    merged['slow'].sort(key=lambda s: s['time'], reverse=True)
+    return merged
@@ -26,12 +26,15 @@
 #####################################################################
 
 from shlex import split as shlex_split
-from subprocess import Popen, PIPE
+from subprocess import PIPE
 from os import system as __system
 import logging
 import ctypes
 import signal
 
+from freenasUI.common import cmdcache
+from freenasUI.common.perf import TracedPopen as Popen, system_call
+
 
 logging.NOTICE = 60
 logging.addLevelName(logging.NOTICE, "NOTICE")
@@ -57,6 +60,7 @@ def pipeopen(command, important=True, logger=log, allowfork=False, quiet=False):
         logger.log(logging.NOTICE if important else logging.DEBUG,
             "Popen()ing: " + command)
     args = shlex_split(str(command))
+    cmdcache.cache.observe(command)
 
     preexec_fn = None
     if allowfork:
@@ -70,7 +74,9 @@ def pipeopen(command, important=True, logger=log, allowfork=False, quiet=False):
 def system(command, important=True, logger=log):
     logger.log(logging.NOTICE if important else logging.DEBUG,
         "Executing: " + command)
-    __system("(" + command + ") 2>&1 | logger -p daemon.notice -t %s" % (
-        logger.name, ))
+    cmdcache.cache.observe(command)
+    with system_call(command):
+        __system("(" + command + ") 2>&1 | logger -p daemon.notice -t %s" % (
+            logger.name, ))
     logger.log(logging.INFO if important else logging.DEBUG,
         "Executed: " + command)
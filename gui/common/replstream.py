@@ -0,0 +1,358 @@
+#+
+# Copyright 2015 iXsystems, Inc.
+# All rights reserved
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted providing that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR ``AS IS'' AND ANY EXPRESS OR
+# IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS
+# OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT,
+# STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING
+# IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+#####################################################################
+
+import errno
+import fcntl
+import logging
+import os
+import subprocess
+import threading
+import time
+from collections import deque
+
+log = logging.getLogger('common.replstream')
+
+BLOCKSIZE = 1024 * 1024
+BUFFERSIZE = 64 * 1024 * 1024
+
+# (compress, decompress) commands, level is substituted when given
+COMPRESSORS = {
+    'pigz': (['/usr/local/bin/pigz'], ['/usr/local/bin/pigz', '-d']),
+    'plzip': (['/usr/local/bin/plzip'], ['/usr/local/bin/plzip', '-d']),
+    'lz4': (['/usr/local/bin/lz4c'], ['/usr/local/bin/lz4c', '-d']),
+}
+
+
+def compress_commands(compression, level=None):
+    """
+    Commands to (de)compress a stream
+
+    Returns:
+        tuple of the compress argv list and the decompress argv list,
+        (None, None) when compression is off or unknown
+    """
+    if compression not in COMPRESSORS:
+        return None, None
+    compress, decompress = COMPRESSORS[compression]
+    compress = list(compress)
+    if level is not None:
+        compress.append('-%d' % level)
+    return compress, list(decompress)
+
+
+def zfs_send_command(snapshot, fromsnap=None, replicate=False,
+                     resume_token=None, verbose=True):
+    """
+    Build the zfs send argv for a full, incremental (-I) or resumed
+    (-t) stream
+    """
+    cmd = ['/sbin/zfs', 'send']
+    if verbose:
+        # Shows progress in the process title, see Replication.status
+        cmd.append('-V')
+    if resume_token:
+        cmd.extend(['-t', resume_token])
+        return cmd
+    if replicate:
+        cmd.append('-R')
+    if fromsnap:
+        cmd.extend(['-I', fromsnap])
+    cmd.append(snapshot)
+    return cmd
+
+
+def parse_resume_token(output):
+    """
+    Snapshot a resume token ends at from `zfs send -nvt <token>` output
+    """
+    for line in output.split('\n'):
+        line = line.strip()
+        if line.startswith('toname = '):
+            return line[len('toname = '):]
+    return None
+
+
+def _cloexec(fd):
+    fcntl.fcntl(
+        fd, fcntl.F_SETFD, fcntl.fcntl(fd, fcntl.F_GETFD) | fcntl.FD_CLOEXEC
+    )
+    return fd
+
+
+class RingBuffer(object):
+    """
+    Bounded FIFO of data blocks between a reader and a writer thread
+
+    Holds at most ``size`` bytes (or a single block larger than that) so
+    a burst from zfs send is absorbed while the network stalls, and the
+    other way around, without either side waiting on the other.
+    """
+
+    def __init__(self, size=BUFFERSIZE):
+        self.size = size
+        self.used = 0
+        self.peak = 0
+        self._blocks = deque()
+        self._closed = False
+        self._aborted = False
+        self._cond = threading.Condition()
+
+    def put(self, block):
+        """
+        Queue a block, waiting for room
+
+        Returns:
+            False if the buffer was aborted by the consumer
+        """
+        with self._cond:
+            while (
+                self.used and self.used + len(block) > self.size and
+                not self._aborted
+            ):
+                self._cond.wait()
+            if self._aborted:
+                return False
+            self._blocks.append(block)
+            self.used += len(block)
+            self.peak = max(self.peak, self.used)
+            self._cond.notify_all()
+            return True
+
+    def get(self):
+        """
+        Dequeue the next block, empty string once closed and drained
+        """
+        with self._cond:
+            while not self._blocks and not self._closed and not self._aborted:
+                self._cond.wait()
+            if not self._blocks or self._aborted:
+                return ''
+            block = self._blocks.popleft()
+            self.used -= len(block)
+            self._cond.notify_all()
+            return block
+
+    def close(self):
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+
+    def abort(self):
+        with self._cond:
+            self._aborted = True
+            self._blocks.clear()
+            self.used = 0
+            self._cond.notify_all()
+
+
+class ReplicationStream(object):
+    """
+    zfs send | [compress] | ring buffer | [rate limit] | receive
+
+    The compressor and the receiving side run as processes, the
+    buffering and rate limiting is done in-process by two threads so
+    there is no need for the throttle/dd/mbuffer chain in between.
+
+    Arguments:
+        send - zfs send argv (see zfs_send_command)
+        receive - command reading the stream on stdin, argv list or a
+                  shell string (usually ssh running zfs receive)
+        compress - compress argv list or None (see compress_commands)
+        blocksize - size of reads from the sending side
+        buffersize - bytes the ring buffer may hold
+        limit - rate limit in KiB/s, 0 for none
+    """
+
+    def __init__(self, send, receive, compress=None, blocksize=BLOCKSIZE,
+                 buffersize=BUFFERSIZE, limit=0):
+        self.send = send
+        self.receive = receive
+        self.compress = compress
+        self.blocksize = blocksize
+        self.limit = limit
+        self.buffer = RingBuffer(buffersize)
+        self.sender = None
+        self.compressor = None
+        self.receiver = None
+        self.bytes = 0
+        self.elapsed = 0
+        self.returncode = None
+
+    @property
+    def throughput(self):
+        """
+        Bytes per second leaving the buffer (compressed size)
+        """
+        if not self.elapsed:
+            return 0
+        return self.bytes / self.elapsed
+
+    def _reader(self, fd):
+        # A pipe hands out at most its own size per read, gather reads
+        # into blocks of self.blocksize like dd obs= would
+        chunks = []
+        pending = 0
+        try:
+            while True:
+                try:
+                    chunk = os.read(fd, self.blocksize - pending)
+                except OSError, e:
+                    if e.errno == errno.EINTR:
+                        continue
+                    log.warn("Failed to read replication stream: %s", e)
+                    self.buffer.abort()
+                    break
+                if chunk:
+                    chunks.append(chunk)
+                    pending += len(chunk)
+                    if pending < self.blocksize:
+                        continue
+                if chunks and not self.buffer.put(''.join(chunks)):
+                    break
+                chunks = []
+                pending = 0
+                if not chunk:
+                    break
+        finally:
+            # The sending side gets SIGPIPE if the buffer was aborted
+            os.close(fd)
+            self.buffer.close()
+
+    def _writer(self, fd):
+        started = time.time()
+        try:
+            while True:
+                block = self.buffer.get()
+                if not block:
+                    break
+                view = memoryview(block)
+                while view:
+                    try:
+                        written = os.write(fd, view)
+                    except OSError, e:
+                        if e.errno == errno.EINTR:
+                            continue
+                        if e.errno != errno.EPIPE:
+                            log.warn(
+                                "Failed to write replication stream: %s", e
+                            )
+                        self.buffer.abort()
+                        return
+                    view = view[written:]
+                    self.bytes += written
+                if self.limit:
+                    ahead = (
+                        float(self.bytes) / (self.limit * 1024) -
+                        (time.time() - started)
+                    )
+                    if ahead > 0:
+                        time.sleep(ahead)
+        finally:
+            os.close(fd)
+
+    def start(self, stdout=None):
+        """
+        Spawn the pipeline
+
+        Arguments:
+            stdout - where the receiving side output (and errors) go,
+                     a file object or None to collect it in self.output
+        """
+        self.started = time.time()
+        self.output = None
+        self.sender = subprocess.Popen(
+            self.send, stdout=subprocess.PIPE, close_fds=True,
+        )
+        source = self.sender.stdout
+        if self.compress:
+            self.compressor = subprocess.Popen(
+                self.compress,
+                stdin=source,
+                stdout=subprocess.PIPE,
+                close_fds=True,
+            )
+            source.close()
+            source = self.compressor.stdout
+        self.receiver = subprocess.Popen(
+            self.receive,
+            shell=isinstance(self.receive, basestring),
+            stdin=subprocess.PIPE,
+            stdout=stdout or subprocess.PIPE,
+            stderr=subprocess.STDOUT,
+            close_fds=True,
+        )
+        # The threads own the descriptors from now on, other processes
+        # spawned meanwhile must not hold them or the stream never ends
+        readfd = _cloexec(os.dup(source.fileno()))
+        source.close()
+        writefd = _cloexec(os.dup(self.receiver.stdin.fileno()))
+        self.receiver.stdin.close()
+        self._threads = [
+            threading.Thread(target=self._reader, args=(readfd, )),
+            threading.Thread(target=self._writer, args=(writefd, )),
+        ]
+        for thread in self._threads:
+            thread.daemon = True
+            thread.start()
+        if stdout is None:
+            self._collector = threading.Thread(target=self._collect)
+            self._collector.daemon = True
+            self._collector.start()
+        else:
+            self._collector = None
+
+    def _collect(self):
+        self.output = self.receiver.stdout.read()
+
+    def wait(self):
+        """
+        Wait for the whole pipeline to finish
+
+        Returns:
+            the receiving side exit status, or the first failure of the
+            sending side if it did not send the complete stream
+        """
+        for thread in self._threads:
+            thread.join()
+        if self._collector is not None:
+            self._collector.join()
+        self.receiver.wait()
+        if self.compressor is not None:
+            self.compressor.wait()
+        self.sender.wait()
+        self.elapsed = time.time() - self.started
+        self.returncode = self.receiver.returncode
+        if self.returncode == 0:
+            for proc in (self.sender, self.compressor):
+                if proc is not None and proc.returncode:
+                    self.returncode = proc.returncode
+                    break
+        return self.returncode
+
+    def run(self, stdout=None):
+        self.start(stdout=stdout)
+        return self.wait()
@@ -25,578 +25,460 @@
 #
 # $FreeBSD$
 #####################################################################
-import string
+"""
+IPv4/IPv6 address and network arithmetic
+
+This used to run the sipcalc command for every address, and every
+arithmetic operation on one (addr += 1 while looking for a free address
+forked once per candidate). Addresses are now plain integers and a
+prefix length, the attributes sipcalc printed are computed on access
+and the string forms are the ones sipcalc printed.
+"""
+import re
+import socket
+import struct
 
 from freenasUI.common.pipesubr import pipeopen
 
-SIPCALC_PATH = "/usr/local/bin/sipcalc"
+_IPV4_RE = re.compile(r'^(\d{1,3})\.(\d{1,3})\.(\d{1,3})\.(\d{1,3})$')
+_INET_RE = re.compile(r'^\s*inet (\S+) netmask (0x[0-9a-fA-F]+)')
+_INET6_RE = re.compile(r'^\s*inet6 ([0-9a-fA-F:]+) prefixlen (\d+)(.*)$')
+
+
+def _parse_ipv4(addr):
+    m = _IPV4_RE.match(addr)
+    if m is None:
+        return None
+    num = 0
+    for octet in m.groups():
+        octet = int(octet)
+        if octet > 255:
+            return None
+        num = (num << 8) | octet
+    return num
+
+
+def _parse_ipv6(addr):
+    addr = addr.split('%', 1)[0]
+    if ':' not in addr:
+        return None
+    try:
+        hi, lo = struct.unpack('!QQ', socket.inet_pton(socket.AF_INET6, addr))
+    except (socket.error, ValueError):
+        return None
+    return (hi << 64) | lo
+
+
+def _netmask(bits, width):
+    return ((1 << bits) - 1) << (width - bits)
+
+
+def _prefix_length(mask, width):
+    """
+    Prefix length of a mask given as bits, or for IPv4 as a dotted quad
+    or in hex like ifconfig prints it
+    """
+    if mask is None:
+        return width
+    mask = str(mask).strip()
+    if mask.isdigit():
+        bits = int(mask)
+        if bits > width:
+            return None
+        return bits
+    if width != 32:
+        return None
+    if mask.lower().startswith('0x'):
+        try:
+            num = int(mask, 16)
+        except ValueError:
+            return None
+    else:
+        num = _parse_ipv4(mask)
+        if num is None:
+            return None
+    bits = bin(num).count('1')
+    if num != _netmask(bits, width):
+        return None
+    return bits
+
+
+def _iface_address(iface):
+    """
+    First address of an interface as "address/bits", IPv4 before IPv6
+    (link local IPv6 addresses are skipped) like sipcalc picked them
+    """
+    p = pipeopen("/sbin/ifconfig '%s'" % iface, important=False)
+    out = p.communicate()[0]
+    if p.returncode != 0 or not out:
+        return None
+
+    ipv6 = None
+    for line in out.splitlines():
+        m = _INET_RE.match(line)
+        if m:
+            return "%s/%d" % (
+                m.group(1), _prefix_length(m.group(2), 32)
+            )
+        m = _INET6_RE.match(line)
+        if m and ipv6 is None and 'scopeid' not in m.group(3):
+            ipv6 = "%s/%s" % (m.group(1), m.group(2))
+    return ipv6
+
+
+def _parse(args, kwargs):
+    """
+    Take the sipcalc command line arguments apart
+
+    Returns:
+        tuple of the address class, the address and the prefix length,
+        None if it is not an address
+    """
+    if len(args) == 1 and isinstance(args[0], sipcalc_base_type):
+        return args[0].__class__, args[0].num, args[0].bits
+
+    words = [str(arg) for arg in args]
+    if kwargs.get('network'):
+        words.append(str(kwargs['network']))
+    if kwargs.get('iface'):
+        address = _iface_address(kwargs['iface'])
+        if address is None:
+            return None
+        words.append(address)
+    if not words or len(words) > 2:
+        return None
+
+    addr = words[0].strip()
+    mask = words[1] if len(words) == 2 else None
+    if '/' in addr:
+        if mask is not None:
+            return None
+        addr, mask = addr.split('/', 1)
+
+    for cls, parse in (
+        (sipcalc_ipv4_type, _parse_ipv4),
+        (sipcalc_ipv6_type, _parse_ipv6),
+    ):
+        num = parse(addr)
+        if num is not None:
+            bits = _prefix_length(mask, cls.width)
+            if bits is None:
+                return None
+            return cls, num, bits
+    return None
+
+
+def _number(other):
+    if isinstance(other, sipcalc_base_type):
+        return other.num
+    return other
+
+
+def _arith(op, reverse=False):
+    def method(self, other):
+        other = _number(other)
+        if reverse:
+            return self._new(op(other, self.num))
+        return self._new(op(self.num, other))
+    return method
 
 
 class sipcalc_base_type(object):
-    def __init__(self, *args, **kwargs):
-        self.sipcalc = SIPCALC_PATH
-        self.args = args
-        self.iface = None
-
-        self.sipcalc_args = [self.sipcalc]
-        for arg in args:
-            self.sipcalc_args.append(str(arg))
-
-        network = kwargs.get('network', None)
-        if network:
-            self.sipcalc_args.append(str(network))
-
-        iface = kwargs.get('iface', None)
-        if iface:
-            self.sipcalc_args.append(str(iface))
-            self.iface = iface
-
-        p1 = pipeopen(
-            string.join(self.sipcalc_args, ' '),
-            allowfork=True,
-            important=False,
-        )
-        self.sipcalc_out = p1.communicate()
-        if self.sipcalc_out:
-            self.sipcalc_out = self.sipcalc_out[0]
-            if self.sipcalc_out:
-                self.sipcalc_out = self.sipcalc_out.split('\n')
-
-    def is_ipv4(self):
-        res = False
-        if self.sipcalc_out[0].startswith("-[ipv4") or (
-            self.iface != None and self.sipcalc_out[0].startswith("-[int-ipv4")):
-            res = True
-        return res
-
-    def is_ipv6(self):
-        res = False
-        if self.sipcalc_out[0].startswith("-[ipv6") or (
-            self.iface != None and self.sipcalc_out[0].startswith("-[int-ipv6")):
-            res = True
-        return res
-
-    def __str__(self):
-        self_str = None 
-        if self.is_ipv4():
-            self_str = "%s/%d" % (self.host_address, self.network_mask_bits)
-        elif self.is_ipv6():
-            self_str = "%s/%d" % (self.expanded_address, self.prefix_length)
-        return self_str
-
-    def __int__(self):
-        return self.to_decimal()
-
-    def __lt__(self, other):
-        return self.to_decimal() < other
-
-    def __le__(self, other):
-        return self.to_decimal() <= other
-
-    def __eq__(self, other):
-        return self.to_decimal() == other
-
-    def __ne__(self, other):
-        return self.to_decimal() != other
-
-    def __gt__(self, other):
-        return self.to_decimal() > other
-
-    def __ge__(self, other):
-        return self.to_decimal() >= other
-
-    def __add__(self, other):
-        num = self.to_decimal() + other
-        addr = self.to_ip(num) 
-        return sipcalc_type(addr)
-
-    def __sub__(self, other):
-        num = self.to_decimal() - other
-        addr = self.to_ip(num) 
-        return sipcalc_type(addr)
-
-    def __mul__(self, other):
-        num = self.to_decimal() * other
-        addr = self.to_ip(num) 
-        return sipcalc_type(addr)
-
-    def __floordiv__(self, other):
-        num = self.to_decimal() // other
-        addr = self.to_ip(num) 
-        return sipcalc_type(addr)
-
-    def __mod__(self, other):
-        num = self.to_decimal() % other
-        addr = self.to_ip(num) 
-        return sipcalc_type(addr)
-
-    def __divmod__(self, other):
-        num = (self.to_decimal()// other, \
-            self.to_decimal() % other)
-        addr = self.to_ip(num) 
-        return sipcalc_type(addr)
+    """
+    An address and the network it is on
 
-    def __pow__(self, other):
-        num = self.to_decimal() ** other
-        addr = self.to_ip(num) 
-        return sipcalc_type(addr)
+    Takes what the sipcalc command line did: "address/bits", an address
+    and a netmask (bits, dotted quad or hex), or iface= for the address
+    of an interface. Arithmetic gives an address on the same network,
+    comparisons are by address.
+    """
+    __slots__ = ('num', 'bits', 'iface')
 
-    def __lshift__(self, other):
-        num = self.to_decimal() << other
-        addr = self.to_ip(num) 
-        return sipcalc_type(addr)
-
-    def __rshift__(self, other):
-        num = self.to_decimal() >> other
-        addr = self.to_ip(num) 
-        return sipcalc_type(addr)
+    width = None
 
-    def __and__(self, other):
-        num = self.to_decimal() & other
-        addr = self.to_ip(num) 
-        return sipcalc_type(addr)
-
-    def __xor__(self, other):
-        num = self.to_decimal() ^ other
-        addr = self.to_ip(num) 
-        return sipcalc_type(addr)
-
-    def __or__(self, other):
-        num = self.to_decimal() | other
-        addr = self.to_ip(num) 
-        return sipcalc_type(addr)
-
-    def __div__(self, other):
-        return self.to_decimal() / other
-
-    def __truediv__(self, other):
-        return self.to_decimal() / other
-
-    def __radd__(self, other):
-        num = self.to_decimal() + other
-        addr = self.to_ip(num) 
-        return sipcalc_type(addr)
-
-    def __rsub__(self, other):
-        num = self.to_decimal() - other
-        addr = self.to_ip(num) 
-        return sipcalc_type(addr)
-
-    def __rmul__(self, other):
-        num = self.to_decimal() * other
-        addr = self.to_ip(num) 
-        return sipcalc_type(addr)
-
-    def __rdiv__(self, other):
-        num = self.to_decimal() / other
-        addr = self.to_ip(num) 
-        return sipcalc_type(addr)
-
-    def __rtruediv__(self, other):
-        num = self.to_decimal() // other
-        addr = self.to_ip(num) 
-        return sipcalc_type(addr)
-
-    def __rfloordiv__(self, other):
-        num = self.to_decimal() // other
-        addr = self.to_ip(num) 
-        return sipcalc_type(addr)
-
-    def __rmod__(self, other):
-        num = self.to_decimal() % other
-        addr = self.to_ip(num) 
-        return sipcalc_type(addr)
-
-    def __rdivmod__(self, other):
-        num = (self.to_decimal() // other, \
-            self.to_decimal() % other)
-        addr = self.to_ip(num) 
-        return sipcalc_type(addr)
-
-    def __rpow__(self, other):
-        num = self.to_decimal() ** other
-        addr = self.to_ip(num) 
-        return sipcalc_type(addr)
-
-    def __rlshift__(self, other):
-        num = self.to_decimal() << other
-        addr = self.to_ip(num) 
-        return sipcalc_type(addr)
-
-    def __rrshift__(self, other):
-        num = self.to_decimal() << other
-        addr = self.to_ip(num) 
-        return sipcalc_type(addr)
-
-    def __rand__(self, other):
-        num = self.to_decimal() & other
-        addr = self.to_ip(num) 
-        return sipcalc_type(addr)
-
-    def __rxor__(self, other):
-        num = self.to_decimal() ^ other
-        addr = self.to_ip(num) 
-        return sipcalc_type(addr)
-
-    def __ror__(self, other):
-        num = self.to_decimal() | other
-        addr = self.to_ip(num) 
-        return sipcalc_type(addr)
-
-    def __iadd__(self, other):
-        num = self.to_decimal() + other
-        addr = self.to_ip(num) 
-        return sipcalc_type(addr)
-
-    def __isub__(self, other):
-        num = self.to_decimal() - other
-        addr = self.to_ip(num) 
-        return sipcalc_type(addr)
-
-    def __imul__(self, other):
-        num = self.to_decimal() * other
-        addr = self.to_ip(num) 
-        return sipcalc_type(addr)
-
-    def __idiv__(self, other):
-        num = self.to_decimal() / other
-        addr = self.to_ip(num) 
-        return sipcalc_type(addr)
-
-    def __itruediv__(self, other):
-        num = self.to_decimal() // other
-        addr = self.to_ip(num) 
-        return sipcalc_type(addr)
-
-    def __ifloordiv__(self, other):
-        num = self.to_decimal() // other
-        addr = self.to_ip(num) 
-        return sipcalc_type(addr)
-
-    def __imod__(self, other):
-        num = self.to_decimal() % other
-        addr = self.to_ip(num) 
-        return sipcalc_type(addr)
-
-    def __invert__(self): 
-        num = ~self.to_decimal()
-        addr = self.to_ip(num) 
-        return sipcalc_type(addr)
-
-    def __ipow__(self, other):
-        num = self.to_decimal() ** other
-        addr = self.to_ip(num) 
-        return sipcalc_type(addr)
-
-    def __ilshift__(self, other):
-        num = self.to_decimal() << other
-        addr = self.to_ip(num) 
-        return sipcalc_type(addr)
-
-    def __irshift__(self, other):
-        num = self.to_decimal() >> other
-        addr = self.to_ip(num) 
-        return sipcalc_type(addr)
-
-    def __iand__(self, other):
-        num = self.to_decimal() & other
-        addr = self.to_ip(num) 
-        return sipcalc_type(addr)
-
-    def __ixor__(self, other):
-        num = self.to_decimal() ^ other
-        addr = self.to_ip(num) 
-        return sipcalc_type(addr)
-
-    def __ior__(self, other):
-        num = self.to_decimal() | other
-        addr = self.to_ip(num) 
-        return sipcalc_type(addr)
-
-class sipcalc_ipv4_type(sipcalc_base_type):
     def __init__(self, *args, **kwargs):
-        super(sipcalc_ipv4_type, self).__init__(*args, **kwargs)
-
-        for line in self.sipcalc_out:
-            parts = line.split("-") 
-
-            i = 0
-            plen = len(parts)
-            while i < plen:
-                parts[i] = parts[i].strip()
-                i += 1
-
-            if parts[0] == "Host address":
-                self.host_address = parts[1]
-
-            elif parts[0] == "Host address (decimal)":
-                self.host_address_dec = int(parts[1])
-
-            elif parts[0] == "Host address (hex)":
-                self.host_address_hex = parts[1]
-
-            elif parts[0] == "Network address":
-                self.network_address  = parts[1]
+        parsed = _parse(args, kwargs)
+        if parsed is None or parsed[0] is not self.__class__:
+            raise ValueError("Invalid address: %s" % (
+                ' '.join(str(arg) for arg in args),
+            ))
+        self.num, self.bits = parsed[1:]
+        self.iface = kwargs.get('iface', None)
+
+    @classmethod
+    def from_int(cls, num, bits=None, iface=None):
+        obj = object.__new__(cls)
+        obj.num = num
+        obj.bits = cls.width if bits is None else bits
+        obj.iface = iface
+        return obj
 
-            elif parts[0] == "Network mask":
-                self.network_mask = parts[1]
+    def _new(self, num):
+        if not 0 <= num < 1 << self.width:
+            raise ValueError("Address out of range: %r" % num)
+        return self.from_int(num, self.bits)
 
-            elif parts[0] == "Network mask (bits)":
-                self.network_mask_bits = int(parts[1])
+    def _coerce(self, addr):
+        if isinstance(addr, sipcalc_base_type):
+            return addr
+        if isinstance(addr, (int, long)):
+            return self.from_int(addr, self.bits)
+        return sipcalc_type(addr)
 
-            elif parts[0] == "Network mask (hex)":
-                self.network_mask_hex = parts[1]
+    def _format(self, num):
+        raise NotImplementedError
 
-            elif parts[0] == "Broadcast address":
-                self.broadcast_address = parts[1]
+    @property
+    def _mask(self):
+        return _netmask(self.bits, self.width)
 
-            elif parts[0] == "Cisco wildcard":
-                self.cisco_wildcard = parts[1]
+    @property
+    def _first(self):
+        return self.num & self._mask
 
-            elif parts[0] == "Addresses in network":
-                self.network_addresses = int(parts[1])
+    @property
+    def _last(self):
+        return self._first | (_netmask(self.width, self.width) ^ self._mask)
 
-            elif parts[0] == "Network range":
-                self.network_range = parts[1:]
+    def is_ipv4(self):
+        return False
 
-            elif parts[0] == "Usable range":
-                self.usable_range = parts[1:]
+    def is_ipv6(self):
+        return False
 
     def to_decimal(self, addr=None):
         if addr is not None:
-            num = sipcalc_type(addr).host_address_dec
-        else:
-            num = self.host_address_dec
-
-        return num
+            return self._coerce(addr).num
+        return self.num
 
     def to_ip(self, num=None):
         if num is None:
-            num = self.host_address_dec
-
-        oct1 = (num >> 24) & 0xff
-        oct2 = (num >> 16) & 0xff
-        oct3 = (num >> 8) & 0xff
-        oct4 = (num >> 0) & 0xff
-
-        addr = "%d.%d.%d.%d/%d" % (oct1, oct2, oct3, oct4, self.network_mask_bits)
-        return addr
+            num = self.num
+        return "%s/%d" % (self._format(num), self.bits)
 
     def in_network(self, addr):
-        res = False
-
-        st_addr = sipcalc_type(addr).host_address_dec
-        st_start = sipcalc_type("%s/%d" % (self.network_range[0],
-            self.network_mask_bits)).host_address_dec
-        st_end = sipcalc_type("%s/%d" % (self.network_range[1],
-            self.network_mask_bits)).host_address_dec
-
-        if st_addr >= st_start and st_addr <= st_end:
-            res = True 
-
-        return res
+        addr = self._coerce(addr)
+        if addr is None or addr.width != self.width:
+            return False
+        return addr.num & self._mask == self._first
 
     def get_next_addr(self, addr=None):
-        naddr = ""
+        return self._format(self.to_decimal(addr) + 1)
 
-        if addr is not None:
-            addr = sipcalc_type(addr).host_address_dec
-        else:
-            addr = self.host_address_dec
+    def __str__(self):
+        return self.to_ip()
 
-        addr += 1
+    def __repr__(self):
+        return "<%s: %s>" % (self.__class__.__name__, self)
 
-        oct1 = (addr >> 24) & 0xff
-        oct2 = (addr >> 16) & 0xff
-        oct3 = (addr >> 8) & 0xff
-        oct4 = (addr >> 0) & 0xff
+    def __int__(self):
+        return self.num
 
-        naddr = "%d.%d.%d.%d" % (oct1, oct2, oct3, oct4)
-        return naddr
+    def __long__(self):
+        return long(self.num)
 
-class sipcalc_ipv6_type(sipcalc_base_type):
-    def __init__(self, *args, **kwargs):
-        super(sipcalc_ipv6_type, self).__init__(*args, **kwargs)
+    def __hash__(self):
+        return hash(self.num)
 
-        network_range = 0
-        for line in self.sipcalc_out:
-            parts = line.split("-") 
+    def __lt__(self, other):
+        return self.num < _number(other)
 
-            i = 0
-            plen = len(parts)
-            while i < plen:
-                parts[i] = parts[i].strip()
-                i += 1
+    def __le__(self, other):
+        return self.num <= _number(other)
 
-            if parts[0] == "Expanded Address":
-                self.expanded_address = parts[1]
+    def __eq__(self, other):
+        return self.num == _number(other)
 
-            elif parts[0] == "Compressed address":
-                self.compressed_address = parts[1]
+    def __ne__(self, other):
+        return self.num != _number(other)
 
-            elif parts[0] == "Subnet prefix (masked)":
-                self.subnet_prefix_masked = parts[1]
+    def __gt__(self, other):
+        return self.num > _number(other)
 
-            elif parts[0] == "Address ID (masked)":
-                self.address_id_masked = parts[1]
+    def __ge__(self, other):
+        return self.num >= _number(other)
+
+    __add__ = __iadd__ = _arith(lambda a, b: a + b)
+    __sub__ = __isub__ = _arith(lambda a, b: a - b)
+    __mul__ = __imul__ = _arith(lambda a, b: a * b)
+    __floordiv__ = __ifloordiv__ = _arith(lambda a, b: a // b)
+    __mod__ = __imod__ = _arith(lambda a, b: a % b)
+    __pow__ = __ipow__ = _arith(lambda a, b: a ** b)
+    __lshift__ = __ilshift__ = _arith(lambda a, b: a << b)
+    __rshift__ = __irshift__ = _arith(lambda a, b: a >> b)
+    __and__ = __iand__ = _arith(lambda a, b: a & b)
+    __xor__ = __ixor__ = _arith(lambda a, b: a ^ b)
+    __or__ = __ior__ = _arith(lambda a, b: a | b)
+
+    __radd__ = _arith(lambda a, b: a + b, reverse=True)
+    __rsub__ = _arith(lambda a, b: a - b, reverse=True)
+    __rmul__ = _arith(lambda a, b: a * b, reverse=True)
+    __rfloordiv__ = _arith(lambda a, b: a // b, reverse=True)
+    __rmod__ = _arith(lambda a, b: a % b, reverse=True)
+    __rpow__ = _arith(lambda a, b: a ** b, reverse=True)
+    __rlshift__ = _arith(lambda a, b: a << b, reverse=True)
+    __rrshift__ = _arith(lambda a, b: a >> b, reverse=True)
+    __rand__ = _arith(lambda a, b: a & b, reverse=True)
+    __rxor__ = _arith(lambda a, b: a ^ b, reverse=True)
+    __ror__ = _arith(lambda a, b: a | b, reverse=True)
+
+    def __invert__(self):
+        return self._new(~self.num & _netmask(self.width, self.width))
 
-            elif parts[0] == "Prefix address":
-                self.prefix_address = parts[1]
+    def __div__(self, other):
+        return self.num / _number(other)
 
-            elif parts[0] == "Prefix length":
-                self.prefix_length = int(parts[1])
+    def __truediv__(self, other):
+        return float(self.num) / _number(other)
 
-            elif parts[0] == "Address type":
-                self.address_type = parts[1]
+    def __divmod__(self, other):
+        return divmod(self.num, _number(other))
 
-            elif parts[0] == "Network range":
-                self.network_range = [None, None]
-                self.network_range[0] = parts[1]
-                network_range = 1
 
-            elif network_range == 1:
-                network_range = 0
-                self.network_range[1] = parts[0]
+class sipcalc_ipv4_type(sipcalc_base_type):
+    __slots__ = ()
 
-    def to_binary(self, addr=None):
-        numbers = { '0': 0, '1': 1, '2': 2, '3': 3, '4': 4,
-            '5': 5, '6': 6, '7': 7, '8': 8, '9': 9, 'a': 10,
-            'b': 11, 'c': 12, 'd': 13, 'e': 14, 'f': 15 }
-   
-        if addr is not None:
-            addr = sipcalc_type(addr).expanded_address
-        else:
-            addr = self.expanded_address
-
-        bnum = ""
-        octets = addr.split(':')
-        for oct in octets:
-
-            # hex to decimal
-            dnum = 0
-            for b in oct:
-                b = b.lower()
-                dnum *= 16
-                dnum += numbers[b]
-
-            # decimal to binary
-            tbnum = ""
-            while True:
-                if dnum & 1:
-                    tbnum = "1%s" % tbnum
-                else:
-                    tbnum = "0%s" % tbnum
-
-                dnum /= 2
-                if dnum < 1:
-                    break
-
-            tbnum = tbnum.zfill(16)
-            bnum = "%s%s" % (bnum, tbnum)
-
-        return bnum
+    width = 32
 
-    def to_decimal(self, addr=None):
-        numbers = { '0': 0, '1': 1, '2': 2, '3': 3, '4': 4,
-            '5': 5, '6': 6, '7': 7, '8': 8, '9': 9, 'a': 10,
-            'b': 11, 'c': 12, 'd': 13, 'e': 14, 'f': 15 }
-        if addr is not None:
-            addr = sipcalc_type(addr).expanded_address
-        else:
-            addr = self.expanded_address
+    def _format(self, num):
+        return "%d.%d.%d.%d" % (
+            (num >> 24) & 0xff,
+            (num >> 16) & 0xff,
+            (num >> 8) & 0xff,
+            num & 0xff,
+        )
 
-        si = 128
-        num = 0
-        octets = addr.split(':')
-        for oct in octets:
-            si -= 16
+    def is_ipv4(self):
+        return True
 
-            # hex to decimal
-            dnum = 0
-            for b in oct:
-                b = b.lower()
-                dnum *= 16
-                dnum += numbers[b]
+    @property
+    def host_address(self):
+        return self._format(self.num)
 
-            num += dnum << si
+    @property
+    def host_address_dec(self):
+        return self.num
 
-        return num
+    @property
+    def host_address_hex(self):
+        return "%08X" % self.num
 
-    def to_ip(self, num=None):
-        if num is None:
-           num = self.to_decimal()
-
-        addr = "" 
-        haddr = hex(num)
-        parts1 = haddr.split('x')
-        if len(parts1) > 1:
-            parts2 = parts1[1].split('L') 
-            hstr = parts2[0]
-
-            i = 0
-            hlen = len(hstr) 
-            while i < hlen:
-                addr += hstr[i]
-                if (i + 1) % 4 == 0 and (i + 1) < hlen:
-                    addr += ':'
-                i += 1 
-
-        addr = "%s/%d" % (addr, self.prefix_length)
-        return addr
-   
-    def in_network(self, addr):
-        res = False
+    @property
+    def network_address(self):
+        return self._format(self._first)
 
-        st_addr = sipcalc_type(addr)
-        st_start = sipcalc_type(self.network_range[0])
+    @property
+    def network_mask(self):
+        return self._format(self._mask)
 
-        st_baddr = self.to_binary(st_addr.expanded_address)
-        st_bstart = self.to_binary(st_start.expanded_address)
+    @property
+    def network_mask_bits(self):
+        return self.bits
 
-        if st_baddr[0:self.prefix_length] == st_bstart[0:self.prefix_length]:
-            res = True
+    @property
+    def network_mask_hex(self):
+        return "%08X" % self._mask
 
-        return res
+    @property
+    def broadcast_address(self):
+        return self._format(self._last)
 
-    def get_next_addr(self, addr=None):
-        naddr = ""
+    @property
+    def cisco_wildcard(self):
+        return self._format(self._mask ^ 0xffffffff)
 
-        if addr is not None:
-            addr = sipcalc_type(addr).expanded_address
-        else:
-            addr = self.expanded_address
+    @property
+    def network_addresses(self):
+        return 1 << (self.width - self.bits)
 
-        daddr = self.to_decimal(addr)
-        daddr += 1
+    @property
+    def network_range(self):
+        return [self._format(self._first), self._format(self._last)]
 
-        haddr = hex(daddr)
-        parts1 = haddr.split('x')
-        if len(parts1) > 1:
-            parts2 = parts1[1].split('L') 
-            hstr = parts2[0]
+    @property
+    def usable_range(self):
+        # Point to point and host networks have no network and
+        # broadcast address to leave out
+        if self.bits >= 31:
+            return self.network_range
+        return [self._format(self._first + 1), self._format(self._last - 1)]
 
-            i = 0
-            hlen = len(hstr) 
-            while i < hlen:
-                naddr += hstr[i]
-                if (i + 1) % 4 == 0 and (i + 1) < hlen:
-                    naddr += ':'
-                i += 1 
 
-        if not naddr:
-            naddr = None
+class sipcalc_ipv6_type(sipcalc_base_type):
+    __slots__ = ()
 
-        return naddr
+    width = 128
 
-class sipcalc_type(sipcalc_base_type):
-    def __new__(cls, *args, **kwargs):    
-        obj = None
-        sbt = sipcalc_base_type(*args, **kwargs) 
+    def _format(self, num):
+        return ':'.join(
+            "%04x" % ((num >> shift) & 0xffff)
+            for shift in xrange(112, -1, -16)
+        )
 
-        if sbt.is_ipv4():
-            obj = sipcalc_ipv4_type(*args, **kwargs)
+    def is_ipv6(self):
+        return True
 
-        elif sbt.is_ipv6():
-            obj = sipcalc_ipv6_type(*args, **kwargs)
+    def to_binary(self, addr=None):
+        return bin(self.to_decimal(addr))[2:].zfill(self.width)
+
+    @property
+    def expanded_address(self):
+        return self._format(self.num)
+
+    @property
+    def compressed_address(self):
+        return socket.inet_ntop(socket.AF_INET6, struct.pack(
+            '!QQ', self.num >> 64, self.num & 0xffffffffffffffff
+        ))
+
+    @property
+    def subnet_prefix_masked(self):
+        return "%s/%d" % (self._format(self._first), self.bits)
+
+    @property
+    def address_id_masked(self):
+        return "%s/%d" % (self._format(self.num & ~self._mask), self.bits)
+
+    @property
+    def prefix_address(self):
+        return self._format(self._mask)
+
+    @property
+    def prefix_length(self):
+        return self.bits
+
+    @property
+    def address_type(self):
+        for prefix, bits, name in (
+            (0x0, 128, "Unspecified"),
+            (0x1, 128, "Loopback"),
+            (0xfe80, 10, "Link-Local Unicast Addresses"),
+            (0xfec0, 10, "Site-Local Unicast Addresses"),
+            (0xfc00, 7, "Unique Local Unicast Addresses"),
+            (0xff00, 8, "Multicast Addresses"),
+            (0x2000, 3, "Aggregatable Global Unicast Addresses"),
+        ):
+            if bits < 128:
+                prefix <<= 112
+            if self.num & _netmask(bits, 128) == prefix:
+                return name
+        return "Reserved"
+
+    @property
+    def network_range(self):
+        return [self._format(self._first), self._format(self._last)]
 
-        return obj
+
+class sipcalc_type(sipcalc_base_type):
+    """
+    sipcalc_ipv4_type or sipcalc_ipv6_type for the arguments, None if
+    they are not an address
+    """
+    __slots__ = ()
+
+    def __new__(cls, *args, **kwargs):
+        parsed = _parse(args, kwargs)
+        if parsed is None:
+            return None
+        addr_cls, num, bits = parsed
+        return addr_cls.from_int(num, bits, kwargs.get('iface', None))
@@ -25,9 +25,13 @@
 #
 # $FreeBSD$
 #####################################################################
+import glob
 import logging
 import os
 import string
+import tempfile
+import threading
+import time
 
 log = logging.getLogger('common.warden')
 
@@ -37,6 +41,13 @@ log = logging.getLogger('common.warden')
 WARDEN = "/usr/local/bin/warden"
 WARDENCONF = "/usr/local/etc/warden.conf"
 
+# Touched whenever a jail is changed through Warden, see WardenRegistry
+WARDEN_STAMP = "/var/tmp/.warden"
+# Jails can be started and stopped outside the GUI without anything
+# under the jail root changing, `warden list` is run again after that
+# many seconds regardless
+WARDEN_LIST_TTL = 15
+
 from freenasUI.common.cmd import cmd_arg, cmd_pipe
 from freenasUI.common.jail import JEXEC_PATH
 from freenasUI.common.pipesubr import pipeopen
@@ -1030,7 +1041,11 @@ class Warden(warden_base):
 
     def __call(self, obj):
         if obj is not None:
-            tmp = obj.run()
+            try:
+                tmp = obj.run()
+            finally:
+                if isinstance(obj, WARDEN_MUTATIONS):
+                    registry.invalidate()
             if tmp is not None and len(tmp) > 1:
                 if hasattr(obj, "parse"):
                     return obj.parse(tmp)
@@ -1069,6 +1084,8 @@ class Warden(warden_base):
         return self.__call(warden_get(flags, **kwargs))
 
     def list(self, flags=WARDEN_FLAGS_NONE, **kwargs):
+        if flags == WARDEN_FLAGS_NONE and not kwargs:
+            return registry.list()
         return self.__call(warden_list(flags, **kwargs))
 
     def pkgs(self, flags=WARDEN_FLAGS_NONE, **kwargs):
@@ -1132,6 +1149,102 @@ class Warden(warden_base):
         return jail_objects  
 
 
+# Commands changing what `warden list` shows
+WARDEN_MUTATIONS = (
+    warden_auto,
+    warden_create,
+    warden_delete,
+    warden_import,
+    warden_set,
+    warden_start,
+    warden_stop,
+)
+
+
+class WardenRegistry(object):
+    """
+    Parsed `warden list` output, kept until a jail changes
+
+    `warden list` is a shell script going through every jail directory
+    and every jail queryset ran it. The output is kept until a jail is
+    changed through Warden (in any process, see invalidate), something
+    under the jail root is modified or WARDEN_LIST_TTL expires.
+    """
+
+    def __init__(self, ttl=WARDEN_LIST_TTL):
+        self.ttl = ttl
+        self._jails = None
+        self._signature = None
+        self._expires = 0
+        self._lock = threading.Lock()
+
+    def invalidate(self):
+        self._signature = None
+        try:
+            fd, tmp = tempfile.mkstemp(dir=os.path.dirname(WARDEN_STAMP))
+            os.close(fd)
+            os.rename(tmp, WARDEN_STAMP)
+        except OSError, e:
+            log.debug("Failed to update %s: %s", WARDEN_STAMP, e)
+
+    def _get_jdir(self):
+        if not os.path.exists(WARDENCONF):
+            return None
+        with open(WARDENCONF, "r") as wconf:
+            for line in wconf:
+                if line.startswith("JDIR:"):
+                    return line.split(':', 1)[1].strip()
+        return None
+
+    def _get_signature(self):
+        """
+        Modification times of the stamp, the jail root and of every
+        jail meta directory and the files in it
+        """
+        paths = [WARDEN_STAMP]
+        jdir = self._get_jdir()
+        if jdir:
+            paths.append(jdir)
+            for meta in sorted(glob.glob(os.path.join(jdir, ".*.meta"))):
+                paths.append(meta)
+                try:
+                    paths.extend(
+                        os.path.join(meta, f) for f in os.listdir(meta)
+                    )
+                except OSError:
+                    pass
+
+        signature = []
+        for path in paths:
+            try:
+                st = os.stat(path)
+                signature.append((path, st.st_ino, st.st_mtime))
+            except OSError:
+                signature.append((path, None, None))
+        return tuple(signature)
+
+    def list(self):
+        """
+        Same as warden list -v, the dicts are copies callers may modify
+        """
+        with self._lock:
+            signature = self._get_signature()
+            if (
+                self._jails is None or signature != self._signature or
+                time.time() > self._expires
+            ):
+                obj = warden_list()
+                self._jails = obj.parse(obj.run())
+                # Whatever changed while warden list ran shows up as a
+                # different signature next time
+                self._signature = signature
+                self._expires = time.time() + self.ttl
+            return [dict(jail) for jail in self._jails]
+
+
+registry = WardenRegistry()
+
+
 def get_warden_template_abi_arch(template_path):
     abi_arch = None
 
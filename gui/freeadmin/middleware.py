@@ -34,6 +34,7 @@ import cProfile
 
 from django.conf import settings
 from django.contrib.auth.decorators import login_required
+from django.db import connection
 from django.http import HttpResponse
 from django.utils import translation
 from django.utils.cache import patch_vary_headers
@@ -41,6 +42,7 @@ from django.utils.translation import ugettext as _
 import oauth2 as oauth
 
 from freenasUI import settings as mysettings
+from freenasUI.common import perf
 from freenasUI.freeadmin.views import JsonResp
 from freenasUI.middleware.exceptions import MiddlewareError
 from freenasUI.services.exceptions import ServiceFailed
@@ -191,6 +193,49 @@ class CatchError(object):
         return response
 
 
+class PerfMiddleware(object):
+    """
+    Account every request to its view: latency, SQL queries and the
+    processes spawned, see common.perf
+
+    Unlike ProfileMiddleware it is cheap enough to be always on.
+    """
+
+    def process_request(self, request):
+        perf.begin(request.path, request.method)
+        perf.trace_queries(connection)
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        stats = perf.current()
+        if stats is None:
+            return None
+        match = getattr(request, 'resolver_match', None)
+        if match is not None and match.url_name:
+            # API views are all the same tastypie wrapper
+            stats.view = match.url_name
+            if 'resource_name' in view_kwargs:
+                stats.view += ':' + view_kwargs['resource_name']
+        else:
+            stats.view = '%s.%s' % (
+                view_func.__module__,
+                getattr(view_func, '__name__', view_func.__class__.__name__),
+            )
+        return None
+
+    def process_response(self, request, response):
+        stats = perf.end()
+        if stats is None:
+            return response
+        perf.stats.record(
+            stats,
+            sql_queries=stats.sql_queries,
+            sql_time=stats.sql_time,
+            slow=getattr(settings, 'PERF_SLOW_REQUEST', None),
+            sample=getattr(settings, 'PERF_SLOW_SAMPLE', 1.0),
+        )
+        return response
+
+
 class ProfileMiddleware(object):
     """
     Based on
@@ -26,29 +26,43 @@
 #####################################################################
 import json
 import logging
+import os
 import re
+import tempfile
+import threading
+import time
 
 from django.conf import settings
 from django.core.urlresolvers import NoReverseMatch, resolve, reverse
-from django.db import models
+from django.db import connection, models
+from django.db.models.signals import post_delete, post_save
 from django.forms import ModelForm
 from django.utils.translation import ugettext_lazy as _
 
 import eventlet
 from freenasUI.common.log import log_traceback
 from freenasUI.common.warden import (
-    WARDEN_STATUS_RUNNING, WARDEN_TYPE_PLUGINJAIL
+    WARDEN_STAMP, WARDEN_STATUS_RUNNING, WARDEN_TYPE_PLUGINJAIL
 )
 from freenasUI.freeadmin.apppool import appPool
 from freenasUI.freeadmin.tree import (
     tree_roots, TreeRoot, TreeNode, unserialize_tree
 )
-from freenasUI.jails.models import Jails
+from freenasUI.jails.models import Jails, JailMountPoint, JailTemplate
+from freenasUI.middleware.zfs import ZFS_INVENTORY_STAMP
 from freenasUI.plugins.models import Plugins
 from freenasUI.plugins.utils import get_base_url
 
 log = logging.getLogger('freeadmin.navtree')
 
+# Replaced whenever something the menu shows changes, shared by all the
+# processes serving the GUI, see NavTree.invalidate
+NAVTREE_STAMP = '/var/tmp/.navtree'
+# Plugin menus are fetched again in the background after that many seconds
+PLUGIN_MENU_TTL = 60
+# How long the first menu request waits for the plugin menus
+PLUGIN_MENU_WAIT = 2
+
 
 class ModelFormsDict(dict):
 
@@ -88,6 +102,13 @@ class NavTree(object):
         self._modelforms = ModelFormsDict()
         self._navs = {}
         self._generated = False
+        self._signature = None
+        self._dijit = {}
+        self._lock = threading.RLock()
+        self._plugin_menus = []
+        self._plugin_menus_version = 0
+        self._plugin_menus_fetched = None
+        self._plugin_fetcher = None
 
     def isGenerated(self):
         return self._generated
@@ -200,7 +221,73 @@ class NavTree(object):
                             _models[form._meta.model] = form
             self._modelforms.update(_models)
 
+    def invalidate(self):
+        """
+        Have the tree generated again on the next request, in every
+        process serving the GUI
+        """
+        self._signature = None
+        try:
+            fd, tmp = tempfile.mkstemp(dir=os.path.dirname(NAVTREE_STAMP))
+            os.close(fd)
+            os.rename(tmp, NAVTREE_STAMP)
+        except OSError, e:
+            log.debug("Failed to update %s: %s", NAVTREE_STAMP, e)
+
+    def _get_signature(self):
+        """
+        Everything the generated tree depends on besides the database
+        """
+        from freenasUI.freeadmin.site import site
+        stamps = []
+        for path in (NAVTREE_STAMP, WARDEN_STAMP, ZFS_INVENTORY_STAMP):
+            try:
+                st = os.stat(path)
+                stamps.append((st.st_ino, st.st_mtime))
+            except OSError:
+                stamps.append(None)
+        return (
+            stamps[0],
+            # Replaced whenever jails are created, deleted, started or
+            # stopped through Warden, in any process
+            stamps[1],
+            # Datasets and zvols in the Storage menu come from zfs list
+            stamps[2],
+            self._plugin_menus_version,
+            len(site._registry),
+            len(appPool._registered),
+        )
+
     def generate(self, request=None):
+        """
+        Generate the tree unless the one generated before is still
+        current, see _generate
+
+        The tree is kept until invalidate is called (models shown in the
+        menu saved or deleted), jails are changed, datasets or zvols are
+        created or destroyed, a model or app is registered or the plugin
+        menus change.
+
+        Returns:
+            bool - the tree was generated again
+        """
+        with self._lock:
+            if self._plugin_menus_fetched and (
+                self._signature is None or
+                self._get_signature()[:2] != self._signature[:2]
+            ):
+                # Plugin jails may have been started or stopped
+                self._plugin_menus_fetched = 0
+            self._refresh_plugin_menus(request)
+            signature = self._get_signature()
+            if self._generated and signature == self._signature:
+                return False
+            self._generate(request)
+            self._signature = signature
+            self._dijit.clear()
+            return True
+
+    def _generate(self, request=None):
         """
         Tree Menu Auto Generate
 
@@ -313,13 +400,7 @@ class NavTree(object):
 
         self.replace_navs(tree_roots)
 
-        jails = []
-        #FIXME: use .filter
-        for j in Jails.objects.all():
-            if j.jail_type == WARDEN_TYPE_PLUGINJAIL and \
-                j.jail_status == WARDEN_STATUS_RUNNING:
-                jails.append(j)
-        self._get_plugins_nodes(request, jails)
+        self._get_plugins_nodes()
 
     def _generate_app(self, app, request, tree_roots, childs_of):
 
@@ -518,7 +599,7 @@ class NavTree(object):
                     self.register_option(subopt, navopt)
 
     def _plugin_fetch(self, args):
-        plugin, host, request = args
+        plugin, host, sessionid = args
         if re.match('^.+\[.+\]', host, re.I):
             import urllib2
         else:
@@ -528,11 +609,7 @@ class NavTree(object):
         url = "%s/plugins/%s/%d/_s/treemenu" % (host, plugin.plugin_name, plugin.id)
         try:
             opener = urllib2.build_opener()
-            opener.addheaders = [(
-                'Cookie', 'sessionid=%s' % (
-                    request.COOKIES.get("sessionid", ''),
-                )
-            )]
+            opener.addheaders = [('Cookie', 'sessionid=%s' % (sessionid, ))]
             #TODO: Increase timeout based on number of plugins
             response = opener.open(url, None, 5)
             data = response.read()
@@ -545,19 +622,70 @@ class NavTree(object):
             })
         return plugin, url, data
 
-    def _get_plugins_nodes(self, request, jails):
+    def _fetch_plugin_menus(self, host, sessionid):
+        """
+        Fetch the treemenu of every plugin running in a plugin jail
 
-        host = get_base_url(request)
-        args = map(
-            lambda y: (y, host, request),
-            Plugins.objects.filter(plugin_enabled=True, plugin_jail__in=[jail.jail_host for jail in jails]))
+        Runs in a thread of its own which may outlive the request, so it
+        only gets the base url and the session of it.
+        """
+        try:
+            jails = []
+            #FIXME: use .filter
+            for j in Jails.objects.all():
+                if j.jail_type == WARDEN_TYPE_PLUGINJAIL and \
+                    j.jail_status == WARDEN_STATUS_RUNNING:
+                    jails.append(j)
+
+            args = map(
+                lambda y: (y, host, sessionid),
+                Plugins.objects.filter(plugin_enabled=True, plugin_jail__in=[jail.jail_host for jail in jails]))
+
+            menus = []
+            pool = eventlet.GreenPool(20)
+            for plugin, url, data in pool.imap(self._plugin_fetch, args):
+                if data:
+                    menus.append((plugin.plugin_name, url, data))
+
+            # Not under self._lock, generate may be waiting for us
+            if menus != self._plugin_menus:
+                self._plugin_menus = menus
+                self._plugin_menus_version += 1
+        except Exception, e:
+            log.warn("Failed to fetch plugin menus: %s", e)
+        finally:
+            self._plugin_menus_fetched = time.time()
+            # This thread has a database connection of its own
+            connection.close()
 
-        pool = eventlet.GreenPool(20)
-        for plugin, url, data in pool.imap(self._plugin_fetch, args):
+    def _refresh_plugin_menus(self, request):
+        """
+        Fetch the plugin menus in the background once they are older than
+        PLUGIN_MENU_TTL, the tree is generated again if they changed.
+        Only the very first time the request waits for them (a little).
+        """
+        if request is None:
+            return
+        fetched = self._plugin_menus_fetched
+        if fetched is not None and time.time() - fetched < PLUGIN_MENU_TTL:
+            return
+        if self._plugin_fetcher is None or \
+                not self._plugin_fetcher.is_alive():
+            self._plugin_fetcher = threading.Thread(
+                target=self._fetch_plugin_menus,
+                args=(
+                    get_base_url(request),
+                    request.COOKIES.get("sessionid", ''),
+                ),
+            )
+            self._plugin_fetcher.daemon = True
+            self._plugin_fetcher.start()
+        if fetched is None:
+            self._plugin_fetcher.join(PLUGIN_MENU_WAIT)
 
-            if not data:
-                continue
+    def _get_plugins_nodes(self):
 
+        for plugin_name, url, data in self._plugin_menus:
             try:
                 data = json.loads(data)
 
@@ -569,7 +697,7 @@ class NavTree(object):
                     if node.append_to:
                         log.debug(
                             "Plugin %s requested to be appended to %s",
-                            plugin.plugin_name, node.append_to)
+                            plugin_name, node.append_to)
                         places = node.append_to.split('.')
                         places.reverse()
                         for root in tree_roots:
@@ -582,7 +710,7 @@ class NavTree(object):
                         log.debug(
                             "Plugin %s didn't request to be appended "
                             "anywhere specific",
-                            plugin.plugin_name)
+                            plugin_name)
 
                     if not found:
                         tree_roots.register(node)
@@ -690,6 +818,17 @@ class NavTree(object):
         return my
 
     def dijitTree(self, user):
+        """
+        The tree as the menu gets it, the same for every user with the
+        same set of permissions
+        """
+        key = (user.is_superuser, frozenset(user.get_all_permissions()))
+        with self._lock:
+            if key not in self._dijit:
+                self._dijit[key] = self._dijitTree(user)
+            return self._dijit[key]
+
+    def _dijitTree(self, user):
 
         class ByRef(object):
             def __init__(self, val):
@@ -706,3 +845,12 @@ class NavTree(object):
         return items
 
 navtree = NavTree()
+
+
+def _model_changed(sender, **kwargs):
+    if sender in (Jails, JailMountPoint, JailTemplate, Plugins) or \
+            sender in navtree._modelforms:
+        navtree.invalidate()
+
+post_save.connect(_model_changed, dispatch_uid='navtree_post_save')
+post_delete.connect(_model_changed, dispatch_uid='navtree_post_delete')
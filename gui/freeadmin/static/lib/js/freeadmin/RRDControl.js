@@ -2,6 +2,8 @@ define([
     "dojo/_base/declare",
     "dojo/dom-attr",
     "dojo/io-query",
+    "dojo/json",
+    "dojo/request/xhr",
     "dijit/_Widget",
     "dijit/_TemplatedMixin",
     "dijit/form/TextBox",
@@ -10,7 +12,48 @@ define([
     "dijit/layout/ContentPane",
     "dojox/timing",
     "dojo/text!freeadmin/templates/rrdcontrol.html"
-    ], function(declare, domAttr, ioQuery, _Widget, _Templated, TextBox, Button, TabContainer, ContentPane, timing, template) {
+    ], function(declare, domAttr, ioQuery, JSON, xhr, _Widget, _Templated, TextBox, Button, TabContainer, ContentPane, timing, template) {
+
+    // Controls waiting to be loaded by the next batch request, see load
+    var pending = [];
+
+    var flush = function() {
+        var controls = pending, graphs = [];
+        pending = [];
+        for(var i = 0; i < controls.length; i++) {
+            graphs.push({
+                plugin: controls[i].plugin,
+                identifier: controls[i].identifier,
+                unit: controls[i].unit,
+                step: controls[i].step
+            });
+        }
+        xhr.post(controls[0].batch, {
+            data: {graphs: JSON.stringify(graphs)},
+            handleAs: "json",
+            headers: {"X-CSRFToken": CSRFToken}
+        }).then(function(results) {
+            var loaded = [];
+            for(var i = 0; i < results.length; i++) {
+                if(results[i].image) {
+                    loaded[results[i].index] = true;
+                    controls[results[i].index].show(results[i].image);
+                }
+            }
+            // Whatever the batch could not render is asked for alone
+            for(var i = 0; i < controls.length; i++) {
+                if(!loaded[i] && !controls[i]._destroyed) {
+                    controls[i].query();
+                }
+            }
+        }, function(error) {
+            for(var i = 0; i < controls.length; i++) {
+                if(!controls[i]._destroyed) {
+                    controls[i].query();
+                }
+            }
+        });
+    };
 
     var RRDControl = declare("freeadmin.RRDControl", [ _Widget, _Templated ], {
         templateString : template,
@@ -21,6 +64,7 @@ define([
         unit: "hourly",
         plugin: "",
         identifier: "",
+        batch: "",
         postCreate: function() {
 
             var me, zoomIn, zoomOut, left, right, t;
@@ -89,10 +133,10 @@ define([
                     me.query();
                 }
             }, this.leftButton);
-            this.query();
+            this.load();
             this.timer = new timing.Timer(300000);
             this.timer.onTick = function() {
-                me.query();
+                me.load();
             }
             this.timer.start();
 
@@ -132,6 +176,25 @@ define([
             }
             return unit;
         },
+        load: function() {
+            /*
+             * The graphs of a page created or refreshed together are
+             * fetched with a single request to the batch url
+             */
+            if(!this.batch) {
+                this.query();
+                return;
+            }
+            pending.push(this);
+            if(pending.length == 1) {
+                setTimeout(flush, 50);
+            }
+        },
+        show: function(image) {
+            if(!this._destroyed) {
+                domAttr.set(this.imageNode, "src", "data:image/png;base64," + image);
+            }
+        },
         query: function() {
 
             var query = ioQuery.objectToQuery({
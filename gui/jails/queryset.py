@@ -166,7 +166,8 @@ class JailsQuerySet(QuerySet):
     # Minimal filter() implementation....
     #
     def filter(self, *args, **kwargs):
-        for wj in list(self.__wlist):
+        wlist = []
+        for wj in self.__wlist:
 
             found = 0
             count = len(kwargs)
@@ -177,7 +178,11 @@ class JailsQuerySet(QuerySet):
                 if key in wj and str(wj[key]) == str(kwargs[k]):
                     found += 1
 
-            if found != count:
-                self.__wlist_cache.remove(wj)
+            if found == count:
+                wlist.append(wj)
 
-        return self
+        # The list is shared with the clones, filter a copy of it
+        c = self._clone()
+        c.__wlist_cache = wlist
+        c.__wcount_cache = len(wlist)
+        return c
@@ -1,8 +1,10 @@
+import Queue
 import glob
 import logging
 import os
 import platform
 import re
+import threading
 import time
 
 from django.utils.translation import ugettext as _
@@ -25,6 +27,15 @@ log = logging.getLogger('jails.utils')
 JAILS_INDEX = "http://download.freenas.org"
 EXTRACT_TARBALL_STATUS_FILE = "/var/tmp/status"
 
+# Addresses probed at once while looking for a free one, how many pings
+# run side by side and for how long a probe result is good
+PROBE_WINDOW = 32
+PROBE_WORKERS = 16
+PROBE_TTL = 60
+
+_probe_cache = {}
+_probe_lock = threading.Lock()
+
 
 #
 # get_jails_index()
@@ -71,15 +82,16 @@ def ping_host(host, ping6=False):
     timeout = t + tseconds
 
     while t <= timeout:
-        if p.poll() == 0:
+        if p.poll() is not None:
             break
 
-        time.sleep(1)
+        time.sleep(0.1)
         t = time.time()
 
     if p.returncode != 0:
         try:
             p.terminate()
+            p.wait()
         except:
             pass
         return False
@@ -214,52 +226,141 @@ def get_ipv6_exclude_dict():
 
 
 #
-# get_available_ipv4()
+# get_neighbor_addresses()
 #
-# Find an IPv4 address in a given range. If no end address
-# is provided, use the netmask to determine how many addresses
-# to probe. If not netmask is provided, assume /24.
+# Addresses in the ARP (or for IPv6 the NDP) cache, as numbers. Something
+# answered on those lately so there is no point in probing them.
 #
-def get_available_ipv4(ipv4_start, ipv4_end=None, ipv4_exclude_dict=None):
-    available_ipv4 = None
-    addr = ipv4_start
-
-    if not ipv4_end:
-        mask = 0
-        try:
-            mask = int(str(addr).split('/')[1])
-            if not mask:
-                mask = 24
-        except:
-            mask = 24
-
-        naddrs = 2**mask
+def get_neighbor_addresses(ipv6=False):
+    neighbors = set()
 
+    if ipv6:
+        p = pipeopen("/usr/sbin/ndp -an", important=False)
     else:
-        naddrs = int(ipv4_end) - int(ipv4_start)
+        p = pipeopen("/usr/sbin/arp -an", important=False)
+    out = p.communicate()[0]
+    if p.returncode != 0 or not out:
+        return neighbors
+
+    for line in out.splitlines():
+        if ipv6:
+            parts = line.split()
+            if len(parts) < 2 or parts[1] == '(incomplete)':
+                continue
+            addr = parts[0]
+        else:
+            m = re.search(r'\(([0-9.]+)\) at ([0-9a-fA-F:]+) ', line)
+            if not m:
+                continue
+            addr = m.group(1)
+
+        sc = sipcalc_type(addr)
+        if sc:
+            neighbors.add(int(sc))
+
+    return neighbors
+
+
+#
+# probe_hosts()
+#
+# Ping a number of addresses at once. Results are kept for PROBE_TTL
+# seconds, so allocating addresses for a few jails in a row only probes
+# the range once.
+#
+# Returns a dictionary of address number: alive
+#
+def probe_hosts(addrs, ipv6=False):
+    now = time.time()
+    results = {}
+    pending = Queue.Queue()
+
+    with _probe_lock:
+        for key, (alive, expires) in _probe_cache.items():
+            if expires < now:
+                del _probe_cache[key]
+        for addr in addrs:
+            cached = _probe_cache.get((ipv6, int(addr)))
+            if cached is not None:
+                results[int(addr)] = cached[0]
+            else:
+                pending.put(addr)
+    total = pending.qsize()
+
+    def worker():
+        while True:
+            try:
+                addr = pending.get_nowait()
+            except Queue.Empty:
+                return
+            alive = ping_host(str(addr).split('/')[0], ping6=ipv6)
+            with _probe_lock:
+                _probe_cache[(ipv6, int(addr))] = (
+                    alive, time.time() + PROBE_TTL
+                )
+            results[int(addr)] = alive
+
+    threads = []
+    for i in xrange(min(PROBE_WORKERS, total)):
+        thread = threading.Thread(target=worker)
+        thread.daemon = True
+        thread.start()
+        threads.append(thread)
+
+    for thread in threads:
+        thread.join()
+
+    return results
+
+
+#
+# get_available_address()
+#
+# Find the first free address from start to end (the end of the network
+# if no end address is given). Excluded and neighbor addresses are
+# skipped, the others are probed PROBE_WINDOW at a time.
+#
+def get_available_address(start, end=None, exclude_dict=None):
+    if not start:
+        return None
+
+    ipv6 = start.is_ipv6()
+    if end:
+        last = int(end)
+    elif ipv6:
+        last = int(sipcalc_type(start.network_range[1]))
+    else:
+        last = int(sipcalc_type(start.usable_range[1]))
 
-    i = 0
-    while i <= naddrs:
-        if not addr:
-            break
+    exclude = get_neighbor_addresses(ipv6=ipv6)
+    if exclude_dict:
+        exclude.update(int(sc) for sc in exclude_dict.values() if sc)
 
-        if ipv4_exclude_dict and str(addr) in ipv4_exclude_dict:
-            addr += 1
-            i += 1
-            continue
+    num = int(start)
+    while num <= last:
+        window = []
+        while num <= last and len(window) < PROBE_WINDOW:
+            if num not in exclude:
+                window.append(start + (num - int(start)))
+            num += 1
 
-        if ping_host(str(addr).split('/')[0]):
-            addr += 1
-            i += 1
-            continue
+        alive = probe_hosts(window, ipv6=ipv6)
+        for addr in window:
+            if not alive[int(addr)]:
+                return addr
 
-        else:
-            available_ipv4 = addr
-            break
+    return None
 
-        i += 1
 
-    return available_ipv4
+#
+# get_available_ipv4()
+#
+# Find an IPv4 address in a given range. If no end address
+# is provided, use the netmask to determine how many addresses
+# to probe.
+#
+def get_available_ipv4(ipv4_start, ipv4_end=None, ipv4_exclude_dict=None):
+    return get_available_address(ipv4_start, ipv4_end, ipv4_exclude_dict)
 
 
 #
@@ -267,49 +368,10 @@ def get_available_ipv4(ipv4_start, ipv4_end=None, ipv4_exclude_dict=None):
 #
 # Find an IPv6 address in a given range. If no end address
 # is provided, use the prefix to determine how many addresses
-# to probe. If not prefix is provided, assume /64.
+# to probe.
 #
 def get_available_ipv6(ipv6_start, ipv6_end=None, ipv6_exclude_dict=None):
-    available_ipv6 = None
-    addr = ipv6_start
-
-    if not ipv6_end:
-        prefix = 0
-        try:
-            prefix = int(str(addr).split('/')[1])
-            if not prefix:
-                prefix = 64
-
-        except:
-            prefix = 64
-
-        naddrs = 2**prefix
-
-    else:
-        naddrs = int(ipv6_end) - int(ipv6_start)
-
-    i = 0
-    while i <= naddrs:
-        if not addr:
-            break
-
-        if ipv6_exclude_dict and str(addr) in ipv6_exclude_dict:
-            addr += 1
-            i += 1
-            continue
-
-        if ping_host(str(addr).split('/')[0], ping6=True):
-            addr += 1
-            i += 1
-            continue
-
-        else:
-            available_ipv6 = addr
-            break
-
-        i += 1
-
-    return available_ipv6
+    return get_available_address(ipv6_start, ipv6_end, ipv6_exclude_dict)
 
 
 def get_jail_ipv4_network():
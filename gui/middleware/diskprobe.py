@@ -0,0 +1,221 @@
+#+
+# Copyright 2015 iXsystems, Inc.
+# All rights reserved
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted providing that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR ``AS IS'' AND ANY EXPRESS OR
+# IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS
+# OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT,
+# STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING
+# IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+#####################################################################
+
+import Queue
+import cPickle as pickle
+import logging
+import os
+import re
+import subprocess
+import threading
+
+log = logging.getLogger('middleware.diskprobe')
+
+WORKERS = 8
+CACHEFILE = '/tmp/.diskprobe'
+
+DISKINFO = '/usr/sbin/diskinfo'
+SMARTCTL = '/usr/local/sbin/smartctl'
+
+RE_SERIAL = re.compile(r'Serial Number:\s+(?P<serial>.+)', re.I)
+
+
+def disk_fingerprint(topology, devname):
+    """
+    What tells the disk behind ``devname`` apart in a GEOM snapshot
+
+    The provider id changes whenever the disk is detached and attached
+    again, the rest when it is replaced by another one under the same
+    name. None if GEOM does not know the disk.
+    """
+    prov = topology.provider_named('DISK', devname)
+    if prov is None:
+        prov = topology.provider_named('MULTIPATH', devname)
+    if prov is None:
+        return None
+    return (
+        prov.get('id'),
+        prov.findtext('mediasize'),
+        prov.findtext('sectorsize'),
+        prov.findtext('config/ident'),
+        prov.findtext('config/lunid'),
+        prov.findtext('config/descr'),
+    )
+
+
+def diskinfo_command(devname):
+    return [DISKINFO, devname]
+
+
+def smartctl_command(args):
+    return [SMARTCTL, '-i'] + list(args)
+
+
+def parse_diskinfo(output):
+    """
+    Returns:
+        dict with devname and capacity (bytes, as text), None if diskinfo
+        failed
+    """
+    info = (output or '').split('\t')
+    if len(info) > 3:
+        return {
+            'devname': info[0],
+            'capacity': info[2],
+        }
+    return None
+
+
+def parse_serial(output):
+    search = RE_SERIAL.search(output or '')
+    if search:
+        return search.group('serial')
+    return None
+
+
+class DiskProbe(object):
+    """
+    Run probe commands for many disks at once
+
+    Probing is dominated by waiting on the disks (smartctl on a SAS
+    expander takes a good fraction of a second per disk), so the
+    commands run from a bounded pool of threads. Outputs are kept in
+    ``cachefile`` keyed by the kind of probe, the device name and the
+    disk fingerprint (see disk_fingerprint), so a disk is only probed
+    again once GEOM sees a different disk under that name.
+
+    Arguments:
+        workers - commands running at the same time
+        cachefile - where outputs are kept, None for no persistent cache
+    """
+
+    def __init__(self, workers=WORKERS, cachefile=CACHEFILE):
+        self.workers = max(1, workers)
+        self.cachefile = cachefile
+        self.probed = 0
+        self.cached = 0
+
+    def _load(self):
+        if not self.cachefile:
+            return {}
+        try:
+            with open(self.cachefile, 'rb') as f:
+                return pickle.load(f)
+        except Exception:
+            return {}
+
+    def _save(self, cache):
+        if not self.cachefile:
+            return
+        tmp = '%s.%d' % (self.cachefile, os.getpid())
+        try:
+            with open(tmp, 'wb') as f:
+                pickle.dump(cache, f, pickle.HIGHEST_PROTOCOL)
+            os.rename(tmp, self.cachefile)
+        except (IOError, OSError), e:
+            log.debug("Failed to save disk probe cache: %s", e)
+
+    def _run(self, argv):
+        try:
+            proc = subprocess.Popen(
+                argv,
+                stdin=subprocess.PIPE,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE,
+                close_fds=True,
+            )
+            output = proc.communicate()[0]
+        except OSError, e:
+            log.debug("Failed to run %s: %s", argv, e)
+            return None, False
+        # smartctl sets the higher bits of its exit status for SMART
+        # errors while the identity is fine, only the two lowest ones
+        # (bad arguments, device open failed) mean no answer; diskinfo
+        # exits with 1 on failure
+        return output, proc.returncode & 0x3 == 0
+
+    def run(self, jobs):
+        """
+        Arguments:
+            jobs - list of (kind, devname, fingerprint, argv)
+
+        Returns:
+            dict of (kind, devname) to the command output
+        """
+        cache = self._load()
+        results = {}
+        pending = Queue.Queue()
+        for kind, devname, fingerprint, argv in jobs:
+            key = (kind, devname)
+            entry = cache.get(key)
+            if (
+                fingerprint is not None and entry is not None and
+                entry[0] == fingerprint
+            ):
+                results[key] = entry[1]
+                self.cached += 1
+            else:
+                pending.put((key, fingerprint, argv))
+
+        count = pending.qsize()
+        if not count:
+            return results
+
+        done = []
+
+        def worker():
+            while True:
+                try:
+                    key, fingerprint, argv = pending.get_nowait()
+                except Queue.Empty:
+                    return
+                output, ok = self._run(argv)
+                # list.append is atomic
+                done.append((key, fingerprint, output, ok))
+
+        threads = [
+            threading.Thread(target=worker)
+            for i in xrange(min(self.workers, count))
+        ]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        for key, fingerprint, output, ok in done:
+            results[key] = output
+            self.probed += 1
+            # A failed probe (disk busy, detached meanwhile) is retried
+            # next time rather than remembered
+            if ok and fingerprint is not None:
+                cache[key] = (fingerprint, output)
+            else:
+                cache.pop(key, None)
+
+        self._save(cache)
+        return results
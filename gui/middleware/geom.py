@@ -0,0 +1,193 @@
+#+
+# Copyright 2015 iXsystems, Inc.
+# All rights reserved
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted providing that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR ``AS IS'' AND ANY EXPRESS OR
+# IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS
+# OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT,
+# STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING
+# IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+#####################################################################
+
+from collections import defaultdict
+
+
+class GeomTopology(object):
+    """
+    Index of a kern.geom.confxml document
+
+    The document is walked once; geoms by class and name, providers by
+    id and name, and partitions by rawuuid are then dictionary lookups
+    instead of XPath scans of the whole tree. The indexed nodes are the
+    document's own elements, so they can still be handed to code that
+    expects lxml nodes (zfs.parse_status, Multipath, ...).
+
+    Where several nodes match, lookups return the first one in document
+    order, like the XPath queries they replace.
+    """
+
+    def __init__(self, doc):
+        self.doc = doc
+        # class name -> [geom], in document order
+        self._geoms = defaultdict(list)
+        # class name -> geom name -> geom
+        self._geom_names = defaultdict(dict)
+        # provider id -> provider
+        self._providers = {}
+        # provider id -> class name
+        self._classes = {}
+        # class name -> provider name -> provider
+        self._provider_names = defaultdict(dict)
+        # partition rawuuid -> [PART provider]
+        self._rawuuids = defaultdict(list)
+
+        for cls in doc.iterchildren('class'):
+            cname = cls.findtext('name')
+            for geom in cls.iterchildren('geom'):
+                self._geoms[cname].append(geom)
+                self._geom_names[cname].setdefault(geom.findtext('name'), geom)
+                for prov in geom.iterchildren('provider'):
+                    pid = prov.get('id')
+                    self._providers[pid] = prov
+                    self._classes[pid] = cname
+                    self._provider_names[cname].setdefault(
+                        prov.findtext('name'), prov
+                    )
+                    if cname == 'PART':
+                        rawuuid = prov.findtext('config/rawuuid')
+                        if rawuuid:
+                            self._rawuuids[rawuuid].append(prov)
+
+    def geoms(self, cname):
+        """
+        All geoms of class ``cname``
+        """
+        return self._geoms.get(cname, [])
+
+    def geom(self, cname, name):
+        """
+        The geom of class ``cname`` named ``name``, None if not found
+        """
+        return self._geom_names.get(cname, {}).get(name)
+
+    def provider(self, pid):
+        """
+        The provider with id ``pid``, None if not found
+        """
+        return self._providers.get(pid)
+
+    def provider_named(self, cname, name):
+        """
+        The provider of class ``cname`` named ``name``, None if not found
+        """
+        return self._provider_names.get(cname, {}).get(name)
+
+    def class_of(self, provider):
+        """
+        Name of the class the geom of ``provider`` belongs to
+        """
+        cname = self._classes.get(provider.get('id'))
+        if cname is None:
+            # A node from another snapshot of the tree
+            cname = provider.getparent().getparent().findtext('name')
+        return cname
+
+    def consumed(self, geom):
+        """
+        Providers the consumers of ``geom`` are attached to
+        """
+        providers = []
+        for ref in geom.xpath('./consumer/provider/@ref'):
+            prov = self._providers.get(ref)
+            if prov is not None:
+                providers.append(prov)
+        return providers
+
+    def mediasize(self, disk):
+        """
+        Media size of the DISK geom named ``disk`` as text, None if not
+        found
+        """
+        geom = self.geom('DISK', disk)
+        if geom is None:
+            return None
+        return geom.findtext('provider/mediasize')
+
+    def partitions(self, name):
+        """
+        Partitions (PART providers) of the partitioned geom ``name``, or
+        the partition named ``name`` itself
+        """
+        geom = self.geom('PART', name)
+        if geom is not None:
+            return list(geom.iterchildren('provider'))
+        prov = self.provider_named('PART', name)
+        if prov is not None:
+            return [prov]
+        return []
+
+    def partition_of_type(self, name, ptype):
+        """
+        The first partition of ``name`` (see partitions) of type
+        ``ptype`` (e.g. freebsd-zfs), None if there is none
+        """
+        for prov in self.partitions(name):
+            if prov.findtext('config/type') == ptype:
+                return prov
+        return None
+
+    def partitioned_by_rawuuid(self, rawuuid):
+        """
+        Names of the geoms having a partition with ``rawuuid``
+        """
+        return [
+            prov.getparent().findtext('name')
+            for prov in self._rawuuids.get(rawuuid, [])
+        ]
+
+    def label_geom(self, label):
+        """
+        Name of the geom labeled ``label`` (e.g. gptid/<uuid>), None if
+        not found
+        """
+        prov = self.provider_named('LABEL', label)
+        if prov is None:
+            return None
+        return prov.getparent().findtext('name')
+
+    def label_to_disk(self, name):
+        """
+        Follow a label (or a device name) down to the geom it is on,
+        through GELI
+        """
+        consumed = []
+        prov = self.provider_named('LABEL', name)
+        if prov is not None:
+            consumed = self.consumed(prov.getparent())
+        if not consumed:
+            geom = self.geom('DEV', name)
+            if geom is not None:
+                consumed = self.consumed(geom)
+        if not consumed:
+            return None
+
+        disk = consumed[0].getparent().findtext('name')
+        if self.class_of(consumed[0]) == 'ELI':
+            return self.label_to_disk(disk.replace('.eli', ''))
+        return disk
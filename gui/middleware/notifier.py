@@ -84,6 +84,7 @@ from freenasUI.common.acl import ACL_FLAGS_OS_WINDOWS, ACL_WINDOWS_FILE, ACL_MAC
 from freenasUI.common.freenasacl import ACL
 from freenasUI.common.jail import Jls, Jexec
 from freenasUI.common.locks import mntlock
+from freenasUI.common import cmdcache, perf
 from freenasUI.common.pbi import (
     pbi_add, pbi_delete, pbi_info, pbi_create, pbi_makepatch, pbi_patch,
     PBI_ADD_FLAGS_NOCHECKSIG, PBI_ADD_FLAGS_INFO,
@@ -104,8 +105,17 @@ from freenasUI.common.warden import (Warden, WardenJail,
     WARDEN_TYPE_PLUGINJAIL, WARDEN_STATUS_RUNNING)
 from freenasUI.freeadmin.hook import HookMetaclass
 from freenasUI.middleware import zfs
+from freenasUI.middleware.diskprobe import (
+    DiskProbe,
+    disk_fingerprint,
+    diskinfo_command,
+    parse_diskinfo,
+    parse_serial,
+    smartctl_command,
+)
 from freenasUI.middleware.encryption import random_wipe
 from freenasUI.middleware.exceptions import MiddlewareError
+from freenasUI.middleware.geom import GeomTopology
 from freenasUI.middleware.multipath import Multipath
 import sysctl
 
@@ -192,9 +202,11 @@ class notifier:
         pmask = ctypes.pointer(mask)
         pomask = ctypes.pointer(omask)
         libc.sigprocmask(signal.SIGQUIT, pmask, pomask)
+        cmdcache.cache.observe(command)
         try:
-            self.__system("(" + command + ") 2>&1 | logger -p daemon.notice -t %s"
-                           % (self.IDENTIFIER, ))
+            with perf.system_call(command):
+                self.__system("(" + command + ") 2>&1 | logger -p daemon.notice -t %s"
+                               % (self.IDENTIFIER, ))
         finally:
             libc.sigprocmask(signal.SIGQUIT, pomask, None)
         log.debug("Executed: %s", command)
@@ -209,17 +221,30 @@ class notifier:
         pmask = ctypes.pointer(mask)
         pomask = ctypes.pointer(omask)
         libc.sigprocmask(signal.SIGQUIT, pmask, pomask)
+        cmdcache.cache.observe(command)
         try:
-            retval = self.__system("(" + command + ") >/dev/null 2>&1")
+            with perf.system_call(command):
+                retval = self.__system("(" + command + ") >/dev/null 2>&1")
         finally:
             libc.sigprocmask(signal.SIGQUIT, pomask, None)
         retval >>= 8
         log.debug("Executed: %s; returned %d", command, retval)
         return retval
 
-    def _pipeopen(self, command):
+    def _pipeopen(self, command, cache=True):
+        """
+        Read-only commands (see common.cmdcache) are run at once and
+        their output memoized for a few seconds, pass cache=False for
+        a fresh one. Any other command drops the memoized output.
+        """
         log.debug("Popen()ing: %s", command)
-        return Popen(command, stdin=PIPE, stdout=PIPE, stderr=PIPE, shell=True, close_fds=True)
+
+        def spawn():
+            return perf.TracedPopen(command, stdin=PIPE, stdout=PIPE, stderr=PIPE, shell=True, close_fds=True)
+
+        if cmdcache.cache.observe(command) and cache:
+            return cmdcache.cache.run(command, spawn)
+        return spawn()
 
     def _do_nada(self):
         pass
@@ -1668,6 +1693,7 @@ class notifier:
         if p1.wait() != 0:
             error = ", ".join(p1.communicate()[1].split('\n'))
             raise MiddlewareError('Unable to create the pool: %s' % error)
+        zfs.inventory.invalidate(z_name)
 
         # Restore previous larger ashift state.
         if larger_ashift == 0:
@@ -1747,6 +1773,8 @@ class notifier:
         zfsproc = self._pipeopen("/sbin/zfs create %s -V '%s' '%s'" % (options, size, name))
         zfs_err = zfsproc.communicate()[1]
         zfs_error = zfsproc.wait()
+        if zfs_error == 0:
+            zfs.inventory.invalidate(name)
         return zfs_error, zfs_err
 
     def create_zfs_dataset(self, path, props=None, _restart_collectd=True):
@@ -1760,6 +1788,8 @@ class notifier:
         zfsproc = self._pipeopen("/sbin/zfs create %s '%s'" % (options, path))
         zfs_output, zfs_err = zfsproc.communicate()
         zfs_error = zfsproc.wait()
+        if zfs_error == 0:
+            zfs.inventory.invalidate(path)
         if zfs_error == 0 and _restart_collectd:
             self.restart("collectd")
         return zfs_error, zfs_err
@@ -1809,24 +1839,6 @@ class notifier:
                 return True
         return False
 
-    def repl_remote_snapshots(self, repl):
-        """
-        Get a list of snapshots in the remote side
-        """
-        if repl.repl_remote.ssh_remote_dedicateduser_enabled:
-            user = repl.repl_remote.ssh_remote_dedicateduser
-        else:
-            user = 'root'
-        proc = self._pipeopen('/usr/bin/ssh -i /data/ssh/replication -o ConnectTimeout=3 -p %s "%s"@"%s" "zfs list -Ht snapshot -o name"' % (
-            repl.repl_remote.ssh_remote_port,
-            user,
-            repl.repl_remote.ssh_remote_hostname,
-        ))
-        data = proc.communicate()[0]
-        if proc.returncode != 0:
-            return []
-        return data.strip('\n').split('\n')
-
     def destroy_zfs_dataset(self, path, recursive=False):
         retval = None
         if '@' in path:
@@ -1858,6 +1870,7 @@ class notifier:
                 zfsproc = self._pipeopen("zfs destroy '%s'" % (path))
             retval = zfsproc.communicate()[1]
             if zfsproc.returncode == 0:
+                zfs.inventory.invalidate(path)
                 from freenasUI.storage.models import Task, Replication
                 Task.objects.filter(task_filesystem=path).delete()
                 Replication.objects.filter(repl_filesystem=path).delete()
@@ -1875,6 +1888,8 @@ class notifier:
             self.delete_plugins()
         zfsproc = self._pipeopen("zfs destroy '%s'" % (str(name),))
         retval = zfsproc.communicate()[1]
+        if zfsproc.returncode == 0:
+            zfs.inventory.invalidate(name)
         return retval
 
     def __destroy_zfs_volume(self, volume):
@@ -1886,6 +1901,7 @@ class notifier:
         # First, destroy the zpool.
         disks = volume.get_disks()
         self._system("zpool destroy -f %s" % (vol_name, ))
+        zfs.inventory.invalidate(vol_name)
 
         # Clear out disks associated with the volume
         for disk in disks:
@@ -3440,13 +3456,14 @@ class notifier:
                     disks.remove(dev)
             disks.append(mp.devname)
 
+        inventory = self.disk_inventory(disks, serial=False)
         for disk in disks:
-            info = self._pipeopen('/usr/sbin/diskinfo %s' % disk).communicate()[0].split('\t')
-            if len(info) > 3:
+            info = inventory[disk]
+            if info['capacity'] is not None:
                 disksd.update({
                     disk: {
-                        'devname': info[0],
-                        'capacity': info[2],
+                        'devname': info['devname'],
+                        'capacity': info['capacity'],
                     },
                 })
 
@@ -3603,6 +3620,7 @@ class notifier:
             # These should probably be options that are configurable from the GUI
             self._system("zfs set aclmode=passthrough '%s'" % name)
             self._system("zfs set aclinherit=passthrough '%s'" % name)
+            zfs.inventory.invalidate(name)
             self.restart("collectd")
             return True
         else:
@@ -3685,6 +3703,9 @@ class notifier:
 
         self.start("syslogd")
 
+        if vol_fstype == 'ZFS':
+            zfs.inventory.invalidate(vol_name)
+
         if not succeeded and p1.returncode:
             raise MiddlewareError('Failed to detach %s with "%s" (exited '
                                   'with %d): %s' %
@@ -3736,57 +3757,93 @@ class notifier:
             raise MiddlewareError('Unable to scrub %s: %s' % (name, stderr))
         return True
 
+    def _snapshot_replication(self, fs, name, replications):
+        """
+        replications maps a local dataset to the sets of snapshot names
+        known to exist on the remote side of its replication tasks
+        """
+        if not replications:
+            return None
+        for snaps in replications.get(fs, ()):
+            if name in snaps:
+                # TODO: Multiple replication tasks
+                return 'OK'
+        return None
+
     def zfs_snapshot_list(self, path=None, replications=None):
         fsinfo = dict()
 
-        zfsproc = self._pipeopen("/sbin/zfs list -t volume -o name -H")
-        zvols = filter(lambda y: y != '', zfsproc.communicate()[0].split('\n'))
-
-        if path:
-            zfsproc = self._pipeopen("/sbin/zfs list -p -r -t snapshot -H -S creation '%s'" % path)
-        else:
-            zfsproc = self._pipeopen("/sbin/zfs list -p -t snapshot -H -S creation")
-        lines = zfsproc.communicate()[0].split('\n')
-        for line in lines:
-            if line != '':
-                _list = line.split('\t')
-                snapname = _list[0]
-                used = _list[1]
-                refer = _list[3]
-                fs, name = snapname.split('@')
-                try:
-                    snaplist = fsinfo[fs]
-                    mostrecent = False
-                except:
-                    snaplist = []
-                    mostrecent = True
-                replication = None
-                if replications:
-                    for repl, snaps in replications.iteritems():
-                        if fs != repl.repl_filesystem:
-                            break
-                        remotename = '%s@%s' % (
-                            repl.repl_zfs,
-                            name,
-                        )
-                        if remotename in snaps:
-                            replication = 'OK'
-                            # TODO: Multiple replication tasks
-                            break
+        zvols = set(
+            row[0] for row in zfs.inventory.rows(types=['volume'])
+        )
 
-                snaplist.insert(0,
-                    zfs.Snapshot(
-                        name=name,
-                        filesystem=fs,
-                        used=used,
-                        refer=refer,
-                        mostrecent=mostrecent,
-                        parent_type='filesystem' if fs not in zvols else 'volume',
-                        replication=replication
-                    ))
-                fsinfo[fs] = snaplist
+        for snapname, used, refer in zfs.zfs_snapshot_iter(
+            path, sort=['-creation']
+        ):
+            fs, name = snapname.split('@')
+            try:
+                snaplist = fsinfo[fs]
+                mostrecent = False
+            except:
+                snaplist = []
+                mostrecent = True
+
+            snaplist.insert(0,
+                zfs.Snapshot(
+                    name=name,
+                    filesystem=fs,
+                    used=used,
+                    refer=refer,
+                    mostrecent=mostrecent,
+                    parent_type='filesystem' if fs not in zvols else 'volume',
+                    replication=self._snapshot_replication(
+                        fs, name, replications
+                    ),
+                ))
+            fsinfo[fs] = snaplist
         return fsinfo
 
+    def zfs_snapshot_objects(self, rows, replications=None):
+        """
+        Build Snapshot objects out of (fullname, used, refer) rows as
+        yielded by zfs.zfs_snapshot_iter
+
+        This is meant for a page of snapshots, only the datasets
+        the rows belong to are listed to find out their most recent
+        snapshot.
+        """
+        filesystems = set(row[0].split('@', 1)[0] for row in rows)
+        if not filesystems:
+            return []
+
+        newest = {}
+        for snapname, used, refer in zfs.zfs_snapshot_iter(
+            sorted(filesystems), recursive=False, sort=['-creation']
+        ):
+            fs = snapname.split('@', 1)[0]
+            if fs not in newest:
+                newest[fs] = snapname
+
+        zvols = set(
+            row[0] for row in zfs.inventory.rows(types=['volume'])
+        )
+
+        snapshots = []
+        for snapname, used, refer in rows:
+            fs, name = snapname.split('@', 1)
+            snapshots.append(zfs.Snapshot(
+                name=name,
+                filesystem=fs,
+                used=used,
+                refer=refer,
+                mostrecent=newest.get(fs) == snapname,
+                parent_type='filesystem' if fs not in zvols else 'volume',
+                replication=self._snapshot_replication(
+                    fs, name, replications
+                ),
+            ))
+        return snapshots
+
     def zfs_mksnap(self, dataset, name, recursive=False):
         if recursive:
             p1 = self._pipeopen("/sbin/zfs snapshot -r '%s'@'%s'" % (dataset, name))
@@ -3800,11 +3857,15 @@ class notifier:
     def zfs_clonesnap(self, snapshot, dataset):
         zfsproc = self._pipeopen("zfs clone '%s' '%s'" % (snapshot, dataset))
         retval = zfsproc.communicate()[1]
+        if zfsproc.returncode == 0:
+            zfs.inventory.invalidate(dataset)
         return retval
 
     def rollback_zfs_snapshot(self, snapshot):
         zfsproc = self._pipeopen("zfs rollback '%s'" % (snapshot))
         retval = zfsproc.communicate()[1]
+        if zfsproc.returncode == 0:
+            zfs.inventory.invalidate(snapshot)
         return retval
 
     def config_restore(self):
@@ -3892,6 +3953,7 @@ class notifier:
         zfsproc = self._pipeopen("zfs set '%s'='%s' '%s'" % (item, value, name))
         err = zfsproc.communicate()[1]
         if zfsproc.returncode == 0:
+            zfs.inventory.invalidate(name)
             return True, None
         return False, err
 
@@ -3913,6 +3975,7 @@ class notifier:
         zfsproc = self._pipeopen(zfscmd)
         err = zfsproc.communicate()[1]
         if zfsproc.returncode == 0:
+            zfs.inventory.invalidate(name)
             return True, None
         return False, err
 
@@ -4112,18 +4175,30 @@ class notifier:
 
     def __init__(self):
         self.__confxml = None
+        self.__geom = None
         self.__camcontrol = None
         self.__diskserial = {}
         self.__twcli = {}
 
     def __del__(self):
         self.__confxml = None
+        self.__geom = None
 
     def _geom_confxml(self):
         if self.__confxml is None:
             self.__confxml = etree.fromstring(self.sysctl('kern.geom.confxml'))
         return self.__confxml
 
+    def _geom_topology(self):
+        """
+        GeomTopology index of the current confxml snapshot, rebuilt
+        whenever confxml is fetched again
+        """
+        doc = self._geom_confxml()
+        if self.__geom is None or self.__geom.doc is not doc:
+            self.__geom = GeomTopology(doc)
+        return self.__geom
+
     def __get_twcli(self, controller):
         if controller in self.__twcli:
             return self.__twcli[controller]
@@ -4139,10 +4214,11 @@ class notifier:
         self.__twcli[controller] = units
         return self.__twcli[controller]
 
-    def serial_from_device(self, devname):
-        if devname in self.__diskserial:
-            return self.__diskserial.get(devname)
-
+    def _smartctl_args(self, devname):
+        """
+        smartctl arguments addressing ``devname``, through the RAID
+        controller it sits behind if any
+        """
         args = ["/dev/%s" % devname]
         camcontrol = self._camcontrol_list()
         info = camcontrol.get(devname)
@@ -4184,60 +4260,98 @@ class notifier:
                     "3ware,%d" % (twcli.get(info["channel"], -1), )
                     ]
 
-        p1 = Popen(["/usr/local/sbin/smartctl", "-i"] + args, stdout=PIPE)
-        output = p1.communicate()[0]
-        search = re.search(r'Serial Number:\s+(?P<serial>.+)', output, re.I)
-        if search:
-            serial = search.group("serial")
-            self.__diskserial[devname] = serial
-            return serial
-        return None
+        return args
+
+    def serial_from_device(self, devname):
+        if devname in self.__diskserial:
+            return self.__diskserial.get(devname)
+
+        return self.disk_inventory([devname], capacity=False)[devname]['serial']
+
+    def disk_inventory(self, disks=None, serial=True, capacity=True):
+        """
+        Serial numbers (smartctl) and capacities (diskinfo) of disks
+
+        The probes run concurrently and their results are kept until
+        GEOM sees a different disk under the same name, see DiskProbe.
+
+        Returns:
+            dict of devname to a dict of devname, capacity and serial,
+            capacity and serial are None when not asked for or unknown
+        """
+        from django.conf import settings
+
+        if disks is None:
+            disks = self.__get_disks()
+        topology = self._geom_topology()
+
+        jobs = []
+        for disk in disks:
+            fingerprint = disk_fingerprint(topology, disk)
+            if capacity:
+                jobs.append((
+                    'diskinfo', disk, fingerprint, diskinfo_command(disk),
+                ))
+            if serial and disk not in self.__diskserial:
+                jobs.append((
+                    'serial', disk, fingerprint,
+                    smartctl_command(self._smartctl_args(disk)),
+                ))
+
+        probe = DiskProbe(
+            workers=getattr(settings, 'DISK_PROBE_WORKERS', 8),
+        )
+        outputs = probe.run(jobs)
+        log.debug(
+            "Disk inventory: %d probed, %d cached", probe.probed, probe.cached
+        )
+
+        inventory = {}
+        for disk in disks:
+            entry = {
+                'devname': disk,
+                'capacity': None,
+                'serial': None,
+            }
+            if capacity:
+                info = parse_diskinfo(outputs.get(('diskinfo', disk)))
+                if info:
+                    entry.update(info)
+            if serial:
+                if disk not in self.__diskserial:
+                    found = parse_serial(outputs.get(('serial', disk)))
+                    if found:
+                        self.__diskserial[disk] = found
+                entry['serial'] = self.__diskserial.get(disk)
+            inventory[disk] = entry
+
+        return inventory
 
     def label_to_disk(self, name):
         """
         Given a label go through the geom tree to find out the disk name
         label = a geom label or a disk partition
         """
-        doc = self._geom_confxml()
-
-        # try to find the provider from GEOM_LABEL
-        search = doc.xpath("//class[name = 'LABEL']//provider[name = '%s']/../consumer/provider/@ref" % name)
-        if len(search) > 0:
-            provider = search[0]
-        else:
-            # the label does not exist, try to find it in GEOM DEV
-            search = doc.xpath("//class[name = 'DEV']/geom[name = '%s']//provider/@ref" % name)
-            if len(search) > 0:
-                provider = search[0]
-            else:
-                return None
-        search = doc.xpath("//provider[@id = '%s']/../name" % provider)
-        disk = search[0].text
-        if search[0].getparent().getparent().xpath("./name")[0].text in ('ELI', ):
-            return self.label_to_disk(disk.replace(".eli", ""))
-        return disk
+        return self._geom_topology().label_to_disk(name)
 
     def device_to_identifier(self, name):
         name = str(name)
-        doc = self._geom_confxml()
+        geom = self._geom_topology()
 
         serial = self.serial_from_device(name)
         if serial:
             return "{serial}%s" % serial
 
-        search = doc.xpath("//class[name = 'PART']/..//*[name = '%s']//config[type = 'freebsd-zfs']/rawuuid" % name)
-        if len(search) > 0:
-            return "{uuid}%s" % search[0].text
-        search = doc.xpath("//class[name = 'PART']/geom/..//*[name = '%s']//config[type = 'freebsd-ufs']/rawuuid" % name)
-        if len(search) > 0:
-            return "{uuid}%s" % search[0].text
+        for ptype in ('freebsd-zfs', 'freebsd-ufs'):
+            part = geom.partition_of_type(name, ptype)
+            if part is not None and part.find('config/rawuuid') is not None:
+                return "{uuid}%s" % part.findtext('config/rawuuid')
 
-        search = doc.xpath("//class[name = 'LABEL']/geom[name = '%s']/provider/name" % name)
-        if len(search) > 0:
-            return "{label}%s" % search[0].text
+        label = geom.geom('LABEL', name)
+        if label is not None and label.find('provider') is not None:
+            return "{label}%s" % label.findtext('provider/name')
 
-        search = doc.xpath("//class[name = 'DEV']/geom[name = '%s']" % name)
-        if len(search) > 0:
+        if geom.geom('DEV', name) is not None:
             return "{devicename}%s" % name
 
         return ''
@@ -4247,7 +4361,7 @@ class notifier:
         if not ident:
             return None
 
-        doc = self._geom_confxml()
+        geom = self._geom_topology()
 
         search = re.search(r'\{(?P<type>.+?)\}(?P<value>.+)', ident)
         if not search:
@@ -4257,18 +4371,13 @@ class notifier:
         value = search.group("value")
 
         if tp == 'uuid':
-            search = doc.xpath("//class[name = 'PART']/geom//config[rawuuid = '%s']/../../name" % value)
-            if len(search) > 0:
-                for entry in search:
-                    if not entry.text.startswith('label'):
-                        return entry.text
+            for name in geom.partitioned_by_rawuuid(value):
+                if not name.startswith('label'):
+                    return name
             return None
 
         elif tp == 'label':
-            search = doc.xpath("//class[name = 'LABEL']/geom//provider[name = '%s']/../name" % value)
-            if len(search) > 0:
-                return search[0].text
-            return None
+            return geom.label_geom(value)
 
         elif tp == 'serial':
             for devname in self.__get_disks():
@@ -4278,8 +4387,7 @@ class notifier:
             return None
 
         elif tp == 'devicename':
-            search = doc.xpath("//class[name = 'DEV']/geom[name = '%s']" % value)
-            if len(search) > 0:
+            if geom.geom('DEV', value) is not None:
                 return value
             return None
         else:
@@ -4290,11 +4398,13 @@ class notifier:
         Given a partition a type and a disk name (adaX)
         get the first partition that matches the type
         """
-        doc = self._geom_confxml()
+        geom = self._geom_topology()
         # TODO get from MBR as well?
-        search = doc.xpath("//class[name = 'PART']/geom[name = '%s']//config[type = 'freebsd-%s']/../name" % (device, name))
-        if len(search) > 0:
-            return search[0].text
+        if geom.geom('PART', device) is None:
+            return ''
+        part = geom.partition_of_type(device, 'freebsd-%s' % name)
+        if part is not None:
+            return part.findtext('name')
         else:
             return ''
 
@@ -4313,21 +4423,22 @@ class notifier:
         Returns:
             The provider xmlnode if found, None otherwise
         """
-        doc = self._geom_confxml()
-        xpath = doc.xpath("//class[name = 'LABEL']//provider[name = '%s']/../consumer/provider/@ref" % "%s/%s" % (geom, name))
-        if not xpath:
+        topology = self._geom_topology()
+        label = topology.provider_named('LABEL', "%s/%s" % (geom, name))
+        if label is None:
+            return None
+        consumed = topology.consumed(label.getparent())
+        if not consumed:
             return None
-        providerid = xpath[0]
-        provider = doc.xpath("//provider[@id = '%s']" % providerid)[0]
+        provider = consumed[0]
 
-        class_name = provider.xpath("../../name")[0].text
+        class_name = topology.class_of(provider)
 
         # We've got a GPT over the softraid, not raw UFS filesystem
         # So we need to recurse one more time
         if class_name == 'PART':
-            providerid = provider.xpath("../consumer/provider/@ref")[0]
-            newprovider = doc.xpath("//provider[@id = '%s']" % providerid)[0]
-            class_name = newprovider.xpath("../../name")[0].text
+            newprovider = topology.consumed(provider.getparent())[0]
+            class_name = topology.class_of(newprovider)
             # if this PART is really backed up by softraid the hypothesis was correct
             if class_name in ('STRIPE', 'MIRROR', 'RAID3'):
                 return newprovider
@@ -4336,14 +4447,13 @@ class notifier:
 
     def get_disks_from_provider(self, provider):
         disks = []
-        geomname = provider.xpath("../../name")[0].text
+        geom = self._geom_topology()
+        geomname = geom.class_of(provider)
         if geomname in ('DISK', 'PART'):
-            disks.append(provider.xpath("../name")[0].text)
+            disks.append(provider.getparent().findtext('name'))
         elif geomname in ('STRIPE', 'MIRROR', 'RAID3'):
-            doc = self._geom_confxml()
-            for prov in provider.xpath("../consumer/provider/@ref"):
-                prov2 = doc.xpath("//provider[@id = '%s']" % prov)[0]
-                disks.append(prov2.xpath("../name")[0].text)
+            for prov in geom.consumed(provider.getparent()):
+                disks.append(prov.getparent().findtext('name'))
         else:
             # TODO log, could not get disks
             pass
@@ -4447,7 +4557,7 @@ class notifier:
         if devname.find("/") != -1:
             return
 
-        doc = self._geom_confxml()
+        geom = self._geom_topology()
         disks = self.__get_disks()
         self.__diskserial.clear()
         self.__camcontrol = None
@@ -4473,9 +4583,9 @@ class notifier:
         if reg:
             disk.disk_subsystem = reg.group(1)
             disk.disk_number = int(reg.group(2))
-        mediasize = doc.xpath("//class[name = 'DISK']//geom[name = '%s']/provider/mediasize" % devname)
+        mediasize = geom.mediasize(devname)
         if mediasize:
-            disk.disk_size = mediasize[0].text
+            disk.disk_size = mediasize
         disk.save()
 
     def sync_disk_extra(self, disk, add=False):
@@ -4484,11 +4594,14 @@ class notifier:
     def sync_disks(self):
         from freenasUI.storage.models import Disk
 
-        doc = self._geom_confxml()
+        geom = self._geom_topology()
         disks = self.__get_disks()
         self.__diskserial.clear()
         self.__camcontrol = None
 
+        # Probe every disk at once rather than one by one below
+        self.disk_inventory(disks, capacity=False)
+
         in_disks = {}
         serials = []
         for disk in Disk.objects.order_by('disk_enabled'):
@@ -4513,9 +4626,9 @@ class notifier:
             if disk.disk_serial:
                 serials.append(disk.disk_serial)
 
-            mediasize = doc.xpath("//class[name = 'DISK']//geom[name = '%s']/provider/mediasize" % dskname)
+            mediasize = geom.mediasize(dskname)
             if mediasize:
-                disk.disk_size = mediasize[0].text
+                disk.disk_size = mediasize
 
             self.sync_disk_extra(disk, add=False)
 
@@ -4536,9 +4649,9 @@ class notifier:
                 d.disk_name = disk
                 d.disk_identifier = self.device_to_identifier(disk)
                 d.disk_serial = self.serial_from_device(disk) or ''
-                mediasize = doc.xpath("//class[name = 'DISK']//geom[name = '%s']/provider/mediasize" % disk)
+                mediasize = geom.mediasize(disk)
                 if mediasize:
-                    d.disk_size = mediasize[0].text
+                    d.disk_size = mediasize
                 if d.disk_serial:
                     if d.disk_serial in serials:
                         # Probably dealing with multipath here, do not add another
@@ -4664,13 +4777,12 @@ class notifier:
         """
         from freenasUI.storage.models import Volume, Disk
 
-        doc = self._geom_confxml()
+        topology = self._geom_topology()
 
         mp_disks = []
-        for geom in doc.xpath("//class[name = 'MULTIPATH']/geom"):
-            for provref in geom.xpath("./consumer/provider/@ref"):
-                prov = doc.xpath("//provider[@id = '%s']" % provref)[0]
-                class_name = prov.xpath("../../name")[0].text
+        for geom in topology.geoms('MULTIPATH'):
+            for prov in topology.consumed(geom):
+                class_name = topology.class_of(prov)
                 # For now just DISK is allowed
                 if class_name != 'DISK':
                     log.warn(
@@ -4679,7 +4791,7 @@ class notifier:
                         class_name
                     )
                     continue
-                disk = prov.xpath("../name")[0].text
+                disk = prov.getparent().findtext('name')
                 mp_disks.append(disk)
 
         reserved = self._find_root_devs()
@@ -4691,21 +4803,26 @@ class notifier:
         serials = defaultdict(list)
         active_active = []
         RE_CD = re.compile('^cd[0-9]')
-        for geom in doc.xpath("//class[name = 'DISK']/geom"):
-            name = geom.xpath("./name")[0].text
+        mp_disks = set(mp_disks)
+        reserved = set(reserved)
+        candidates = []
+        for geom in topology.geoms('DISK'):
+            name = geom.findtext('name')
             if RE_CD.match(name) or name in reserved or name in mp_disks:
                 continue
+            candidates.append((name, geom))
+
+        self.disk_inventory([c[0] for c in candidates], capacity=False)
+
+        for name, geom in candidates:
             if self._multipath_is_active(name, geom):
                 active_active.append(name)
             serial = self.serial_from_device(name) or ''
-            try:
-                lunid = geom.xpath("./provider/config/lunid")[0].text
-            except:
-                lunid = ''
+            lunid = geom.findtext('provider/config/lunid') or ''
             serial = serial + lunid
             if not serial:
                 continue
-            size = geom.xpath("./provider/mediasize")[0].text
+            size = geom.findtext('provider/mediasize')
             serials[(serial, size)].append(name)
 
         for disks in serials.values():
@@ -4715,17 +4832,16 @@ class notifier:
             self.multipath_create(name, disks, active_active)
 
         # Grab confxml again to take new multipaths into account
-        doc = self._geom_confxml()
+        topology = self._geom_topology()
         mp_ids = []
-        for geom in doc.xpath("//class[name = 'MULTIPATH']/geom"):
+        for geom in topology.geoms('MULTIPATH'):
             _disks = []
-            for provref in geom.xpath("./consumer/provider/@ref"):
-                prov = doc.xpath("//provider[@id = '%s']" % provref)[0]
-                class_name = prov.xpath("../../name")[0].text
+            for prov in topology.consumed(geom):
+                class_name = topology.class_of(prov)
                 # For now just DISK is allowed
                 if class_name != 'DISK':
                     continue
-                disk = prov.xpath("../name")[0].text
+                disk = prov.getparent().findtext('name')
                 _disks.append(disk)
             qs = Disk.objects.filter(
                 Q(disk_name__in=_disks) | Q(disk_multipath_member__in=_disks)
@@ -4733,7 +4849,7 @@ class notifier:
             if qs.exists():
                 diskobj = qs[0]
                 mp_ids.append(diskobj.id)
-                diskobj.disk_multipath_name = geom.xpath("./name")[0].text
+                diskobj.disk_multipath_name = geom.findtext('name')
                 if diskobj.disk_name in _disks:
                     _disks.remove(diskobj.disk_name)
                 if _disks:
@@ -5298,6 +5414,8 @@ class notifier:
                         'zfs rename -f "%s" "%s"' % (name, newname)
                     )
                     errmsg = proc.communicate()[1]
+                    zfs.inventory.invalidate(name)
+                    zfs.inventory.invalidate(newname)
                     if proc.returncode != 0:
                         log.error(
                             "Failed renaming system dataset from %s to %s: %s",
@@ -5403,6 +5521,7 @@ class notifier:
                 )
             )
             proc.communicate()
+            zfs.inventory.invalidate('%s/.system' % _from)
 
         for service in restart:
             self.start(service)
@@ -27,9 +27,14 @@
 from decimal import Decimal
 import bisect
 import logging
+import os
 import re
 import subprocess
+import tempfile
+import threading
+import time
 
+from django.conf import settings
 from django.utils.datastructures import SortedDict
 from django.utils.translation import ugettext_lazy as _
 
@@ -37,6 +42,9 @@ log = logging.getLogger('middleware.zfs')
 
 ZPOOL_NAME_RE = r'[a-z][a-z0-9_\-\.]*'
 
+ZFS_LIST_FIELDS = "space,refer,mountpoint,type"
+ZFS_INVENTORY_STAMP = '/var/tmp/.zfs_inventory'
+
 
 def _is_vdev(name):
     """
@@ -419,41 +427,55 @@ class Dev(Tnode):
 
 
 class ZFSList(SortedDict):
+    """
+    Top level datasets keyed by path
+
+    Every dataset appended, including the ones nested under a parent
+    in a hierarchical list, is also indexed by its full path so lookups
+    do not need to walk the tree.
+    """
 
     pools = None
 
     def __init__(self, *args, **kwargs):
         self.pools = {}
+        self._poolpaths = {}
+        self._index = {}
         super(ZFSList, self).__init__(*args, **kwargs)
 
     def append(self, new):
-        if new.pool in self.pools:
-            bisect.insort(self.pools.get(new.pool), new)
+        paths = self._poolpaths.setdefault(new.pool, [])
+        datasets = self.pools.setdefault(new.pool, [])
+        # zfs list output is sorted already, avoid the bisect if we can
+        if not paths or paths[-1] <= new.path:
+            idx = len(paths)
         else:
-            self.pools[new.pool] = [new]
+            idx = bisect.bisect(paths, new.path)
+        paths.insert(idx, new.path)
+        datasets.insert(idx, new)
         self[new.path] = new
+        self._index[new.path] = new
+
+    def append_child(self, parent, new):
+        parent.append(new)
+        self._index[new.path] = new
+
+    def lookup(self, path):
+        """
+        Find any dataset in the list, top level or not, by its full path
+        """
+        return self._index.get(path)
 
     def find(self, names, root=False):
-        if not root:
-            search = '/'.join(names[0:2])
-            names = names[2:]
-        else:
-            search = names[0]
-            names = names[1:]
-        item = self.get(search, None)
-        if item:
-            while names:
-                found = False
-                search = names[0]
-                names = names[1:]
-                for child in item.children:
-                    if child.name == search:
-                        item = child
-                        found = True
-                        break
-                if not found:
-                    break
-        return item
+        """
+        Return the deepest dataset in the list along the path in names
+        """
+        top = 1 if root else 2
+        for depth in xrange(len(names), top - 1, -1):
+            item = self._index.get('/'.join(names[:depth]))
+            if item is not None:
+                return item
+        return None
 
     def __getitem__(self, item):
         if isinstance(item, slice):
@@ -464,27 +486,25 @@ class ZFSList(SortedDict):
         else:
             return super(ZFSList, self).__getitem__(item)
 
-    def __delitem__(self, item):
-        self.pools[item.pool].remove(item)
-        super(ZFSList, self).__delitem__(item)
+    def __delitem__(self, path):
+        item = super(ZFSList, self).__getitem__(path)
+        paths = self._poolpaths[item.pool]
+        idx = bisect.bisect_left(paths, path)
+        del paths[idx]
+        del self.pools[item.pool][idx]
+        del self._index[path]
+        super(ZFSList, self).__delitem__(path)
 
 
 class ZFSDataset(object):
 
+    __slots__ = (
+        'name', 'path', 'pool', 'used', 'usedsnap', 'usedds',
+        'usedrefreserv', 'usedchild', 'avail', 'refer', 'mountpoint',
+        'parent', 'children',
+    )
+
     category = 'filesystem'
-    name = None
-    path = None
-    pool = None
-    used = None
-    usedsnap = None
-    usedds = None
-    usedrefreserv = None
-    usedchild = None
-    avail = None
-    refer = None
-    mountpoint = None
-    parent = None
-    children = None
 
     def __init__(self, path=None, used=None, usedsnap=None, usedds=None,
                  usedrefreserv=None, usedchild=None, avail=None, refer=None,
@@ -496,6 +516,9 @@ class ZFSDataset(object):
             else:
                 self.pool = ''
                 self.name = path
+        else:
+            self.pool = None
+            self.name = None
         self.used = used
         self.usedsnap = usedsnap
         self.usedds = usedds
@@ -531,19 +554,12 @@ class ZFSDataset(object):
 
 class ZFSVol(object):
 
+    __slots__ = (
+        'name', 'path', 'pool', 'used', 'usedsnap', 'usedds',
+        'usedrefreserv', 'usedchild', 'avail', 'refer', 'parent', 'children',
+    )
+
     category = 'volume'
-    name = None
-    path = None
-    pool = None
-    used = None
-    usedsnap = None
-    usedds = None
-    usedrefreserv = None
-    usedchild = None
-    avail = None
-    refer = None
-    parent = None
-    children = None
 
     def __init__(self, path=None, used=None, usedsnap=None, usedds=None,
                  usedrefreserv=None, usedchild=None, avail=None, refer=None):
@@ -554,6 +570,9 @@ class ZFSVol(object):
             else:
                 self.pool = ''
                 self.name = path
+        else:
+            self.pool = None
+            self.name = None
         self.used = used
         self.usedsnap = usedsnap
         self.usedds = usedds
@@ -588,20 +607,17 @@ class ZFSVol(object):
 
 class Snapshot(object):
 
-    name = None
-    filesystem = None
-    used = None
-    refer = None
-    mostrecent = False
-    parent_type = None
-    replication = None
+    __slots__ = (
+        'name', 'filesystem', 'used', 'refer', 'mostrecent', 'parent_type',
+        'replication',
+    )
 
     def __init__(
         self,
-        name,
-        filesystem,
-        used,
-        refer,
+        name=None,
+        filesystem=None,
+        used=None,
+        refer=None,
         mostrecent=False,
         parent_type=None,
         replication=None
@@ -857,42 +873,226 @@ def parse_status(name, doc, data):
     return pool
 
 
-def zfs_list(path="", recursive=False, hierarchical=False, include_root=False,
-             types=None):
+class ZFSInventory(object):
     """
-    Return a dictionary that contains all ZFS dataset list and their
-    mountpoints
+    Process wide cache of the `zfs list` output for filesystems and volumes
+
+    Rows are kept parsed and ordered by dataset hierarchy so zfs_list() can
+    build a brand new ZFSList out of them without forking.
+
+    Whoever mutates a dataset through the notifier calls invalidate(), which
+    refreshes only the affected subtree (and its ancestors, for the space
+    accounting) and replaces the stamp file so other processes know their
+    copy is no longer valid.
+
+    Once the TTL expires the stale copy is still served while a background
+    thread revalidates it, up to max_stale seconds.
+    A TTL of 0 disables the cache altogether.
     """
-    args = [
-        "/sbin/zfs",
-        "list",
-        "-p",
-        "-H",
-        "-s", "name",
-        "-o", "space,refer,mountpoint,type",
-    ]
-    if recursive:
-        args.insert(3, "-r")
 
-    if types:
-        args.insert(4, "-t")
-        args.insert(5, ",".join(types))
+    def __init__(self, ttl=None, max_stale=None, stamp=ZFS_INVENTORY_STAMP):
+        self._ttl = ttl
+        self._max_stale = max_stale
+        self._stamp_path = stamp
+        self._lock = threading.RLock()
+        self._keys = None
+        self._rows = None
+        self._stamp = None
+        self._updated = 0
+        self._revalidating = False
 
-    if path:
-        args.append(path)
+    @property
+    def ttl(self):
+        if self._ttl is None:
+            return getattr(settings, 'ZFS_INVENTORY_TTL', 10)
+        return self._ttl
+
+    @property
+    def max_stale(self):
+        if self._max_stale is None:
+            return getattr(settings, 'ZFS_INVENTORY_MAX_STALE', self.ttl * 6)
+        return self._max_stale
+
+    @staticmethod
+    def _key(name):
+        return name.split('/')
 
-    zfsproc = subprocess.Popen(
-        args,
-        stdout=subprocess.PIPE,
-        stderr=subprocess.PIPE)
+    @staticmethod
+    def _exec(names, recursive=False):
+        args = [
+            "/sbin/zfs",
+            "list",
+            "-p",
+            "-H",
+            "-s", "name",
+            "-o", ZFS_LIST_FIELDS,
+            "-t", "filesystem,volume",
+        ]
+        if recursive:
+            args.append("-r")
+        args.extend(names)
+        zfsproc = subprocess.Popen(
+            args,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE)
+        zfs_output, zfs_err = zfsproc.communicate()
+        return [
+            tuple(line.split('\t'))
+            for line in zfs_output.split('\n') if line
+        ]
+
+    def _read_stamp(self):
+        try:
+            st = os.stat(self._stamp_path)
+        except OSError:
+            return None
+        return (st.st_ino, st.st_mtime)
 
-    zfs_output, zfs_err = zfsproc.communicate()
-    zfs_output = zfs_output.split('\n')
+    def _write_stamp(self):
+        try:
+            fd, tmp = tempfile.mkstemp(
+                dir=os.path.dirname(self._stamp_path),
+                prefix='.zfs_inventory',
+            )
+            os.write(fd, '%d\n' % os.getpid())
+            os.close(fd)
+            os.rename(tmp, self._stamp_path)
+        except OSError, e:
+            log.debug("Failed to update zfs inventory stamp: %s", e)
+            return None
+        return self._read_stamp()
+
+    def _load(self, rows, stamp):
+        keys = []
+        byname = {}
+        for row in rows:
+            byname[row[0]] = row
+            keys.append(self._key(row[0]))
+        keys.sort()
+        with self._lock:
+            self._keys = keys
+            self._rows = byname
+            self._stamp = stamp
+            self._updated = time.time()
+
+    def _refresh(self):
+        stamp = self._read_stamp()
+        self._load(self._exec([]), stamp)
+
+    def _revalidate(self):
+        try:
+            self._refresh()
+        except Exception:
+            log.warn("Failed to revalidate zfs inventory", exc_info=True)
+        finally:
+            self._revalidating = False
+
+    def _ensure(self):
+        stamp = self._read_stamp()
+        with self._lock:
+            age = time.time() - self._updated
+            if self._rows is None or stamp != self._stamp or (
+                age > self.max_stale
+            ):
+                self._refresh()
+            elif age > self.ttl and not self._revalidating:
+                self._revalidating = True
+                thread = threading.Thread(target=self._revalidate)
+                thread.daemon = True
+                thread.start()
+
+    def _subtree(self, key):
+        """
+        Slice of self._keys for a given dataset and all its descendants
+        """
+        start = bisect.bisect_left(self._keys, key)
+        end = start
+        depth = len(key)
+        while end < len(self._keys) and self._keys[end][:depth] == key:
+            end += 1
+        return start, end
+
+    def rows(self, path="", recursive=False, types=None):
+        """
+        Rows in the same format `zfs list -o space,refer,mountpoint,type`
+        would output them, as tuples
+        """
+        if not self.ttl:
+            args = [path] if path else []
+            return [
+                row for row in self._exec(args, recursive=recursive)
+                if not types or row[9] in types
+            ]
+        self._ensure()
+        with self._lock:
+            if not path:
+                keys = self._keys
+            elif recursive:
+                start, end = self._subtree(self._key(path))
+                keys = self._keys[start:end]
+            elif path in self._rows:
+                keys = [self._key(path)]
+            else:
+                keys = []
+            rows = []
+            for key in keys:
+                row = self._rows['/'.join(key)]
+                if not types or row[9] in types:
+                    rows.append(row)
+        return rows
+
+    def invalidate(self, path=None):
+        """
+        Refresh a dataset (including children and ancestors) after it has
+        been created, destroyed or had properties changed.
+
+        If path is omitted the whole inventory is thrown away.
+
+        The stamp is replaced even with the inventory cache disabled, the
+        navigation tree depends on it too.
+        """
+        if not self.ttl:
+            self._write_stamp()
+            return
+        if not path:
+            with self._lock:
+                self._rows = None
+            self._write_stamp()
+            return
+        path = path.split('@', 1)[0].rstrip('/')
+        key = self._key(path)
+        subtree = self._exec([path], recursive=True)
+        ancestors = self._exec([
+            '/'.join(key[:i]) for i in range(1, len(key))
+        ]) if len(key) > 1 else []
+        stamp = self._write_stamp()
+        with self._lock:
+            if self._rows is None:
+                return
+            start, end = self._subtree(key)
+            for old in self._keys[start:end]:
+                self._rows.pop('/'.join(old), None)
+            self._keys[start:end] = sorted(
+                self._key(row[0]) for row in subtree
+            )
+            for row in subtree:
+                self._rows[row[0]] = row
+            for row in ancestors:
+                if row[0] not in self._rows:
+                    bisect.insort(self._keys, self._key(row[0]))
+                self._rows[row[0]] = row
+            self._stamp = stamp
+
+
+inventory = ZFSInventory()
+
+
+def zfslist_from_rows(rows, hierarchical=False, include_root=False):
+    """
+    Build a ZFSList out of `zfs list -o space,refer,mountpoint,type` rows
+    """
     zfslist = ZFSList()
-    for line in zfs_output:
-        if not line:
-            continue
-        data = line.split('\t')
+    for data in rows:
         names = data[0].split('/')
         depth = len(names)
         # root filesystem is not treated as dataset by us
@@ -929,15 +1129,30 @@ def zfs_list(path="", recursive=False, hierarchical=False, include_root=False,
             zfslist.append(item)
             continue
 
-        parentds = zfslist.find(names, root=include_root)
+        parentds = zfslist.find(names[:-1], root=include_root)
         if parentds:
-            parentds.append(item)
+            zfslist.append_child(parentds, item)
         else:
             zfslist.append(item)
 
     return zfslist
 
 
+def zfs_list(path="", recursive=False, hierarchical=False, include_root=False,
+             types=None):
+    """
+    Return a dictionary that contains all ZFS dataset list and their
+    mountpoints
+
+    The listing is served from the process wide ZFSInventory.
+    """
+    return zfslist_from_rows(
+        inventory.rows(path, recursive=recursive, types=types),
+        hierarchical=hierarchical,
+        include_root=include_root,
+    )
+
+
 def list_datasets(path="", recursive=False, hierarchical=False,
                   include_root=False):
     return zfs_list(
@@ -949,6 +1164,57 @@ def list_datasets(path="", recursive=False, hierarchical=False,
     )
 
 
+def zfs_snapshot_iter(path=None, recursive=True, sort=None):
+    """
+    Generator over `zfs list -t snapshot` yielding (fullname, used, refer)
+    tuples as zfs writes them, so the listing is never held in memory
+
+    path may be a single dataset or a list of them, snapshots of children
+    datasets are only included if recursive is set.
+    sort is a list of zfs properties, prefixed with - for descending order,
+    handed down to zfs list as -s/-S.
+    """
+    args = [
+        "/sbin/zfs",
+        "list",
+        "-p",
+        "-H",
+        "-t", "snapshot",
+        "-o", "name,used,refer",
+    ]
+    for prop in sort or []:
+        if prop.startswith('-'):
+            args.extend(["-S", prop[1:]])
+        else:
+            args.extend(["-s", prop])
+
+    if path:
+        if isinstance(path, basestring):
+            path = [path]
+        if recursive:
+            args.append("-r")
+        else:
+            args.extend(["-d", "1"])
+        args.extend(path)
+
+    with open(os.devnull, 'w') as devnull:
+        zfsproc = subprocess.Popen(
+            args,
+            stdout=subprocess.PIPE,
+            stderr=devnull,
+            close_fds=True)
+    try:
+        for line in zfsproc.stdout:
+            data = line.rstrip('\n').split('\t')
+            if len(data) < 3:
+                continue
+            yield data[0], data[1], data[2]
+    finally:
+        if zfsproc.poll() is None:
+            zfsproc.kill()
+        zfsproc.wait()
+
+
 def zpool_list():
     zfsproc = subprocess.Popen([
         'zpool',
@@ -1,14 +1,13 @@
-import hashlib
 import logging
 import os
 import platform
 import requests
 import re
-import urllib2
 
 from django.utils.translation import ugettext as _
 
 from freenasUI.common import pbi
+from freenasUI.common.download import ParallelDownload
 from freenasUI.middleware.exceptions import MiddlewareError
 
 import platform as p
@@ -100,89 +99,37 @@ class Plugin(object):
         if not self.urls:
             raise ValueError("No mirrors available")
 
-        rv = False
-        for url in self.urls:
-            rpath = "%s/%s" % (url, self.file)
+        if not self.hash:
+            log.debug("No hash provided to validate download (%r)", self)
+
+        with open(PROGRESS_FILE, 'w') as f:
+
+            def progress(percent):
+                f.write("%d\n" % percent)
+                f.flush()
+
+            dl = ParallelDownload(
+                ["%s/%s" % (url, self.file) for url in self.urls],
+                path,
+                sha256=self.hash,
+                progress=progress,
+            )
             try:
-                rv = self.__download(rpath, path)
-                if rv:
-                    break
+                return dl.run()
             except Exception, e:
                 log.debug(
                     "Failed to download %s (%s): %s",
-                    url,
+                    self.file,
                     type(e).__class__,
                     e,
                 )
-                #FIXME: try to download from multiple urls
                 raise MiddlewareError(
                     _("Failed to download %(url)s: %(error)s" % {
-                        'url': url,
+                        'url': self.file,
                         'error': e,
                     })
                 )
 
-        return rv
-
-    def __download(self, url, path):
-        response = urllib2.urlopen(url)
-        try:
-            total_size = int(
-                response.info().getheader('Content-Length').strip()
-            )
-        except Exception, e:
-            log.debug(
-                "Error getting Content-Length header (%s): %s",
-                type(e).__class__,
-                e,
-            )
-            total_size = None
-
-        rv = True
-        csize = 20480
-        downloaded = 0
-        last_percent = 0
-
-        with open(path, 'wb+') as f, open(PROGRESS_FILE, 'w') as f2:
-
-            if total_size:
-                f2.write("0\n")
-                f2.flush()
-
-            while True:
-                chunk = response.read(csize)
-                if not chunk:
-                    break
-
-                f.write(chunk)
-
-                if total_size:
-                    downloaded += len(chunk)
-                    percent = float(downloaded) / total_size
-                    percent = round(percent * 100, 2)
-                    if int(percent) != last_percent:
-                        f2.write("%d\n" % percent)
-                        f2.flush()
-                    last_percent = int(percent)
-
-            if total_size and downloaded != total_size:
-                return False
-
-            if self.hash:
-                log.debug("No hash provided to validate download (%r)", self)
-                f.seek(0)
-                dohash = hashlib.sha256()
-                while True:
-                    chunk = f.read(csize)
-                    if not chunk:
-                        break
-                    dohash.update(chunk)
-                if dohash.hexdigest() != self.hash:
-                    log.debug("SHA256 failed for %s", url)
-                    return False
-
-        return rv
-
 
 class Available(object):
 
@@ -25,11 +25,17 @@
 #
 #####################################################################
 import glob
+import hashlib
 import logging
+import multiprocessing
 import os
+import Queue
 import re
 import tempfile
 import subprocess
+import threading
+import time
+from xml.etree import cElementTree as etree
 
 from freenasUI.common.pipesubr import pipeopen
 
@@ -37,6 +43,93 @@ log = logging.getLogger('reporting.rrd')
 
 name2plugin = dict()
 
+# Rendered graphs, see GraphCache
+GRAPH_CACHE_PATH = '/var/tmp/.rrdgraphs'
+# collectd Interval, RRDs are not updated more often than this
+COLLECTD_STEP = 10
+# Re-render a graph at least this often even if its RRDs did not change,
+# the time axis still moves
+GRAPH_CACHE_MAXAGE = 300
+
+
+def lttb(times, values, threshold):
+    """
+    Largest-Triangle-Three-Buckets downsampling
+
+    Keeps the first and last point and, for every bucket in between, the
+    point forming the largest triangle with the point kept before it and
+    the average of the next bucket. Spikes survive, unlike averaging.
+    Unknown values are skipped.
+
+    Returns:
+        tuple of the times and values kept
+    """
+    points = [(t, v) for t, v in zip(times, values) if v is not None]
+    n = len(points)
+    if threshold >= n or threshold < 3:
+        return [p[0] for p in points], [p[1] for p in points]
+
+    sampled = [points[0]]
+    every = float(n - 2) / (threshold - 2)
+    a = 0
+    for i in xrange(threshold - 2):
+        nxt = points[int((i + 1) * every) + 1:int((i + 2) * every) + 1] or \
+            points[-1:]
+        avg_t = sum(p[0] for p in nxt) / float(len(nxt))
+        avg_v = sum(p[1] for p in nxt) / float(len(nxt))
+
+        at, av = points[a]
+        best = -1
+        for j in xrange(int(i * every) + 1, int((i + 1) * every) + 1):
+            t, v = points[j]
+            area = abs((at - avg_t) * (v - av) - (at - t) * (avg_v - av))
+            if area > best:
+                best = area
+                a = j
+        sampled.append(points[a])
+    sampled.append(points[-1])
+    return [p[0] for p in sampled], [p[1] for p in sampled]
+
+
+def minmax(times, values, threshold):
+    """
+    Keep the minimum and the maximum of threshold / 2 buckets, in time
+    order, so the envelope of the series is exact
+
+    Returns:
+        tuple of the times and values kept
+    """
+    n = len(times)
+    buckets = max(threshold // 2, 1)
+    if n <= threshold:
+        keep = [i for i in xrange(n) if values[i] is not None]
+    else:
+        keep = []
+        size = float(n) / buckets
+        for b in xrange(buckets):
+            bucket = [
+                i for i in xrange(int(b * size), int((b + 1) * size))
+                if values[i] is not None
+            ]
+            if not bucket:
+                continue
+            low = min(bucket, key=values.__getitem__)
+            high = max(bucket, key=values.__getitem__)
+            keep.extend(sorted(set([low, high])))
+    return [times[i] for i in keep], [values[i] for i in keep]
+
+
+DOWNSAMPLERS = {
+    'lttb': lttb,
+    'minmax': minmax,
+}
+
+
+def downsample(times, values, threshold, method='lttb'):
+    if method not in DOWNSAMPLERS:
+        raise ValueError("Unknown downsampling method: %s" % method)
+    return DOWNSAMPLERS[method](times, values, threshold)
+
 
 class RRDMeta(type):
 
@@ -64,14 +157,21 @@ class RRDBase(object):
     imgformat = 'PNG'
     unit = 'hourly'
     step = 0
+    width = None
+    height = None
 
-    def __init__(self, base_path, identifier=None, unit=None, step=None):
+    def __init__(self, base_path, identifier=None, unit=None, step=None,
+                 width=None, height=None):
         if identifier is not None:
             self.identifier = str(identifier)
         if unit is not None:
             self.unit = str(unit)
         if step is not None:
             self.step = int(step)
+        if width:
+            self.width = int(width)
+        if height:
+            self.height = int(height)
         self._base_path = base_path
         self.base_path = os.path.join(base_path, self.plugin)
 
@@ -98,6 +198,147 @@ class RRDBase(object):
     def get_identifiers(self):
         return None
 
+    def get_sources(self):
+        """
+        RRD files the graph is drawn from, as given to the DEFs
+        """
+        sources = []
+        for arg in self.graph():
+            if not arg.startswith('DEF:'):
+                continue
+            # DEF:<vname>=<rrdfile>:<ds-name>:<CF>
+            path = arg.split('=', 1)[1].rsplit(':', 2)[0]
+            if path not in sources:
+                sources.append(path)
+        return sources
+
+    def get_last_update(self):
+        """
+        Newest modification time of the graph sources, 0 if none exists
+        """
+        mtime = 0
+        for path in self.get_sources():
+            try:
+                mtime = max(mtime, os.stat(path).st_mtime)
+            except OSError:
+                pass
+        return mtime
+
+    def _timespan(self):
+        """
+        rrdtool --start and --end of the window given by unit and step
+        """
+        if self.step == 0:
+            endtime = 'now'
+        else:
+            endtime = 'now-%d%s' % (self.step, self.unit[0], )
+        return 'end-1%s' % (self.unit[0], ), endtime
+
+    def get_series(self):
+        """
+        xport arguments for the series the graph draws
+
+        Keeps the DEFs and CDEFs and turns every labeled LINE into an
+        XPORT. VDEFs are single values, xport takes none of them nor
+        anything computed from them (e.g. the uptime Maximum line).
+
+        Returns:
+            list of DEF/CDEF/XPORT arguments
+        """
+        defs = []
+        xports = []
+        dropped = set()
+        for arg in self.graph():
+            kind, rest = arg.split(':', 1)
+            if kind == 'DEF':
+                defs.append(arg)
+            elif kind == 'CDEF':
+                vname, expr = rest.split('=', 1)
+                if dropped.intersection(re.findall(r'[A-Za-z_]\w*', expr)):
+                    dropped.add(vname)
+                else:
+                    defs.append(arg)
+            elif kind == 'VDEF':
+                dropped.add(rest.split('=', 1)[0])
+            elif kind.startswith('LINE'):
+                # LINE<width>:<vname>[#color][:<legend>[:dashes]]
+                fields = re.split(r'(?<!\\):', rest)
+                vname = fields[0].split('#', 1)[0]
+                if len(fields) < 2 or vname in dropped:
+                    continue
+                label = fields[1].strip()
+                if label.endswith('\\:'):
+                    label = label[:-2]
+                if label:
+                    xports.append('XPORT:%s:%s' % (vname, label))
+        return defs + xports
+
+    def export(self, start=None, end=None, maxpoints=None, method='lttb'):
+        """
+        Call rrdxport for the series of the graph
+
+        Arguments:
+            start, end - rrdtool time specifications, the unit/step
+                         window by default
+            maxpoints - downsample each series to about that many points
+            method - lttb or minmax, see downsample
+
+        Returns:
+            dict with the window (start, end, step) and a list of series,
+            each a name and the times and values of its points. Unknown
+            values are None unless the series was downsampled, in which
+            case they are left out.
+        """
+        defstart, defend = self._timespan()
+        args = [
+            "/usr/local/bin/rrdtool",
+            "xport",
+            '--start', str(start or defstart),
+            '--end', str(end or defend),
+        ] + self.get_series()
+        proc = subprocess.Popen(
+            args,
+            stdout=subprocess.PIPE,
+            stdin=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+        )
+        out, err = proc.communicate()
+        if proc.returncode != 0:
+            raise ValueError("Failed to export graph: %s" % err.strip())
+
+        root = etree.fromstring(out)
+        meta = root.find('meta')
+        names = [e.text or '' for e in meta.find('legend')]
+        times = []
+        columns = [[] for name in names]
+        for row in root.find('data'):
+            times.append(int(row.findtext('t')))
+            for column, v in zip(columns, row.findall('v')):
+                v = float(v.text)
+                column.append(None if v != v else v)
+
+        series = []
+        for name, values in zip(names, columns):
+            if maxpoints:
+                ts, values = downsample(times, values, maxpoints, method)
+            else:
+                ts = times
+            series.append({
+                'name': name,
+                'times': ts,
+                'values': values,
+            })
+        return {
+            'plugin': self.plugin,
+            'identifier': self.identifier,
+            'title': self.get_title(),
+            'vertical_label': self.get_vertical_label(),
+            'start': int(meta.findtext('start')),
+            'end': int(meta.findtext('end')),
+            'step': int(meta.findtext('step')),
+            'series': series,
+        }
+
     def generate(self):
         """
         Call rrdgraph to generate the graph on a temp file
@@ -106,11 +347,7 @@ class RRDBase(object):
             str - path to the image
         """
 
-        starttime = '1%s' % (self.unit[0], )
-        if self.step == 0:
-            endtime = 'now'
-        else:
-            endtime = 'now-%d%s' % (self.step, self.unit[0], )
+        starttime, endtime = self._timespan()
 
         fh, path = tempfile.mkstemp()
         args = [
@@ -122,8 +359,12 @@ class RRDBase(object):
             '--title', str(self.get_title()),
             '--lower-limit', '0',
             '--end', endtime,
-            '--start', 'end-%s' % starttime, '-b', '1024',
+            '--start', starttime, '-b', '1024',
         ]
+        if self.width:
+            args.extend(['--width', str(self.width)])
+        if self.height:
+            args.extend(['--height', str(self.height)])
         args.extend(self.graph())
         # rrdtool python is suffering from some sort of threading locking issue
         # See #3478
@@ -140,6 +381,161 @@ class RRDBase(object):
         return fh, path
 
 
+class GraphCache(object):
+    """
+    Rendered graphs on disk
+
+    A graph is kept per plugin, identifier, unit, step and size, along
+    with the version of its data: the newest modification time of its
+    RRD files bucketed to the collectd step. As long as none of the
+    files changed since it was rendered (and it is not older than
+    maxage) the image is served as is instead of running rrdtool again.
+    The files are shared by all the processes serving the GUI.
+    """
+
+    def __init__(self, path=GRAPH_CACHE_PATH, step=COLLECTD_STEP,
+                 maxage=GRAPH_CACHE_MAXAGE):
+        self.path = path
+        self.step = step
+        self.maxage = maxage
+
+    def key(self, plugin):
+        return hashlib.sha1('|'.join([
+            plugin.plugin,
+            str(plugin.identifier),
+            plugin.unit,
+            str(plugin.step),
+            '%sx%s' % (plugin.width, plugin.height),
+        ])).hexdigest()
+
+    def version(self, plugin):
+        """
+        Returns:
+            tuple of the data version and the newest RRD modification
+            time
+        """
+        mtime = plugin.get_last_update()
+        return int(mtime // self.step), mtime
+
+    def etag(self, plugin, version=None):
+        """
+        Arguments:
+            version - what version() returned, to not stat the RRD
+                      files again
+        """
+        if version is None:
+            version = self.version(plugin)
+        return '"%s-%d"' % (self.key(plugin), version[0])
+
+    def _file(self, key, version):
+        return os.path.join(self.path, '%s-%d' % (key, version))
+
+    def get(self, plugin, version=None):
+        """
+        The rendered graph, from the cache if it is still current
+
+        Arguments:
+            version - what version() returned, to not stat the RRD
+                      files again
+
+        Returns:
+            tuple of the image data, its ETag and the newest RRD
+            modification time
+        """
+        key = self.key(plugin)
+        if version is None:
+            version = self.version(plugin)
+        version, mtime = version
+        path = self._file(key, version)
+        etag = '"%s-%d"' % (key, version)
+
+        try:
+            if time.time() - os.stat(path).st_mtime < self.maxage:
+                with open(path, 'rb') as f:
+                    return f.read(), etag, mtime
+        except (IOError, OSError):
+            pass
+
+        fd, tmp = plugin.generate()
+        try:
+            with open(tmp, 'rb') as f:
+                data = f.read()
+        finally:
+            try:
+                os.unlink(tmp)
+                os.close(fd)
+            except OSError, e:
+                log.warn("Failed to remove reporting temp file: %s", e)
+
+        # rrdtool failed, do not keep whatever it left behind
+        if not data:
+            return data, etag, mtime
+
+        try:
+            if not os.path.isdir(self.path):
+                os.makedirs(self.path)
+            # Other versions of this graph are stale from now on
+            for old in glob.glob(os.path.join(self.path, '%s-*' % key)):
+                os.unlink(old)
+            fd, tmp = tempfile.mkstemp(dir=self.path)
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            os.rename(tmp, path)
+        except (IOError, OSError), e:
+            log.debug("Failed to cache graph %s: %s", path, e)
+
+        return data, etag, mtime
+
+
+def render_many(plugins, cache=None, workers=None):
+    """
+    Render a number of graphs at once
+
+    Every graph is an rrdtool process of its own, a pool of threads
+    sized to the CPU count keeps that many of them running side by side
+    instead of one after the other.
+
+    Returns:
+        iterator of (index, result) in the order the graphs are done,
+        result being the GraphCache.get tuple or the exception raised
+    """
+    if cache is None:
+        cache = GraphCache()
+    if workers is None:
+        workers = multiprocessing.cpu_count()
+
+    pending = Queue.Queue()
+    for item in enumerate(plugins):
+        pending.put(item)
+    total = pending.qsize()
+    done = Queue.Queue()
+
+    def worker():
+        while True:
+            try:
+                i, plugin = pending.get_nowait()
+            except Queue.Empty:
+                return
+            try:
+                result = cache.get(plugin)
+            except Exception, e:
+                result = e
+            done.put((i, result))
+
+    threads = []
+    for i in xrange(max(min(workers, total), 1)):
+        thread = threading.Thread(target=worker)
+        thread.daemon = True
+        thread.start()
+        threads.append(thread)
+
+    for i in xrange(total):
+        yield done.get()
+
+    for thread in threads:
+        thread.join()
+
+
 class CPUPlugin(RRDBase):
 
     plugin = "aggregation-cpu-sum"
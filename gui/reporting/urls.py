@@ -39,4 +39,6 @@ urlpatterns = patterns('freenasUI.reporting.views',
     url(r'^partition/$', 'generic_graphs', {'names': ['df']}, name="reporting_partition"),
     url(r'^system/$', 'generic_graphs', {'names': ['processes', 'uptime']}, name="reporting_system"),
     url(r'^generate/$', 'generate', name="reporting_generate"),
+    url(r'^generate/batch/$', 'generate_many', name="reporting_generate_many"),
+    url(r'^export/$', 'export', name="reporting_export"),
 )
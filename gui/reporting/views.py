@@ -24,11 +24,15 @@
 # POSSIBILITY OF SUCH DAMAGE.
 #
 #####################################################################
+import base64
+import json
 import logging
-import os
 
-from django.http import HttpResponse
+from django.http import (
+    HttpResponse, HttpResponseNotModified, StreamingHttpResponse,
+)
 from django.shortcuts import render
+from django.utils.http import http_date, parse_http_date_safe
 
 from freenasUI.freeadmin.apppool import appPool
 from freenasUI.system.models import SystemDataset
@@ -38,6 +42,8 @@ RRD_BASE_PATH = "/var/db/collectd/rrd/localhost"
 
 log = logging.getLogger('reporting.views')
 
+graph_cache = rrd.GraphCache()
+
 
 def _get_rrd_path():
     # /var/db/collectd/rrd will be a symlink if using system dataset
@@ -103,20 +109,145 @@ def generate(request):
             base_path=_get_rrd_path(),
             unit=unit,
             step=step,
-            identifier=identifier
+            identifier=identifier,
+            width=request.GET.get("width"),
+            height=request.GET.get("height"),
         )
-        fd, path = plugin.generate()
-        with open(path, 'rb') as f:
-            data = f.read()
 
-        try:
-            os.unlink(path)
-            os.close(fd)
-        except OSError, e:
-            log.warn("Failed to remove reporting temp file: %s", e)
+        # Nothing changed since the client got the graph
+        version = graph_cache.version(plugin)
+        etag = graph_cache.etag(plugin, version)
+        if request.META.get('HTTP_IF_NONE_MATCH') == etag:
+            return HttpResponseNotModified()
+        since = parse_http_date_safe(
+            request.META.get('HTTP_IF_MODIFIED_SINCE', '')
+        )
+        if (
+            'HTTP_IF_NONE_MATCH' not in request.META and since and
+            int(version[1]) <= since
+        ):
+            return HttpResponseNotModified()
+
+        data, etag, mtime = graph_cache.get(plugin, version)
 
         response = HttpResponse(data)
         response['Content-type'] = 'image/png'
+        response['ETag'] = etag
+        if mtime:
+            response['Last-Modified'] = http_date(mtime)
         return response
     except Exception, e:
         log.debug("Failed to generate rrd graph: %s", e)
+
+
+def generate_many(request):
+    """
+    Render a batch of graphs at once, see rrd.render_many
+
+    POST (or GET):
+        graphs - JSON list of objects with plugin and optionally
+                 identifier, unit, step, width and height
+
+    Streams a JSON list with an entry per graph in the order they are
+    rendered: its index in the request, the ETag and the base64 PNG (or
+    an error).
+    """
+    try:
+        graphs = json.loads(
+            request.POST.get('graphs') or request.GET.get('graphs') or '[]'
+        )
+    except ValueError:
+        graphs = []
+
+    plugins = []
+    failed = []
+    for i, graph in enumerate(graphs):
+        try:
+            plugin = rrd.name2plugin[graph['plugin']]
+            plugins.append((i, plugin(
+                base_path=_get_rrd_path(),
+                unit=graph.get('unit', 'hourly'),
+                step=graph.get('step', 0),
+                identifier=graph.get('identifier'),
+                width=graph.get('width'),
+                height=graph.get('height'),
+            )))
+        except Exception, e:
+            log.debug("Invalid rrd graph %r: %s", graph, e)
+            failed.append({'index': i, 'error': 'Invalid graph'})
+
+    def stream():
+        yield '['
+        sep = ''
+        for entry in failed:
+            yield sep + json.dumps(entry, separators=(',', ':'))
+            sep = ','
+        results = rrd.render_many(
+            [plugin for i, plugin in plugins], cache=graph_cache,
+        )
+        for n, result in results:
+            entry = {'index': plugins[n][0]}
+            if isinstance(result, Exception) or not result[0]:
+                log.debug("Failed to generate rrd graph: %s", result)
+                entry['error'] = 'Failed to generate graph'
+            else:
+                entry['etag'] = result[1]
+                entry['image'] = base64.b64encode(result[0])
+            yield sep + json.dumps(entry, separators=(',', ':'))
+            sep = ','
+        yield ']'
+
+    return StreamingHttpResponse(stream(), content_type='application/json')
+
+
+def export(request):
+    """
+    Series of one or more graphs as JSON
+
+    GET:
+        graph - plugin[:identifier], may be given more than once
+        unit, step - window, same as generate
+        start, end - rrdtool time specifications, override unit/step
+        maxpoints - downsample every series to about that many points
+        method - downsampling method, lttb (default) or minmax
+
+    A graph which fails to export gets an error instead of its series.
+    """
+    maxpoints = request.GET.get("maxpoints")
+    try:
+        maxpoints = int(maxpoints) if maxpoints else None
+    except ValueError:
+        maxpoints = None
+    method = request.GET.get("method", "lttb")
+
+    graphs = []
+    for graph in request.GET.getlist("graph"):
+        name, identifier = (graph.split(':', 1) + [None])[:2]
+        try:
+            plugin = rrd.name2plugin.get(name)
+            if plugin is None:
+                raise ValueError("Unknown plugin: %s" % name)
+            plugin = plugin(
+                base_path=_get_rrd_path(),
+                unit=request.GET.get("unit", "hourly"),
+                step=request.GET.get("step", "0"),
+                identifier=identifier,
+            )
+            graphs.append(plugin.export(
+                start=request.GET.get("start"),
+                end=request.GET.get("end"),
+                maxpoints=maxpoints,
+                method=method,
+            ))
+        except Exception, e:
+            log.debug("Failed to export rrd graph: %s", e)
+            graphs.append({
+                'plugin': name,
+                'identifier': identifier,
+                'error': str(e),
+            })
+
+    return HttpResponse(
+        json.dumps(graphs, separators=(',', ':')),
+        content_type='application/json',
+    )
@@ -127,6 +127,7 @@ TEMPLATE_LOADERS = (
 )
 
 MIDDLEWARE_CLASSES = (
+    'freenasUI.freeadmin.middleware.PerfMiddleware',
     'django.middleware.common.CommonMiddleware',
     #'freenasUI.freeadmin.middleware.ProfileMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
@@ -163,6 +164,32 @@ LOCALE_PATHS = (
 
 SESSION_ENGINE = 'django.contrib.sessions.backends.file'
 
+# Seconds a cached `zfs list` is served before being revalidated in the
+# background (see middleware.zfs.ZFSInventory), 0 disables the cache
+ZFS_INVENTORY_TTL = 10
+
+# Replication tasks autorepl runs at once, in total and against the
+# same remote host
+REPLICATION_MAX_WORKERS = 4
+REPLICATION_MAX_PER_REMOTE = 1
+# Replication stream tuning, see common.replstream and
+# tools/bench_replstream.py. Resumable streams need `zfs receive -s`
+# support on the remote side.
+REPLICATION_BLOCKSIZE = 1024 * 1024
+REPLICATION_BUFFERSIZE = 64 * 1024 * 1024
+REPLICATION_COMPRESSION_LEVEL = None
+REPLICATION_RESUMABLE = False
+
+# diskinfo/smartctl probes run at once when taking the disk inventory
+# (see middleware.diskprobe)
+DISK_PROBE_WORKERS = 8
+
+# Requests taking longer than that many seconds are logged and listed by
+# /api/v1.0/system/perf/, a fraction PERF_SLOW_SAMPLE of them (see
+# freeadmin.middleware.PerfMiddleware)
+PERF_SLOW_REQUEST = 2.0
+PERF_SLOW_SAMPLE = 1.0
+
 DIR_BLACKLIST = [
     'templates',
     'fnstatic',
@@ -653,6 +653,11 @@ class ReplicationFAdmin(BaseFreeAdmin):
             'label': _('Status'),
             'sortable': False,
         })
+        columns.insert(4, {
+            'name': 'repl_lasttransfer',
+            'label': _('Last Transfer'),
+            'sortable': False,
+        })
         return columns
 
 
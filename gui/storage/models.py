@@ -30,6 +30,8 @@ import cPickle
 import logging
 import os
 import re
+import tempfile
+import threading
 import uuid
 
 from django.db import models, transaction
@@ -42,6 +44,25 @@ from freenasUI.freeadmin.models import Model, UserField
 
 log = logging.getLogger('storage.models')
 REPL_RESULTFILE = '/tmp/.repl-result'
+REPL_REMOTESNAPFILE = '/tmp/.repl-remotesnaps'
+REPL_STATSFILE = '/tmp/.repl-stats'
+# autorepl updates the remote snapshots from several threads
+_remote_snapshots_lock = threading.Lock()
+
+
+def repl_remote_snapshots():
+    """
+    Snapshots autorepl last saw on the remote side of replication tasks
+
+    Returns:
+        dict keyed by (remote host, port, remote dataset) with the set
+        of snapshot names (the part after the @) found there
+    """
+    try:
+        with open(REPL_REMOTESNAPFILE, 'rb') as f:
+            return cPickle.load(f)
+    except Exception:
+        return {}
 
 
 class Volume(Model):
@@ -928,6 +949,45 @@ class Replication(Model):
             self.repl_remote.ssh_remote_hostname,
             self.repl_zfs)
 
+    def remote_dataset(self, fs=None):
+        """
+        Name of the remote dataset a local dataset (repl_filesystem by
+        default) is received into
+        """
+        if fs is None:
+            fs = self.repl_filesystem
+        fs_split = fs.split('/')
+        if len(fs_split) > 1:
+            return "%s/%s" % (self.repl_zfs, "/".join(fs_split[1:]))
+        return self.repl_zfs
+
+    def remote_snapshots_key(self, fs=None):
+        return (
+            self.repl_remote.ssh_remote_hostname,
+            self.repl_remote.ssh_remote_port,
+            self.remote_dataset(fs),
+        )
+
+    def set_remote_snapshots(self, snapshots, add=False):
+        """
+        Record the snapshots known to exist on the remote dataset so
+        the snapshot list does not need to ask the remote side over ssh
+        """
+        key = self.remote_snapshots_key()
+        with _remote_snapshots_lock:
+            data = repl_remote_snapshots()
+            if add:
+                data.setdefault(key, set()).update(snapshots)
+            else:
+                data[key] = set(snapshots)
+            fd, tmp = tempfile.mkstemp(
+                dir=os.path.dirname(REPL_REMOTESNAPFILE),
+                prefix='.repl-remotesnaps',
+            )
+            with os.fdopen(fd, 'wb') as f:
+                cPickle.dump(data, f, cPickle.HIGHEST_PROTOCOL)
+            os.rename(tmp, REPL_REMOTESNAPFILE)
+
     @property
     def repl_lastresult(self):
         if not os.path.exists(REPL_RESULTFILE):
@@ -940,6 +1000,17 @@ class Replication(Model):
         except:
             return None
 
+    @property
+    def repl_laststats(self):
+        """
+        Size, duration and snapshot count of the last stream sent
+        """
+        try:
+            with open(REPL_STATSFILE, 'rb') as f:
+                return cPickle.load(f).get(self.id)
+        except Exception:
+            return None
+
     @property
     def status(self):
         progressfile = '/tmp/.repl_progress_%d' % self.id
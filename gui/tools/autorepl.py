@@ -29,8 +29,9 @@ import cPickle
 import datetime
 import logging
 import os
-import subprocess
 import sys
+import threading
+from collections import defaultdict
 
 sys.path.extend([
     '/usr/local/www',
@@ -43,11 +44,20 @@ os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'freenasUI.settings')
 from django.db.models.loading import cache
 cache.get_apps()
 
+from django.conf import settings
+from django.db import connection
+
 from freenasUI.freeadmin.apppool import appPool
-from freenasUI.storage.models import Replication, REPL_RESULTFILE
+from freenasUI.storage.models import (
+    Replication, REPL_RESULTFILE, REPL_STATSFILE,
+)
 from freenasUI.common.timesubr import isTimeBetween
 from freenasUI.common.pipesubr import pipeopen, system
 from freenasUI.common.locks import mntlock
+from freenasUI.common.replstream import (
+    BLOCKSIZE, BUFFERSIZE, ReplicationStream, compress_commands,
+    parse_resume_token, zfs_send_command,
+)
 from freenasUI.common.system import send_mail
 
 # DESIGN NOTES
@@ -124,15 +134,62 @@ try:
 except:
     results = {}
 
-# Traverse all replication tasks
-replication_tasks = Replication.objects.all()
-for replication in replication_tasks:
+# Per task transfer accounting of the last stream sent
+try:
+    with open(REPL_STATSFILE, 'rb') as f:
+        data = f.read()
+    stats = cPickle.loads(data)
+except:
+    stats = {}
+
+
+def stream_size(cmd):
+    """
+    Estimate how many bytes a zfs send will produce using a dry run
+    """
+    proc = pipeopen(' '.join(
+        ['/sbin/zfs', 'send', '-nP'] + [i for i in cmd[2:] if i != '-V']
+    ), debug)
+    output, error = proc.communicate()
+    for line in (output + error).split('\n'):
+        if line.startswith('size\t'):
+            try:
+                return int(line.split('\t')[1])
+            except ValueError:
+                pass
+    return None
+
+
+def remote_resume_token(sshcmd, remote_port, remote, remotefs):
+    """
+    Token of a partially received stream on the remote dataset, if any
+    """
+    rzfscmd = '"zfs get -H -o value receive_resume_token %s"' % (remotefs)
+    sshproc = pipeopen('%s -p %d %s %s' % (sshcmd, remote_port, remote, rzfscmd))
+    output = sshproc.communicate()[0].strip()
+    if sshproc.returncode or output in ('', '-'):
+        return None
+    return output
+
+
+def resume_target(token):
+    """
+    Local snapshot the stream of a resume token ends at
+    """
+    proc = pipeopen('/sbin/zfs send -nvt %s' % (token), debug)
+    output, error = proc.communicate()
+    if proc.returncode:
+        return None
+    return parse_resume_token(output + error)
+
+
+def replicate(replication, MNTLOCK):
     if not isTimeBetween(now, replication.repl_begin, replication.repl_end):
-        continue
+        return
 
     if not replication.repl_enabled:
         log.warn("%s replication not enabled" % replication)
-        continue
+        return
 
     remote = replication.repl_remote.ssh_remote_hostname.__str__()
     remote_port = replication.repl_remote.ssh_remote_port
@@ -168,26 +225,11 @@ for replication in replication_tasks:
             dedicateduser.encode('utf-8'),
             )
 
-    if replication.repl_userepl:
-        Rflag = '-R '
-    else:
-        Rflag = ''
-
     wanted_list = []
     known_latest_snapshot = ''
     expected_local_snapshot = ''
 
-    localfs_split = localfs.split('/')
-
-    if len(localfs_split) > 1:
-        remotefs_final = "%s/%s" % (remotefs, "/".join(localfs_split[1:]))
-        if len(localfs_split) > 2:
-            remotefs_parent = "%s/%s" % (remotefs, "/".join(localfs_split[1:-1]))
-        else:
-            remotefs_parent = "%s/%s" % (remotefs, localfs_split[1])
-    else:
-        remotefs_final = remotefs
-        remotefs_parent = remotefs
+    remotefs_final = replication.remote_dataset()
 
     # Test if there is work to do, if so, own them
     MNTLOCK.lock()
@@ -200,7 +242,7 @@ for replication in replication_tasks:
             error,
             ))
         MNTLOCK.unlock()
-        continue
+        return
     if output != '':
         snapshots_list = output.split('\n')
         snapshots_list.reverse()
@@ -246,15 +288,17 @@ for replication in replication_tasks:
 
     # If there is nothing to do, go through next replication entry
     if len(wanted_list) == 0:
-        continue
+        return
 
     if known_latest_snapshot != '' and not resetonce:
         # Check if it matches remote snapshot
-        rzfscmd = '"zfs list -Hr -o name -t snapshot -d 1 %s | tail -n 1 | cut -d@ -f2" || true' % (remotefs_final)
+        rzfscmd = '"zfs list -Hr -o name -t snapshot -d 1 %s | cut -d@ -f2" || true' % (remotefs_final)
         sshproc = pipeopen('%s -p %d %s %s' % (sshcmd, remote_port, remote, rzfscmd))
         output = sshproc.communicate()[0]
-        if output != '':
-            expected_local_snapshot = '%s@%s' % (localfs, output.split('\n')[0])
+        remote_snapshots = filter(None, output.split('\n'))
+        if remote_snapshots:
+            replication.set_remote_snapshots(remote_snapshots)
+            expected_local_snapshot = '%s@%s' % (localfs, remote_snapshots[-1])
             if expected_local_snapshot == last_snapshot:
                 # Accept: remote and local snapshots matches
                 log.debug("Found matching latest snapshot %s remotely" % (last_snapshot))
@@ -288,7 +332,7 @@ Hello,
                         """ % (localfs), interval=datetime.timedelta(hours=2), channel='autorepl')
                     MNTLOCK.unlock()
                     results[replication.id] = 'Remote system has diverged snapshots with us'
-                    continue
+                    return
                 MNTLOCK.unlock()
         elif sshproc.returncode == 0:
             log.log(logging.NOTICE, "Can not locate %s on remote system, starting from there" % (known_latest_snapshot))
@@ -309,95 +353,138 @@ Hello,
     have returned an error code of %d
                         """ % (localfs, sshcmd, sshproc.returncode,), interval=datetime.timedelta(hours=2), channel='autorepl')
             results[replication.id] = 'SSH Failed'
-            continue
+            return
 
     if resetonce:
         log.log(logging.NOTICE, "Destroying remote %s" % (remotefs_final))
         destroycmd = '%s -p %d %s /sbin/zfs destroy -rRf %s' % (sshcmd, remote_port, remote, remotefs_final)
         system(destroycmd)
+        replication.set_remote_snapshots([])
         known_latest_snapshot = ''
 
     last_snapshot = known_latest_snapshot
 
-    for snapname in wanted_list:
-        local_fs, local_snap = snapname.split('@')
-        if replication.repl_limit != 0:
-            limit = '/usr/local/bin/throttle -K %d | ' % replication.repl_limit
+    compress, decompress = compress_commands(
+        compression, getattr(settings, 'REPLICATION_COMPRESSION_LEVEL', None)
+    )
+    if decompress:
+        decompress = '%s | ' % ' '.join(decompress)
+    else:
+        decompress = ''
+    resumable = (
+        getattr(settings, 'REPLICATION_RESUMABLE', False) and
+        not replication.repl_userepl
+    )
+
+    # Send the wanted snapshots in as few streams as possible: a full
+    # stream of the first one if there is nothing on the remote side yet
+    # and then a single incremental (-I) stream up to the newest one,
+    # which carries every snapshot in between.
+    streams = []
+    resume_token = None
+    if resumable:
+        resume_token = remote_resume_token(
+            sshcmd, remote_port, remote, remotefs_final
+        )
+    if resume_token:
+        # A previous stream broke off, finish it before anything else
+        resume_snap = resume_target(resume_token)
+        if resume_snap in wanted_list:
+            log.info("Resuming interrupted replication of %s" % (resume_snap))
+            streams.append((last_snapshot, resume_snap, resume_token))
+            if resume_snap != wanted_list[-1]:
+                streams.append((resume_snap, wanted_list[-1], None))
         else:
-            limit = ''
-        cmd = ['/sbin/zfs', 'send', '-V']
-        if replication.repl_userepl:
-            cmd.append('-R')
+            log.warn("Discarding partial receive of %s on %s" % (resume_snap, remote))
+            system('%s -p %d %s "/sbin/zfs receive -A %s"' % (sshcmd, remote_port, remote, remotefs_final))
+    if not streams:
         if last_snapshot == '':
-            cmd.append(snapname)
+            streams.append(('', wanted_list[0], None))
+            if len(wanted_list) > 1:
+                streams.append((wanted_list[0], wanted_list[-1], None))
         else:
-            cmd.extend(['-I', last_snapshot, snapname])
-
-        progressfile = '/tmp/.repl_progress_%d' % replication.id
-        # subprocess.Popen does not handle large stream of data between
-        # processes very well, do it on our own
-        readfd, writefd = os.pipe()
-        zproc_pid = os.fork()
-        if zproc_pid == 0:
-            os.close(readfd)
-            os.dup2(writefd, 1)
-            os.close(writefd)
-            os.execv('/sbin/zfs', cmd)
-            # NOTREACHED
+            streams.append((last_snapshot, wanted_list[-1], None))
+
+    progressfile = '/tmp/.repl_progress_%d' % replication.id
+    tasklog = '%s-%d' % (templog, replication.id)
+    for fromsnap, snapname, token in streams:
+        local_fs, local_snap = snapname.split('@')
+        if fromsnap in wanted_list:
+            start = wanted_list.index(fromsnap) + 1
         else:
+            start = 0
+        sent_list = wanted_list[start:wanted_list.index(snapname) + 1]
+
+        size = stream_size(zfs_send_command(
+            snapname,
+            fromsnap=fromsnap,
+            replicate=replication.repl_userepl,
+            resume_token=token,
+            verbose=False,
+        ))
+
+        replcmd = '%s -p %d %s "%s/sbin/zfs receive %s-F -d %s && echo Succeeded"' % (sshcmd, remote_port, remote, decompress, '-s ' if resumable else '', remotefs)
+        stream = ReplicationStream(
+            zfs_send_command(
+                snapname,
+                fromsnap=fromsnap,
+                replicate=replication.repl_userepl,
+                resume_token=token,
+            ),
+            replcmd,
+            compress=compress,
+            blocksize=getattr(settings, 'REPLICATION_BLOCKSIZE', BLOCKSIZE),
+            buffersize=getattr(settings, 'REPLICATION_BUFFERSIZE', BUFFERSIZE),
+            limit=replication.repl_limit,
+        )
+        with open(tasklog, 'w+') as f:
+            stream.start(stdout=f)
             with open(progressfile, 'w') as f2:
-                f2.write(str(zproc_pid))
-            os.close(writefd)
-
-        if compression == 'pigz':
-            compress = '/usr/local/bin/pigz | '
-            decompress = '/usr/local/bin/pigz -d | '
-        elif compression == 'plzip':
-            compress = '/usr/local/bin/plzip | '
-            decompress = '/usr/local/bin/plzip -d | '
-        elif compression == 'lz4':
-            compress = '/usr/local/bin/lz4c | '
-            decompress = '/usr/local/bin/lz4c -d | '
-        else: #off
-            compress = ''
-            decompress = ''
-
-        replcmd = '%s%s/bin/dd obs=1m 2> /dev/null | /bin/dd obs=1m 2> /dev/null | %s -p %d %s "%s/sbin/zfs receive -F -d %s && echo Succeeded"' % (compress, limit, sshcmd, remote_port, remote, decompress, remotefs)
-        with open(templog, 'w+') as f:
-            readobj = os.fdopen(readfd, 'r', 0)
-            proc = subprocess.Popen(
-                replcmd,
-                shell=True,
-                stdin=readobj,
-                stdout=f,
-                stderr=subprocess.STDOUT,
-            )
-            proc.wait()
-            os.waitpid(zproc_pid, os.WNOHANG)
-            readobj.close()
+                f2.write(str(stream.sender.pid))
+            stream.wait()
             os.remove(progressfile)
             f.seek(0)
             msg = f.read().strip('\n').strip('\r')
-        os.remove(templog)
+        os.remove(tasklog)
+        elapsed = stream.elapsed
         log.debug("Replication result: %s" % (msg))
         msg = msg.replace('WARNING: enabled NONE cipher\n', '')
         results[replication.id] = msg
+        stats[replication.id] = {
+            'snapshot': snapname,
+            'snapshots': len(sent_list),
+            'bytes': size,
+            'seconds': elapsed,
+        }
+        if size is not None and elapsed > 0:
+            log.info("Sent %d snapshot(s) up to %s to %s: %d bytes in %.1fs (%.2f MB/s)" % (
+                len(sent_list), snapname, remote, size, elapsed,
+                size / elapsed / 1048576,
+            ))
 
         # Determine if the remote side have the snapshot we have now.
-        rzfscmd = '"zfs list -Hr -o name -t snapshot -d 1 %s | tail -n 1 | cut -d@ -f2"' % (remotefs_final)
+        rzfscmd = '"zfs list -Hr -o name -t snapshot -d 1 %s | cut -d@ -f2"' % (remotefs_final)
         sshproc = pipeopen('%s -p %d %s %s' % (sshcmd, remote_port, remote, rzfscmd))
         output = sshproc.communicate()[0]
-        if output != '':
-            remote_snap = output.split('\n')[0]
+        remote_snapshots = filter(None, output.split('\n'))
+        if remote_snapshots:
+            replication.set_remote_snapshots(remote_snapshots)
+            remote_snap = remote_snapshots[-1]
             if local_snap == remote_snap:
                 system('%s -p %d %s "/sbin/zfs inherit freenas:state %s@%s"' % (sshcmd, remote_port, remote, remotefs_final, remote_snap))
                 # system('%s -p %d %s "/sbin/zfs hold -r freenas:repl %s@%s"' % (sshcmd, remote_port, remote, remotefs_final, remote_snap))
                 # TODO: release all older snapshots
                 # Replication was successful, mark as such
                 MNTLOCK.lock()
+                # The previous latest snapshot and everything the stream
+                # carried before the newest one are no longer needed.
                 if last_snapshot != '':
-                    system('/sbin/zfs inherit freenas:state %s' % (last_snapshot))
-                    system('/sbin/zfs release -r freenas:repl %s' % (last_snapshot))
+                    released = [last_snapshot] + sent_list[:-1]
+                else:
+                    released = sent_list[:-1]
+                for snapshot in released:
+                    system('/sbin/zfs inherit freenas:state %s' % (snapshot))
+                    system('/sbin/zfs release -r freenas:repl %s' % (snapshot))
                 last_snapshot = snapname
                 system('/sbin/zfs set freenas:state=LATEST %s' % (last_snapshot))
                 #
@@ -420,6 +507,7 @@ Hello,
                     expected_local_snapshot = '%s@%s' % (localfs, output.split('\n')[0])
                     if expected_local_snapshot == snapname:
                         log.warn("Snapshot %s already exist on remote, marking as such" % (snapname))
+                        replication.set_remote_snapshots([local_snap], add=True)
                         system('%s -p %d %s "/sbin/zfs inherit -r freenas:state %s"' % (sshcmd, remote_port, remote, remotefs_final))
                         # Replication was successful, mark as such
                         MNTLOCK.lock()
@@ -439,7 +527,71 @@ Hello,
             """ % (localfs, remote, msg), interval=datetime.timedelta(hours=2), channel='autorepl')
         break
 
+
+def run_replications(tasks, max_workers, max_per_remote):
+    """
+    Run replication tasks in a pool of max_workers threads, never more
+    than max_per_remote of them against the same remote host at once,
+    so a slow target does not hold back every other replication.
+    """
+    pending = list(tasks)
+    running = defaultdict(int)
+    cond = threading.Condition()
+
+    def remote_key(replication):
+        return (
+            replication.repl_remote.ssh_remote_hostname,
+            replication.repl_remote.ssh_remote_port,
+        )
+
+    def next_task():
+        with cond:
+            while pending:
+                for i, replication in enumerate(pending):
+                    if running[remote_key(replication)] < max_per_remote:
+                        running[remote_key(replication)] += 1
+                        return pending.pop(i)
+                cond.wait()
+        return None
+
+    def worker():
+        # Each worker needs its own descriptor, flock(2) does not
+        # exclude holders of the same open file.
+        lock = mntlock()
+        try:
+            while True:
+                replication = next_task()
+                if replication is None:
+                    break
+                try:
+                    replicate(replication, lock)
+                except Exception:
+                    log.error("Replication %s failed", replication, exc_info=True)
+                finally:
+                    with cond:
+                        running[remote_key(replication)] -= 1
+                        cond.notify_all()
+        finally:
+            connection.close()
+
+    threads = []
+    for i in xrange(min(max(max_workers, 1), len(pending))):
+        thread = threading.Thread(target=worker)
+        thread.start()
+        threads.append(thread)
+    for thread in threads:
+        thread.join()
+
+
+run_replications(
+    Replication.objects.select_related('repl_remote'),
+    getattr(settings, 'REPLICATION_MAX_WORKERS', 4),
+    max(getattr(settings, 'REPLICATION_MAX_PER_REMOTE', 1), 1),
+)
+
 with open(REPL_RESULTFILE, 'w') as f:
     f.write(cPickle.dumps(results))
+with open(REPL_STATSFILE, 'w') as f:
+    f.write(cPickle.dumps(stats))
 os.remove('/var/run/autorepl.pid')
 log.debug("Autosnap replication finished")
@@ -29,6 +29,7 @@ import logging
 import os
 import re
 import sys
+import time as _time
 sys.path.append('/usr/local/www')
 sys.path.append('/usr/local/www/freenasUI')
 
@@ -61,6 +62,96 @@ MNTLOCK=mntlock()
 # Set to True if verbose log desired
 debug = False
 
+# Maximum number of snapshots handed to a single zfs get/destroy call
+GET_BATCH_SIZE = 1000
+DESTROY_BATCH_SIZE = 64
+
+
+def chunks(items, size):
+    for i in xrange(0, len(items), size):
+        yield items[i:i + size]
+
+
+class PhaseTimer(object):
+    """
+    Log how long each phase of the run took
+    """
+
+    def __init__(self, name, count=None):
+        self.name = name
+        self.count = count
+
+    def __enter__(self):
+        self.start = _time.time()
+        return self
+
+    def __exit__(self, typ, value, traceback):
+        elapsed = _time.time() - self.start
+        if self.count is None:
+            log.info("%s took %.3fs", self.name, elapsed)
+        else:
+            log.info("%s took %.3fs (%d snapshots)", self.name, elapsed,
+                     self.count)
+
+
+def take_snapshots(snapnames, recursive, replicated):
+    """
+    Take all snapshots atomically in a single zfs snapshot call
+
+    If that fails (e.g. one of them already exists) fall back to one call
+    per snapshot so the others still get taken.
+    Returns the list of snapshots taken.
+    """
+    flags = ''
+    if recursive:
+        flags += ' -r'
+    if replicated:
+        flags += ' -o freenas:state=NEW'
+
+    snapcmd = '/sbin/zfs snapshot%s %s' % (flags, ' '.join(snapnames))
+    proc = pipeopen(snapcmd, logger=log)
+    err = proc.communicate()[1]
+    if proc.returncode == 0:
+        return list(snapnames)
+    if len(snapnames) == 1:
+        log.error("Failed to create snapshot '%s': %s", snapnames[0], err)
+        return []
+
+    log.warn("Failed to create snapshots at once, retrying one by one: %s",
+             err)
+    taken = []
+    for snapname in snapnames:
+        proc = pipeopen('/sbin/zfs snapshot%s %s' % (flags, snapname),
+                        logger=log)
+        err = proc.communicate()[1]
+        if proc.returncode != 0:
+            log.error("Failed to create snapshot '%s': %s", snapname, err)
+        else:
+            taken.append(snapname)
+    return taken
+
+
+def destroy_snapshots(fs, snapnames):
+    """
+    Destroy snapshots of a dataset using the fs@snap1,snap2,... form
+
+    Returns the names of the snapshots which could not be destroyed
+    """
+    # snapshots with clones will have destruction deferred
+    snapcmd = '/sbin/zfs destroy -r -d %s@%s' % (fs, ','.join(snapnames))
+    proc = pipeopen(snapcmd, logger=log)
+    err = proc.communicate()[1]
+    if proc.returncode == 0:
+        return []
+    if len(snapnames) == 1:
+        log.error("Failed to destroy snapshot '%s@%s': %s",
+                  fs, snapnames[0], err)
+        return list(snapnames)
+    failed = []
+    for snapname in snapnames:
+        failed.extend(destroy_snapshots(fs, [snapname]))
+    return failed
+
 def snapinfodict2datetime(snapinfo):
     year = int(snapinfo['year'])
     month = int(snapinfo['month'])
@@ -180,8 +271,10 @@ if len(mp_to_task_map) > 0:
     # Grab all existing snapshot and filter out the expiring ones
     snapshots = {}
     snapshots_pending_delete = set()
-    zfsproc = pipeopen("/sbin/zfs list -t snapshot -H", debug, logger=log)
-    lines = zfsproc.communicate()[0].split('\n')
+    with PhaseTimer("Listing snapshots"):
+        zfsproc = pipeopen("/sbin/zfs list -t snapshot -H -o name", debug,
+                           logger=log)
+        lines = zfsproc.communicate()[0].split('\n')
     reg_autosnap = re.compile('^auto-(?P<year>\d{4})(?P<month>\d{2})(?P<day>\d{2}).(?P<hour>\d{2})(?P<minute>\d{2})-(?P<retcount>\d+)(?P<retunit>[hdwmy])$')
     for line in lines:
         if line != '':
@@ -220,54 +313,102 @@ if len(mp_to_task_map) > 0:
 
     snaptime_str = snaptime.strftime('%Y%m%d.%H%M')
 
+    # Snapshots taken in one go must be in the same pool and share flags
+    replicated_fs = set(Replication.objects.filter(
+        repl_enabled=True,
+    ).values_list('repl_filesystem', flat=True))
+    snapgroups = {}
     for mpkey, tasklist in mp_to_task_map.items():
         fs, expire = mpkey
         recursive = False
         for task in tasklist:
             if task.task_recursive == True:
                 recursive = True
-        if recursive == True:
-            rflag = ' -r'
-        else:
-            rflag = ''
 
         snapname = '%s@auto-%s-%s' % (fs, snaptime_str, expire)
 
         # If there is associated replication task, mark the snapshots as 'NEW'.
-        if Replication.objects.filter(repl_filesystem=fs, repl_enabled=True).count() > 0:
-            MNTLOCK.lock()
-            snapcmd = '/sbin/zfs snapshot%s -o freenas:state=NEW %s' % (rflag, snapname)
-            proc = pipeopen(snapcmd, logger=log)
-            err = proc.communicate()[1]
-            if proc.returncode != 0:
-                log.error("Failed to create snapshot '%s': %s", snapname, err)
-            # Take a hold on snapshots.
-            holdcmd = '/sbin/zfs hold%s freenas:repl %s' % (rflag, snapname)
-            proc = pipeopen(holdcmd, logger=log)
-            err = proc.communicate()[1]
-            if proc.returncode != 0:
-                log.error("Failed to create snapshot '%s': %s", snapname, err)
-            MNTLOCK.unlock()
-        else:
-            snapcmd = '/sbin/zfs snapshot%s %s' % (rflag, snapname)
-            proc = pipeopen(snapcmd, logger=log)
-            err = proc.communicate()[1]
-            if proc.returncode != 0:
-                log.error("Failed to create snapshot '%s': %s", snapname, err)
+        replicated = fs in replicated_fs
+        snapgroups.setdefault(
+            (fs.split('/')[0], recursive, replicated), []
+        ).append(snapname)
+
+    with PhaseTimer("Creating snapshots", len(mp_to_task_map)):
+        for (pool, recursive, replicated), snapnames in snapgroups.items():
+            if replicated:
+                MNTLOCK.lock()
+                with PhaseTimer("Creating replicated snapshots under lock"):
+                    taken = take_snapshots(snapnames, recursive, True)
+                    # Take a hold on snapshots.
+                    if taken:
+                        holdcmd = '/sbin/zfs hold%s freenas:repl %s' % (
+                            ' -r' if recursive else '',
+                            ' '.join(taken),
+                        )
+                        proc = pipeopen(holdcmd, logger=log)
+                        err = proc.communicate()[1]
+                        if proc.returncode != 0:
+                            log.error("Failed to hold snapshots '%s': %s",
+                                      ' '.join(taken), err)
+                MNTLOCK.unlock()
+            else:
+                take_snapshots(snapnames, recursive, False)
 
     MNTLOCK.lock()
-    for snapshot in snapshots_pending_delete:
+    with PhaseTimer("Destroying snapshots under lock"):
         # TODO: Future versions will have freenas:state removed in favor of holds.
-        zfsproc = pipeopen('/sbin/zfs get -H freenas:state %s' % (snapshot, ), logger=log)
-        output = zfsproc.communicate()[0]
-        if output != '':
-            fsname, attrname, value, source = output.split('\n')[0].split('\t')
-            if value == '-':
-                snapcmd = '/sbin/zfs destroy -r -d %s' % (snapshot) #snapshots with clones will have destruction deferred
-                proc = pipeopen(snapcmd, logger=log)
-                err = proc.communicate()[1]
-                if proc.returncode != 0:
-                    log.error("Failed to destroy snapshot '%s': %s", snapshot, err)
+        states = {}
+        with PhaseTimer("Getting state", len(snapshots_pending_delete)):
+            for chunk in chunks(sorted(snapshots_pending_delete),
+                                GET_BATCH_SIZE):
+                zfsproc = pipeopen(
+                    '/sbin/zfs get -H -o name,value freenas:state %s' % (
+                        ' '.join(chunk),
+                    ),
+                    logger=log,
+                )
+                output = zfsproc.communicate()[0]
+                for line in output.split('\n'):
+                    if line != '':
+                        name, value = line.split('\t')
+                        states[name] = value
+
+        to_destroy = {}
+        skipped = {}
+        for snapshot in snapshots_pending_delete:
+            if states.get(snapshot) != '-':
+                continue
+            fs, snapname = snapshot.split('@')
+            # Already taken care of by the recursive destroy of a parent
+            parts = fs.split('/')
+            parents = [
+                '%s@%s' % ('/'.join(parts[:i]), snapname)
+                for i in xrange(1, len(parts))
+            ]
+            parents = [p for p in parents if states.get(p) == '-']
+            if parents:
+                skipped[snapshot] = parents
+                continue
+            to_destroy.setdefault(fs, []).append(snapname)
+
+        with PhaseTimer(
+            "Destroying", sum(len(i) for i in to_destroy.values())
+        ):
+            failed = set()
+            for fs, snapnames in sorted(to_destroy.items()):
+                for chunk in chunks(sorted(snapnames), DESTROY_BATCH_SIZE):
+                    failed.update(
+                        '%s@%s' % (fs, snapname)
+                        for snapname in destroy_snapshots(fs, chunk)
+                    )
+
+            # The recursive destroy of every parent failed (e.g. a hold),
+            # parents first so a child is left alone once one succeeded
+            for snapshot in sorted(skipped, key=lambda s: s.count('/')):
+                if failed.issuperset(skipped[snapshot]):
+                    fs, snapname = snapshot.split('@')
+                    if destroy_snapshots(fs, [snapname]):
+                        failed.add(snapshot)
     MNTLOCK.unlock()
 
 
@@ -0,0 +1,228 @@
+#!/usr/bin/env python
+#-
+# Copyright (c) 2015 iXsystems, Inc.
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR AND CONTRIBUTORS ``AS IS'' AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE AUTHOR OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS
+# OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY
+# OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF
+# SUCH DAMAGE.
+#
+"""
+Exercise common.download against local HTTP mirrors
+
+Every mirror is a threaded HTTP server on localhost serving the same
+random file with range support, rate limited per connection so the gain
+of spreading the download shows. Covers a single mirror against all of
+them, a broken mirror, a mirror without range support, resuming an
+interrupted download and a SHA-256 mismatch.
+"""
+
+import BaseHTTPServer
+import SocketServer
+import argparse
+import hashlib
+import os
+import re
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+HERE = os.path.abspath(os.path.dirname(__file__))
+sys.path.append(os.path.join(HERE, ".."))
+sys.path.append(os.path.join(HERE, "../.."))
+sys.path.append('/usr/local/www')
+sys.path.append('/usr/local/www/freenasUI')
+
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'freenasUI.settings')
+
+from freenasUI.common.download import DownloadError, ParallelDownload
+
+
+class Mirror(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """
+    Arguments:
+        data - the file served
+        rate - bytes per second per connection, 0 for no limit
+        ranges - honor Range headers
+        broken - answer everything with a 500
+        cut - close connections once that many bytes were served in
+              total, 0 for never
+    """
+    daemon_threads = True
+    running = []
+
+    def __init__(self, data, rate=0, ranges=True, broken=False, cut=0):
+        BaseHTTPServer.HTTPServer.__init__(
+            self, ('127.0.0.1', 0), MirrorHandler
+        )
+        self.data = data
+        self.rate = rate
+        self.ranges = ranges
+        self.broken = broken
+        self.cut = cut
+        self.served = 0
+        self.lock = threading.Lock()
+        self.thread = threading.Thread(target=self.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        Mirror.running.append(self)
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+        self.thread.join()
+
+    def handle_error(self, request, client_address):
+        # Clients closing the connection early is part of the exercise
+        pass
+
+    @property
+    def url(self):
+        return "http://127.0.0.1:%d/file.pbi" % self.server_address[1]
+
+
+class MirrorHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        server = self.server
+        if server.broken:
+            self.send_error(500)
+            return
+
+        data = server.data
+        start, end = 0, len(data)
+        m = re.match(r'bytes=(\d+)-(\d*)$', self.headers.get('Range', ''))
+        if m and server.ranges:
+            start = int(m.group(1))
+            if m.group(2):
+                end = min(int(m.group(2)) + 1, len(data))
+            self.send_response(206)
+            self.send_header('Content-Range', 'bytes %d-%d/%d' % (
+                start, end - 1, len(data),
+            ))
+        else:
+            self.send_response(200)
+        self.send_header('Content-Length', str(end - start))
+        self.end_headers()
+
+        sent = 0
+        began = time.time()
+        pos = start
+        while pos < end:
+            block = data[pos:min(pos + 16384, end)]
+            if server.cut and server.served + len(block) > server.cut:
+                return
+            self.wfile.write(block)
+            pos += len(block)
+            sent += len(block)
+            with server.lock:
+                server.served += len(block)
+            if server.rate:
+                ahead = float(sent) / server.rate - (time.time() - began)
+                if ahead > 0:
+                    time.sleep(ahead)
+
+
+def check(label, condition):
+    print "%-48s %s" % (label, "ok" if condition else "FAILED")
+    return condition
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Exercise ParallelDownload.')
+    parser.add_argument('-s', '--size', type=int, default=32,
+        help='file size in MiB')
+    parser.add_argument('-m', '--mirrors', type=int, default=3,
+        help='number of mirrors')
+    parser.add_argument('-r', '--rate', type=int, default=4096,
+        help='KiB/s per connection, 0 for no limit')
+    args = parser.parse_args()
+
+    data = os.urandom(args.size * 1024 * 1024)
+    digest = hashlib.sha256(data).hexdigest()
+    rate = args.rate * 1024
+    tmpdir = tempfile.mkdtemp()
+    path = os.path.join(tmpdir, 'file.pbi')
+    ok = True
+
+    def fetch(mirrors, sha256=digest):
+        if os.path.exists(path):
+            os.unlink(path)
+        start = time.time()
+        rv = ParallelDownload(
+            [m.url for m in mirrors], path, sha256=sha256,
+            segment=1024 * 1024,
+        ).run()
+        return rv, time.time() - start
+
+    def same():
+        with open(path, 'rb') as f:
+            return f.read() == data
+
+    try:
+        mirrors = [Mirror(data, rate) for i in xrange(args.mirrors)]
+
+        rv, single = fetch(mirrors[:1])
+        ok &= check("single mirror (%.2fs)" % single, rv and same())
+
+        rv, elapsed = fetch(mirrors)
+        ok &= check("%d mirrors (%.2fs, %.1fx)" % (
+            len(mirrors), elapsed, single / elapsed,
+        ), rv and same())
+
+        rv, elapsed = fetch([Mirror(data, broken=True)] + mirrors)
+        ok &= check("broken mirror first (%.2fs)" % elapsed, rv and same())
+
+        rv, elapsed = fetch([Mirror(data, rate, ranges=False)] + mirrors)
+        ok &= check("no range support (%.2fs)" % elapsed, rv and same())
+
+        cut = Mirror(data, rate, cut=len(data) / 8)
+        try:
+            fetch([cut])
+            ok &= check("interrupted download fails", False)
+        except DownloadError:
+            ok &= check("interrupted download fails", True)
+        ok &= check("progress kept", os.path.exists(path + ".state"))
+        cut.cut = 0
+        cut.served = 0
+        rv, elapsed = fetch([cut])
+        ok &= check("resumed (%d%% left to fetch)" % (
+            cut.served * 100 / len(data),
+        ), rv and same() and cut.served < len(data))
+
+        rv, elapsed = fetch(mirrors, sha256='0' * 64)
+        ok &= check("sha256 mismatch", not rv and not any(
+            os.path.exists(p) for p in (path, path + ".part", path + ".state")
+        ))
+    finally:
+        for mirror in Mirror.running:
+            mirror.stop()
+        shutil.rmtree(tmpdir)
+
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == "__main__":
+    main()
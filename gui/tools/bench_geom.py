@@ -0,0 +1,342 @@
+#!/usr/bin/env python
+#-
+# Copyright (c) 2015 iXsystems, Inc.
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR AND CONTRIBUTORS ``AS IS'' AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE AUTHOR OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS
+# OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY
+# OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF
+# SUCH DAMAGE.
+#
+"""
+Benchmark GEOM lookups against a synthetic kern.geom.confxml
+
+The tree mimics a large JBOD: every disk carries a GPT with a swap and
+a ZFS partition, gptid labels and DEV nodes, the swap is GELI encrypted
+and some of the disks are paths of a gmultipath. The XPath queries the
+notifier used to run per disk are timed against GeomTopology, and the
+results of both are compared.
+"""
+
+import argparse
+import os
+import sys
+import time
+import uuid
+
+HERE = os.path.abspath(os.path.dirname(__file__))
+sys.path.append(os.path.join(HERE, ".."))
+sys.path.append(os.path.join(HERE, "../.."))
+sys.path.append('/usr/local/www')
+sys.path.append('/usr/local/www/freenasUI')
+
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'freenasUI.settings')
+
+from lxml import etree
+
+from freenasUI.middleware.geom import GeomTopology
+
+
+class Mesh(object):
+
+    def __init__(self):
+        self.ids = 0
+        self.classes = {}
+
+    def id(self):
+        self.ids += 1
+        return '0x%x' % (0xfffff80000000000 + self.ids * 0x100)
+
+    def cls(self, name):
+        if name not in self.classes:
+            self.classes[name] = {'id': self.id(), 'geoms': []}
+        return self.classes[name]
+
+    def geom(self, cname, name, consumes=(), providers=(), config=None):
+        """
+        Returns the ids of the providers of the new geom
+        """
+        cls = self.cls(cname)
+        geom = {
+            'id': self.id(), 'name': name, 'config': config or {},
+            'consumers': [(self.id(), ref) for ref in consumes],
+            'providers': [],
+        }
+        for pname, pconfig in providers:
+            geom['providers'].append((self.id(), pname, pconfig))
+        cls['geoms'].append(geom)
+        return [p[0] for p in geom['providers']]
+
+    def xml(self):
+        out = ['<mesh>']
+        for cname in ('DISK', 'MULTIPATH', 'PART', 'ELI', 'LABEL', 'DEV'):
+            cls = self.classes.get(cname)
+            if cls is None:
+                continue
+            out.append('<class id="%s"><name>%s</name>' % (cls['id'], cname))
+            for geom in cls['geoms']:
+                out.append(
+                    '<geom id="%s"><class ref="%s"/><name>%s</name>'
+                    '<rank>1</rank>' % (geom['id'], cls['id'], geom['name'])
+                )
+                out.append('<config>%s</config>' % ''.join(
+                    '<%s>%s</%s>' % (k, v, k)
+                    for k, v in sorted(geom['config'].items())
+                ))
+                for cid, ref in geom['consumers']:
+                    out.append(
+                        '<consumer id="%s"><geom ref="%s"/>'
+                        '<provider ref="%s"/><mode>r1w1e1</mode>'
+                        '</consumer>' % (cid, geom['id'], ref)
+                    )
+                for pid, pname, pconfig in geom['providers']:
+                    pconfig = dict(pconfig)
+                    mediasize = pconfig.pop('mediasize', 4000787030016)
+                    out.append(
+                        '<provider id="%s"><geom ref="%s"/>'
+                        '<mode>r1w1e1</mode><name>%s</name>'
+                        '<mediasize>%d</mediasize><sectorsize>512'
+                        '</sectorsize><config>%s</config></provider>' % (
+                            pid, geom['id'], pname, mediasize, ''.join(
+                                '<%s>%s</%s>' % (k, v, k)
+                                for k, v in sorted(pconfig.items())
+                            ))
+                    )
+                out.append('</geom>')
+            out.append('</class>')
+        out.append('</mesh>')
+        return ''.join(out)
+
+
+def synthetic_confxml(count, multipath=0):
+    """
+    Returns:
+        tuple of the confxml text and the names of the disks, partitions
+        and gptid labels in it
+    """
+    mesh = Mesh()
+    disks, parts, labels = [], [], []
+    paths = []
+    for i in xrange(count):
+        name = 'da%d' % i
+        disk = mesh.geom('DISK', name, providers=[(name, {
+            'lunid': '5000c500%08x' % i,
+            'ident': 'Z1Z%05d' % i,
+        })])
+        mesh.geom('DEV', name, consumes=disk)
+        if i < multipath * 2:
+            paths.append((name, disk[0]))
+            continue
+        disks.append(name)
+        swap, data = mesh.geom('PART', name, consumes=disk, providers=[
+            ('%sp1' % name, {
+                'type': 'freebsd-swap', 'index': 1,
+                'rawuuid': uuid.uuid4(), 'mediasize': 2147483648,
+            }),
+            ('%sp2' % name, {
+                'type': 'freebsd-zfs', 'index': 2,
+                'rawuuid': uuid.uuid4(), 'mediasize': 3998639546368,
+            }),
+        ], config={'scheme': 'GPT'})
+        eli = mesh.geom('ELI', '%sp1.eli' % name, consumes=[swap],
+            providers=[('%sp1.eli' % name, {'mediasize': 2147483648})])
+        mesh.geom('DEV', '%sp1.eli' % name, consumes=eli)
+        for pid, pname in ((swap, '%sp1' % name), (data, '%sp2' % name)):
+            label = 'gptid/%s' % uuid.uuid4()
+            mesh.geom('LABEL', pname, consumes=[pid],
+                providers=[(label, {})])
+            mesh.geom('DEV', pname, consumes=[pid])
+            parts.append(pname)
+            labels.append(label)
+    for i in xrange(0, len(paths), 2):
+        mesh.geom('MULTIPATH', 'disk%d' % (i / 2 + 1),
+            consumes=[paths[i][1], paths[i + 1][1]],
+            providers=[('multipath/disk%d' % (i / 2 + 1), {})],
+            config={'State': 'OPTIMAL'})
+    return mesh.xml(), disks, parts, labels
+
+
+# The queries notifier ran before GeomTopology
+
+
+def xpath_mediasize(doc, disk):
+    mediasize = doc.xpath("//class[name = 'DISK']//geom[name = '%s']/provider/mediasize" % disk)
+    if mediasize:
+        return mediasize[0].text
+
+
+def xpath_device_to_identifier(doc, name):
+    search = doc.xpath("//class[name = 'PART']/..//*[name = '%s']//config[type = 'freebsd-zfs']/rawuuid" % name)
+    if len(search) > 0:
+        return "{uuid}%s" % search[0].text
+    search = doc.xpath("//class[name = 'PART']/geom/..//*[name = '%s']//config[type = 'freebsd-ufs']/rawuuid" % name)
+    if len(search) > 0:
+        return "{uuid}%s" % search[0].text
+    search = doc.xpath("//class[name = 'LABEL']/geom[name = '%s']/provider/name" % name)
+    if len(search) > 0:
+        return "{label}%s" % search[0].text
+    search = doc.xpath("//class[name = 'DEV']/geom[name = '%s']" % name)
+    if len(search) > 0:
+        return "{devicename}%s" % name
+    return ''
+
+
+def xpath_identifier_to_device(doc, ident):
+    value = ident.split('}', 1)[1]
+    search = doc.xpath("//class[name = 'PART']/geom//config[rawuuid = '%s']/../../name" % value)
+    for entry in search:
+        if not entry.text.startswith('label'):
+            return entry.text
+    return None
+
+
+def xpath_label_to_disk(doc, name):
+    search = doc.xpath("//class[name = 'LABEL']//provider[name = '%s']/../consumer/provider/@ref" % name)
+    if len(search) > 0:
+        provider = search[0]
+    else:
+        search = doc.xpath("//class[name = 'DEV']/geom[name = '%s']//provider/@ref" % name)
+        if len(search) > 0:
+            provider = search[0]
+        else:
+            return None
+    search = doc.xpath("//provider[@id = '%s']/../name" % provider)
+    disk = search[0].text
+    if search[0].getparent().getparent().xpath("./name")[0].text in ('ELI', ):
+        return xpath_label_to_disk(doc, disk.replace(".eli", ""))
+    return disk
+
+
+def xpath_multipath_disks(doc):
+    disks = []
+    for geom in doc.xpath("//class[name = 'MULTIPATH']/geom"):
+        for provref in geom.xpath("./consumer/provider/@ref"):
+            prov = doc.xpath("//provider[@id = '%s']" % provref)[0]
+            if prov.xpath("../../name")[0].text == 'DISK':
+                disks.append(prov.xpath("../name")[0].text)
+    return disks
+
+
+def topology_device_to_identifier(geom, name):
+    # Same as notifier.device_to_identifier, without the serial number
+    for ptype in ('freebsd-zfs', 'freebsd-ufs'):
+        part = geom.partition_of_type(name, ptype)
+        if part is not None and part.find('config/rawuuid') is not None:
+            return "{uuid}%s" % part.findtext('config/rawuuid')
+    label = geom.geom('LABEL', name)
+    if label is not None and label.find('provider') is not None:
+        return "{label}%s" % label.findtext('provider/name')
+    if geom.geom('DEV', name) is not None:
+        return "{devicename}%s" % name
+    return ''
+
+
+def topology_identifier_to_device(geom, ident):
+    for name in geom.partitioned_by_rawuuid(ident.split('}', 1)[1]):
+        if not name.startswith('label'):
+            return name
+    return None
+
+
+def topology_multipath_disks(geom):
+    disks = []
+    for mp in geom.geoms('MULTIPATH'):
+        for prov in geom.consumed(mp):
+            if geom.class_of(prov) == 'DISK':
+                disks.append(prov.getparent().findtext('name'))
+    return disks
+
+
+def timed(label, func, *args):
+    start = time.time()
+    result = func(*args)
+    return label, time.time() - start, result
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Benchmark GEOM lookups against a synthetic confxml.')
+    parser.add_argument('-n', '--disks', type=int, default=500)
+    parser.add_argument('-m', '--multipath', type=int, default=0,
+        help='number of two path multipath disks among them')
+    parser.add_argument('--xml',
+        help='use this confxml (sysctl -n kern.geom.confxml) instead')
+    args = parser.parse_args()
+
+    if args.xml:
+        with open(args.xml) as f:
+            text = f.read()
+        doc = etree.fromstring(text)
+        disks = [g.findtext('name') for g in doc.xpath(
+            "//class[name = 'PART']/geom")]
+        parts = [p.findtext('name') for p in doc.xpath(
+            "//class[name = 'PART']/geom/provider")]
+        labels = [p.findtext('name') for p in doc.xpath(
+            "//class[name = 'LABEL']/geom/provider")]
+    else:
+        text, disks, parts, labels = synthetic_confxml(
+            args.disks, args.multipath)
+
+    start = time.time()
+    doc = etree.fromstring(text)
+    parsed = time.time() - start
+    start = time.time()
+    geom = GeomTopology(doc)
+    indexed = time.time() - start
+
+    print "%d bytes, %d disks, %d partitions, %d labels" % (
+        len(text), len(disks), len(parts), len(labels))
+    print "parse %.3fs, index %.3fs" % (parsed, indexed)
+    print
+
+    idents = [xpath_device_to_identifier(doc, d) for d in disks]
+    cases = [
+        ('mediasize (sync_disks)', disks,
+            xpath_mediasize, lambda g, d: g.mediasize(d)),
+        ('device_to_identifier', disks,
+            xpath_device_to_identifier, topology_device_to_identifier),
+        ('identifier_to_device', idents,
+            xpath_identifier_to_device, topology_identifier_to_device),
+        ('label_to_disk', labels,
+            xpath_label_to_disk, lambda g, l: g.label_to_disk(l)),
+    ]
+
+    print "%-24s %8s %10s %10s %8s" % (
+        'lookup', 'count', 'xpath', 'topology', 'speedup')
+    for label, items, old, new in cases:
+        _, xtime, xresult = timed(label, lambda: [old(doc, i) for i in items])
+        _, ttime, tresult = timed(label, lambda: [new(geom, i) for i in items])
+        if xresult != tresult:
+            print >> sys.stderr, "%s: results differ" % label
+            sys.exit(1)
+        print "%-24s %8d %9.3fs %9.4fs %7.0fx" % (
+            label, len(items), xtime, ttime, xtime / ttime if ttime else 0)
+
+    _, xtime, xresult = timed('', xpath_multipath_disks, doc)
+    _, ttime, tresult = timed('', topology_multipath_disks, geom)
+    if xresult != tresult:
+        print >> sys.stderr, "multipath: results differ"
+        sys.exit(1)
+    print "%-24s %8d %9.3fs %9.4fs %7.0fx" % (
+        'multipath consumers', len(xresult), xtime, ttime,
+        xtime / ttime if ttime else 0)
+
+
+if __name__ == "__main__":
+    main()
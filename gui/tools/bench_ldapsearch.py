@@ -0,0 +1,292 @@
+#!/usr/bin/env python
+#-
+# Copyright (c) 2015 iXsystems, Inc.
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR AND CONTRIBUTORS ``AS IS'' AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE AUTHOR OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS
+# OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY
+# OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF
+# SUCH DAMAGE.
+#
+"""
+Benchmark paged LDAP searches of a large directory
+
+By default searches run against a stand-in for slapd serving synthetic
+users and groups, with a fixed round trip per page and cost per entry,
+so the numbers show how much paging latency the pipelined and
+concurrent searches hide. --uri runs the same searches against a real
+server instead, e.g. a local slapd loaded with the output of --ldif.
+"""
+
+import argparse
+import os
+import sys
+import threading
+import time
+
+HERE = os.path.abspath(os.path.dirname(__file__))
+sys.path.append(os.path.join(HERE, ".."))
+sys.path.append(os.path.join(HERE, "../.."))
+sys.path.append('/usr/local/www')
+sys.path.append('/usr/local/www/freenasUI')
+
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'freenasUI.settings')
+
+import ldap
+from ldap.controls import SimplePagedResultsControl
+
+from freenasUI.common.freenasldap import (
+    FreeNAS_LDAP_ConnectionPool,
+    FreeNAS_LDAP_Directory,
+)
+
+BASEDN = 'dc=bench,dc=freenas,dc=org'
+USERS = 'ou=People,%s' % BASEDN
+GROUPS = 'ou=Group,%s' % BASEDN
+
+
+def synthetic_user(i):
+    uid = 'user%06d' % i
+    return ('uid=%s,%s' % (uid, USERS), {
+        'objectClass': ['account', 'posixAccount'],
+        'uid': [uid],
+        'cn': [uid],
+        'uidNumber': [str(10000 + i)],
+        'gidNumber': [str(10000 + i % 1000)],
+        'homeDirectory': ['/home/%s' % uid],
+        'loginShell': ['/bin/sh'],
+    })
+
+
+def synthetic_group(i):
+    cn = 'group%04d' % i
+    return ('cn=%s,%s' % (cn, GROUPS), {
+        'objectClass': ['posixGroup'],
+        'cn': [cn],
+        'gidNumber': [str(10000 + i)],
+    })
+
+
+def ldif(users, groups):
+    yield 'dn: %s\nobjectClass: dcObject\nobjectClass: organization\n' \
+        'dc: bench\no: bench\n' % BASEDN
+    for ou in ('People', 'Group'):
+        yield 'dn: ou=%s,%s\nobjectClass: organizationalUnit\nou: %s\n' % (
+            ou, BASEDN, ou)
+    for entry in [synthetic_user(i) for i in xrange(users)] + \
+        [synthetic_group(i) for i in xrange(groups)]:
+        lines = ['dn: %s' % entry[0]]
+        for attr, values in sorted(entry[1].items()):
+            lines.extend('%s: %s' % (attr, v) for v in values)
+        yield '\n'.join(lines) + '\n'
+
+
+class StandIn(object):
+    """
+    Enough of a python-ldap connection to slapd for paged searches
+
+    A page is ready rtt seconds plus cost seconds per entry after it
+    was requested; like slapd, one connection works on one page at a
+    time.
+    """
+
+    def __init__(self, users, groups, rtt, cost):
+        self.entries = {USERS: users, GROUPS: groups}
+        self.rtt = rtt
+        self.cost = cost
+        self.busy = 0
+        self.pending = {}
+        self.msgid = 0
+        self.lock = threading.Lock()
+
+    def search_ext(self, base, scope, filterstr='', attrlist=None,
+                   attrsonly=0, serverctrls=None, clientctrls=None,
+                   timeout=-1, sizelimit=0):
+        size, cookie = None, ''
+        for control in serverctrls or []:
+            if control.controlType == SimplePagedResultsControl.controlType:
+                size, cookie = control.size, control.cookie
+        entries = self.entries[base]
+        offset = int(cookie or 0)
+        size = size or len(entries)
+        page = [
+            synthetic(i) for synthetic, i in [
+                entries[j] for j in xrange(
+                    offset, min(offset + size, len(entries))
+                )
+            ]
+        ]
+        with self.lock:
+            self.msgid += 1
+            start = max(time.time() + self.rtt / 2, self.busy)
+            self.busy = start + self.cost * len(page)
+            cookie = str(offset + size) if offset + size < len(entries) \
+                else ''
+            self.pending[self.msgid] = (
+                self.busy + self.rtt / 2, page, size, cookie,
+            )
+            return self.msgid
+
+    def result3(self, msgid, all=1, timeout=None, resp_ctrl_classes=None):
+        with self.lock:
+            ready, page, size, cookie = self.pending.pop(msgid)
+        delay = ready - time.time()
+        if delay > 0:
+            time.sleep(delay)
+        return (ldap.RES_SEARCH_RESULT, page, msgid, [
+            SimplePagedResultsControl(True, size=size, cookie=cookie)
+        ])
+
+    def abandon(self, msgid):
+        with self.lock:
+            self.pending.pop(msgid, None)
+
+    def unbind(self):
+        pass
+
+
+def standin_directory(args):
+    users = [(synthetic_user, i) for i in xrange(args.users)]
+    groups = [(synthetic_group, i) for i in xrange(args.groups)]
+    directory = FreeNAS_LDAP_Directory(
+        host='standin', basedn=BASEDN, pagesize=args.pagesize)
+    directory._handle = StandIn(
+        users, groups, args.rtt / 1000.0, args.cost / 1000000.0)
+    directory._isopen = True
+    return directory
+
+
+class StandInPool(FreeNAS_LDAP_ConnectionPool):
+    def __init__(self, args, **kwargs):
+        self.args = args
+        super(StandInPool, self).__init__(None, **kwargs)
+
+    def _connect(self):
+        return standin_directory(self.args)
+
+
+def process(entries, cost):
+    # What the caller does with each entry, e.g. getpwnam and caching
+    deadline = time.time() + cost * len(entries)
+    while time.time() < deadline:
+        pass
+    return len(entries)
+
+
+def serial_search(directory, query, cost):
+    """
+    One page requested at a time, processed once it arrived, the way
+    _search used to page
+    """
+    handle = directory._handle
+    cookie = ''
+    count = 0
+    while True:
+        paged = SimplePagedResultsControl(
+            True, size=directory.pagesize, cookie=cookie)
+        msgid = handle.search_ext(query['basedn'], query['scope'],
+            filterstr=query['filter'], serverctrls=[paged])
+        rtype, rdata, rmsgid, rctrls = handle.result3(msgid,
+            resp_ctrl_classes={
+                SimplePagedResultsControl.controlType:
+                    SimplePagedResultsControl,
+            })
+        count += process(rdata, cost)
+        cookie = None
+        for control in rctrls:
+            if control.controlType == SimplePagedResultsControl.controlType:
+                cookie = control.cookie
+        if not cookie:
+            return count
+
+
+def pipelined_search(directory, query, cost):
+    count = 0
+    for page in directory._search_pages(**query):
+        count += process(page, cost)
+    return count
+
+
+def timed(label, func):
+    start = time.time()
+    count = func()
+    elapsed = time.time() - start
+    print "%-36s %8d entries %8.2f s %10.0f entries/s" % (
+        label, count, elapsed, count / elapsed if elapsed else 0)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Benchmark paged LDAP searches.')
+    parser.add_argument('-u', '--users', type=int, default=100000)
+    parser.add_argument('-g', '--groups', type=int, default=10000)
+    parser.add_argument('-p', '--pagesize', type=int, default=1000)
+    parser.add_argument('--rtt', type=float, default=2.0,
+        help='stand-in round trip per page in ms')
+    parser.add_argument('--cost', type=float, default=5.0,
+        help='stand-in server cost per entry in microseconds')
+    parser.add_argument('--process', type=float, default=5.0,
+        help='caller cost per entry in microseconds')
+    parser.add_argument('--uri',
+        help='search this server instead of the stand-in')
+    parser.add_argument('--binddn')
+    parser.add_argument('--bindpw')
+    parser.add_argument('--ldif', action='store_true',
+        help='print the synthetic directory as LDIF and exit')
+    args = parser.parse_args()
+
+    if args.ldif:
+        for entry in ldif(args.users, args.groups):
+            print entry
+        return
+
+    cost = args.process / 1000000.0
+    if args.uri:
+        proto, rest = args.uri.split('://')
+        host, port = (rest.rstrip('/').split(':') + ['389'])[:2]
+        directory = FreeNAS_LDAP_Directory(
+            host=host, port=int(port), binddn=args.binddn,
+            bindpw=args.bindpw, basedn=BASEDN, pagesize=args.pagesize,
+            ssl='on' if proto == 'ldaps' else None)
+        directory.open()
+        pool = FreeNAS_LDAP_ConnectionPool(directory, size=2)
+    else:
+        directory = standin_directory(args)
+        pool = StandInPool(args, size=2)
+
+    queries = [
+        {'basedn': USERS, 'scope': ldap.SCOPE_SUBTREE,
+         'filter': '(&(objectclass=account)(uid=*))'},
+        {'basedn': GROUPS, 'scope': ldap.SCOPE_SUBTREE,
+         'filter': '(&(objectclass=posixgroup)(gidnumber=*))'},
+    ]
+
+    timed('serial pages, users', lambda: serial_search(
+        directory, queries[0], cost))
+    timed('pipelined pages, users', lambda: pipelined_search(
+        directory, queries[0], cost))
+    timed('serial pages, users then groups', lambda: sum(
+        serial_search(directory, q, cost) for q in queries))
+    timed('pipelined pages, users and groups', lambda: sum(
+        process(page, cost) for i, page in pool.search_pages(queries)))
+    pool.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,200 @@
+#!/usr/bin/env python
+#-
+# Copyright (c) 2015 iXsystems, Inc.
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR AND CONTRIBUTORS ``AS IS'' AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE AUTHOR OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS
+# OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY
+# OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF
+# SUCH DAMAGE.
+#
+"""
+Benchmark the replication stream pipeline on the local machine
+
+Streams a source (a file, a synthetic data set or a real `zfs send`)
+through ReplicationStream into a local receiver which discards the
+data (or a real `zfs receive`) for each combination of compression,
+level, block size and buffer size, and reports MB/s of source data.
+
+Use --limit to emulate the link speed to the replication target: the
+best compression is the cheapest one which still saturates the link.
+"""
+
+import argparse
+import itertools
+import os
+import random
+import sys
+import tempfile
+
+HERE = os.path.abspath(os.path.dirname(__file__))
+sys.path.append(os.path.join(HERE, ".."))
+sys.path.append(os.path.join(HERE, "../.."))
+sys.path.append('/usr/local/www')
+sys.path.append('/usr/local/www/freenasUI')
+
+from freenasUI.common.replstream import (
+    COMPRESSORS, ReplicationStream, compress_commands, zfs_send_command,
+)
+
+
+def synthetic_source(size):
+    """
+    Write a file of roughly half compressible, half random data
+    """
+    fd, path = tempfile.mkstemp(prefix='bench_replstream')
+    words = ['freenas', 'zfs', 'snapshot', 'replication', 'pool', '\n']
+    block = 1024 * 1024
+    with os.fdopen(fd, 'wb') as f:
+        written = 0
+        while written < size:
+            if (written / block) % 2:
+                data = os.urandom(block)
+            else:
+                data = ' '.join(
+                    random.choice(words) for i in xrange(block / 6)
+                )[:block]
+            f.write(data)
+            written += len(data)
+    return path
+
+
+def resolve(cmd):
+    """
+    Fall back to $PATH for compressors not installed under /usr/local
+
+    Returns:
+        the command or None if it can not be found at all
+    """
+    if not cmd or os.path.exists(cmd[0]):
+        return cmd
+    name = os.path.basename(cmd[0])
+    for path in os.environ.get('PATH', '').split(os.pathsep):
+        if os.access(os.path.join(path, name), os.X_OK):
+            return [os.path.join(path, name)] + cmd[1:]
+    return None
+
+
+def parse_size(value):
+    units = {'k': 1024, 'm': 1024 ** 2, 'g': 1024 ** 3}
+    value = value.lower()
+    if value[-1] in units:
+        return int(value[:-1]) * units[value[-1]]
+    return int(value)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Benchmark the replication stream pipeline.'
+    )
+    parser.add_argument('-s', '--size', default='256m',
+        help='size of the synthetic source')
+    parser.add_argument('-f', '--file',
+        help='stream this file instead of synthetic data')
+    parser.add_argument('--snapshot',
+        help='stream `zfs send` of this snapshot instead')
+    parser.add_argument('--receive', default=None,
+        help='shell command receiving the stream (default discards it)')
+    parser.add_argument('-c', '--compression', action='append',
+        choices=['off'] + sorted(COMPRESSORS.keys()),
+        help='compression to try (repeatable, default all)')
+    parser.add_argument('-l', '--level', action='append', type=int,
+        help='compression level to try (repeatable, default tool default)')
+    parser.add_argument('-b', '--blocksize', action='append',
+        help='block size to try (repeatable, default 1m)')
+    parser.add_argument('-B', '--buffersize', action='append',
+        help='ring buffer size to try (repeatable, default 64m)')
+    parser.add_argument('--limit', type=int, default=0,
+        help='emulated link speed in KiB/s')
+    args = parser.parse_args()
+
+    source = None
+    if args.snapshot:
+        send = zfs_send_command(args.snapshot, verbose=False)
+        size = None
+    else:
+        if args.file:
+            path = args.file
+        else:
+            path = source = synthetic_source(parse_size(args.size))
+        send = ['/bin/cat', path]
+        size = os.stat(path).st_size
+    receive = args.receive or 'cat > /dev/null'
+
+    try:
+        print "%-8s %5s %9s %9s %12s %8s %10s" % (
+            'compress', 'level', 'block', 'buffer', 'wire bytes', 'ratio',
+            'MB/s',
+        )
+        methods = []
+        for compression in (
+            args.compression or ['off'] + sorted(COMPRESSORS.keys())
+        ):
+            if compression == 'off':
+                methods.append((compression, None))
+            else:
+                methods.extend(
+                    (compression, level) for level in args.level or [None]
+                )
+        for (compression, level), blocksize, buffersize in itertools.product(
+            methods,
+            args.blocksize or ['1m'],
+            args.buffersize or ['64m'],
+        ):
+            compress, decompress = compress_commands(compression, level)
+            if compress:
+                compress, decompress = resolve(compress), resolve(decompress)
+                if compress is None or decompress is None:
+                    print "%-8s not installed, skipped" % compression
+                    continue
+            if decompress:
+                receiver = '%s | %s' % (' '.join(decompress), receive)
+            else:
+                receiver = receive
+            stream = ReplicationStream(
+                send,
+                receiver,
+                compress=compress,
+                blocksize=parse_size(blocksize),
+                buffersize=parse_size(buffersize),
+                limit=args.limit,
+            )
+            rv = stream.run()
+            if rv != 0:
+                print "%-8s failed with %d: %s" % (
+                    compression, rv, stream.output,
+                )
+                continue
+            total = size if size is not None else stream.bytes
+            print "%-8s %5s %9s %9s %12d %7.2fx %10.2f" % (
+                compression,
+                level if level is not None else '-',
+                blocksize,
+                buffersize,
+                stream.bytes,
+                float(total) / stream.bytes if stream.bytes else 0,
+                total / stream.elapsed / 1048576,
+            )
+    finally:
+        if source:
+            os.unlink(source)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,121 @@
+#!/usr/bin/env python
+#-
+# Copyright (c) 2015 iXsystems, Inc.
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR AND CONTRIBUTORS ``AS IS'' AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE AUTHOR OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS
+# OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY
+# OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF
+# SUCH DAMAGE.
+#
+"""
+Benchmark the per-operation cost of sipcalc_type
+
+Walks an address range the way jails.utils.get_available_ipv4 does and
+times the common operations. With --legacy the same number of sipcalc
+runs is timed as well, that is what every one of these operations cost
+before the arithmetic was done in-process.
+"""
+
+import argparse
+import os
+import subprocess
+import sys
+import time
+
+HERE = os.path.abspath(os.path.dirname(__file__))
+sys.path.append(os.path.join(HERE, ".."))
+sys.path.append(os.path.join(HERE, "../.."))
+sys.path.append('/usr/local/www')
+sys.path.append('/usr/local/www/freenasUI')
+
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'freenasUI.settings')
+
+from freenasUI.common.sipcalc import sipcalc_type
+
+SIPCALC_PATH = "/usr/local/bin/sipcalc"
+
+
+def timeit(label, func, count, repeat):
+    best = None
+    for i in range(repeat):
+        start = time.time()
+        func()
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    print "%-32s %12.2f us/op" % (label, best * 1000000 / count)
+
+
+def walk(start, count):
+    addr = sipcalc_type(start)
+    end = addr + count
+    while addr < end:
+        addr += 1
+    return addr
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark sipcalc_type.')
+    parser.add_argument('-n', '--count', type=int, default=10000,
+        help='operations per run')
+    parser.add_argument('-r', '--repeat', type=int, default=3,
+        help='best of how many runs')
+    parser.add_argument('--legacy', action='store_true',
+        help='also time running %s' % SIPCALC_PATH)
+    args = parser.parse_args()
+    count = args.count
+
+    ipv4 = sipcalc_type("10.0.0.1/8")
+    ipv6 = sipcalc_type("2001:db8::1/64")
+    timeit('parse ipv4', lambda: [
+        sipcalc_type("10.0.0.1/24") for i in xrange(count)
+    ], count, args.repeat)
+    timeit('parse ipv6', lambda: [
+        sipcalc_type("2001:db8::1/64") for i in xrange(count)
+    ], count, args.repeat)
+    timeit('walk ipv4 (addr += 1)', lambda: walk("10.0.0.1/8", count),
+        count, args.repeat)
+    timeit('walk ipv6 (addr += 1)', lambda: walk("2001:db8::1/64", count),
+        count, args.repeat)
+    timeit('ipv4 usable_range', lambda: [
+        ipv4.usable_range for i in xrange(count)
+    ], count, args.repeat)
+    timeit('ipv4 in_network', lambda: [
+        ipv4.in_network("10.1.2.3") for i in xrange(count)
+    ], count, args.repeat)
+    timeit('ipv6 in_network', lambda: [
+        ipv6.in_network("2001:db8::ffff") for i in xrange(count)
+    ], count, args.repeat)
+
+    if args.legacy:
+        if not os.path.exists(SIPCALC_PATH):
+            print "%s not found, skipping" % SIPCALC_PATH
+            return
+        runs = max(1, count / 100)
+        timeit('sipcalc run (legacy)', lambda: [
+            subprocess.Popen(
+                [SIPCALC_PATH, "10.0.0.1/24"],
+                stdout=subprocess.PIPE,
+            ).communicate() for i in xrange(runs)
+        ], runs, args.repeat)
+
+
+if __name__ == "__main__":
+    main()
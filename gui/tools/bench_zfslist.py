@@ -0,0 +1,117 @@
+#!/usr/bin/env python
+#-
+# Copyright (c) 2015 iXsystems, Inc.
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR AND CONTRIBUTORS ``AS IS'' AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE AUTHOR OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS
+# OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY
+# OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF
+# SUCH DAMAGE.
+#
+"""
+Benchmark building a ZFSList out of synthetic `zfs list` output
+
+The layout mimics per-user home datasets: thousands of siblings under
+a single parent, some of them with a few children of their own.
+"""
+
+import argparse
+import os
+import random
+import sys
+import time
+
+HERE = os.path.abspath(os.path.dirname(__file__))
+sys.path.append(os.path.join(HERE, ".."))
+sys.path.append(os.path.join(HERE, "../.."))
+sys.path.append('/usr/local/www')
+sys.path.append('/usr/local/www/freenasUI')
+
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'freenasUI.settings')
+
+from freenasUI.middleware.zfs import zfslist_from_rows
+
+
+def synthetic_output(count, pool='tank'):
+    lines = []
+
+    def add(path, _type='filesystem'):
+        lines.append('\t'.join([
+            path, '1099511627776', '1073741824', '0', '1073741824', '0', '0',
+            '1073741824', '/mnt/%s' % path, _type,
+        ]))
+
+    add(pool)
+    add('%s/home' % pool)
+    user = 0
+    while len(lines) < count:
+        home = '%s/home/user%06d' % (pool, user)
+        add(home)
+        if user % 10 == 0:
+            for sub in ('mail', 'projects', 'backup'):
+                add('%s/%s' % (home, sub))
+        if user % 50 == 0:
+            add('%s/swap' % home, 'volume')
+        user += 1
+    return '\n'.join(lines[:count]) + '\n'
+
+
+def timeit(label, func, repeat):
+    best = None
+    for i in range(repeat):
+        start = time.time()
+        rv = func()
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    print "%-32s %10.2f ms" % (label, best * 1000)
+    return rv
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark ZFSList.')
+    parser.add_argument('-n', '--datasets', type=int, default=50000,
+        help='number of datasets to generate')
+    parser.add_argument('-r', '--repeat', type=int, default=3,
+        help='best of how many runs')
+    args = parser.parse_args()
+
+    output = synthetic_output(args.datasets)
+    rows = timeit('parse output', lambda: [
+        tuple(line.split('\t')) for line in output.split('\n') if line
+    ], args.repeat)
+    timeit('flat list', lambda: zfslist_from_rows(rows), args.repeat)
+    zfslist = timeit('hierarchical list', lambda: zfslist_from_rows(
+        rows, hierarchical=True, include_root=True,
+    ), args.repeat)
+
+    paths = [row[0] for row in rows]
+    random.shuffle(paths)
+    timeit('lookup every dataset', lambda: [
+        zfslist.lookup(path) for path in paths
+    ], args.repeat)
+
+    home = zfslist.lookup('tank/home')
+    print "%d datasets, %d children under tank/home" % (
+        len(rows), len(home.children),
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -27,6 +27,7 @@
 
 import os
 import sys
+import time
 
 from string import join
 
@@ -57,6 +58,8 @@ from freenasUI.common.freenascache import (
 
 from freenasUI.common.freenasldap import (
     FreeNAS_ActiveDirectory,
+    FreeNAS_ActiveDirectory_CacheRefresh,
+    FreeNAS_LDAP_CacheRefresh,
     FLAGS_DBINIT,
     FLAGS_CACHE_READ_USER,
     FLAGS_CACHE_WRITE_USER,
@@ -92,10 +95,44 @@ def cache_fill(**kwargs):
     uargs = { 'flags': FLAGS_DBINIT|FLAGS_CACHE_WRITE_USER }
     gargs = { 'flags': FLAGS_DBINIT|FLAGS_CACHE_WRITE_GROUP }
 
-    for u in FreeNAS_Users(**uargs):
-        pass
-    for g in FreeNAS_Groups(**gargs):
-        pass
+    # Enumerating (and resolving) the directory is what takes the time
+    start = time.time()
+    users = len(FreeNAS_Users(**uargs))
+    ustop = time.time()
+    groups = len(FreeNAS_Groups(**gargs))
+    gstop = time.time()
+
+    print "%d users in %.2fs, %d groups in %.2fs" % (
+        users, ustop - start, groups, gstop - ustop)
+
+
+def cache_refresh(**kwargs):
+    """Update the cache with what changed in the directory since the
+       last refresh, or everything with "full", without emptying it
+       first. Other directories (NT4, NIS, domain controller) can not
+       tell what changed, a full refresh expires and fills their cache."""
+    full = 'full' in kwargs.get('args', [])
+
+    refresh = None
+    if activedirectory_enabled():
+        refresh = FreeNAS_ActiveDirectory_CacheRefresh(flags=FLAGS_DBINIT)
+
+    elif ldap_enabled():
+        refresh = FreeNAS_LDAP_CacheRefresh(flags=FLAGS_DBINIT)
+
+    elif full:
+        cache_expire(**kwargs)
+        cache_fill(**kwargs)
+        return
+
+    if refresh is None:
+        return
+
+    start = time.time()
+    users, groups = refresh.refresh(full=full)
+    print "%d users, %d groups %s in %.2fs" % (
+        users, groups, "fetched" if full else "changed",
+        time.time() - start)
 
 
 def __cache_expire(cachedir):
@@ -559,6 +596,7 @@ def cache_count(**kwargs):
 def main():
     cache_funcs = {}
     cache_funcs['fill'] = cache_fill
+    cache_funcs['refresh'] = cache_refresh
     cache_funcs['expire'] = cache_expire
     cache_funcs['dump'] = cache_dump
     cache_funcs['keys'] = cache_keys
@@ -37,6 +37,7 @@ from freenasUI.api import v1_api
 from freenasUI.api.resources import (
     AlertResource,
     BootEnvResource,
+    PerfResource,
     PermissionResource,
     RebootResource,
     ShutdownResource,
@@ -52,6 +53,7 @@ handler404 = 'freenasUI.freeadmin.views.page_not_found'
 
 v1_api.register(AlertResource())
 v1_api.register(BootEnvResource())
+v1_api.register(PerfResource())
 v1_api.register(PermissionResource())
 v1_api.register(RebootResource())
 v1_api.register(ShutdownResource())
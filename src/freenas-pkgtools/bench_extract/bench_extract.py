@@ -0,0 +1,150 @@
+#!/usr/local/bin/python -R
+
+# Benchmark extracting a package with Installer.ExtractEntry.
+# A synthetic package with a few large files is generated, then
+# extracted in a child process, reporting MB/s and the peak RSS
+# of the child.  With -l the same is done reading every file into
+# memory first, the way ExtractEntry used to.
+
+import os, sys
+import getopt
+import hashlib
+import logging
+import resource
+import shutil
+import tarfile
+import tempfile
+import time
+
+HERE = os.path.abspath(os.path.dirname(__file__))
+LIB = os.path.join(HERE, "..", "lib")
+if os.path.exists(os.path.join(LIB, "Installer.py")):
+    # Running from the source tree, lib is installed as freenasOS
+    import imp
+    imp.load_module("freenasOS", None, LIB, ("", "", imp.PKG_DIRECTORY))
+else:
+    sys.path.append("/usr/local/lib")
+
+import freenasOS.Installer as Installer
+
+kMB = 1024 * 1024
+
+class SyntheticFile(object):
+    # File-like object producing size bytes, hashing them as they
+    # are read, so the package is never in memory either.
+    def __init__(self, size, block):
+        self.left = size
+        self.block = block
+        self.hash = hashlib.sha256()
+
+    def read(self, size = -1):
+        if size < 0 or size > len(self.block):
+            size = len(self.block)
+        size = min(size, self.left)
+        data = self.block[:size]
+        self.left -= size
+        self.hash.update(data)
+        return data
+
+def usage():
+    print >> sys.stderr, "Usage: %s [-l] [-n files] [-s size_mb] [-d dir]" % sys.argv[0]
+    print >> sys.stderr, "\t-l also extract the way ExtractEntry used to (whole file in memory)"
+    sys.exit(1)
+
+def MakePackage(path, nfiles, size):
+    hashes = {}
+    block = os.urandom(kMB)
+    t = tarfile.open(path, "w", format = tarfile.PAX_FORMAT)
+    ti = tarfile.TarInfo("usr/local/share/bench")
+    ti.type = tarfile.DIRTYPE
+    ti.mode = 0755
+    t.addfile(ti)
+    for i in range(nfiles):
+        ti = tarfile.TarInfo("usr/local/share/bench/file%d" % i)
+        ti.size = size
+        ti.mode = 0644
+        src = SyntheticFile(size, block)
+        t.addfile(ti, src)
+        hashes[ti.name] = src.hash.hexdigest()
+    t.close()
+    return hashes
+
+def LegacyExtractEntry(tf, entry, root, prefix = None, mFileHash = None):
+    full_path = os.path.join(root, entry.name)
+    if entry.isfile():
+        buffer = tf.extractfile(entry).read()
+        if hashlib.sha256(buffer).hexdigest() != mFileHash:
+            print >> sys.stderr, "%s hash does not match" % entry.name
+        with open(full_path, "w") as f:
+            f.write(buffer)
+    elif entry.isdir() and not os.path.isdir(full_path):
+        os.makedirs(full_path)
+
+def Extract(pkg, root, hashes, extract):
+    # Extract in a child, so its peak RSS is the extraction's only.
+    # Returns (seconds, peak RSS in KB).
+    (rfd, wfd) = os.pipe()
+    start = time.time()
+    pid = os.fork()
+    if pid == 0:
+        os.close(rfd)
+        status = 0
+        try:
+            t = tarfile.open(pkg)
+            for member in t:
+                extract(t, member, root, None, hashes.get(member.name, "-"))
+            t.close()
+            os.write(wfd, "%d" % resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)
+        except Exception as e:
+            print >> sys.stderr, "Extraction failed: %s" % str(e)
+            status = 1
+        os._exit(status)
+    os.close(wfd)
+    rss = os.read(rfd, 64)
+    os.close(rfd)
+    os.waitpid(pid, 0)
+    if not rss:
+        sys.exit(1)
+    return (time.time() - start, int(rss))
+
+def main():
+    nfiles = 2
+    size = 1024
+    legacy = False
+    tmpdir = None
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], "ln:s:d:")
+    except getopt.GetoptError as err:
+        print >> sys.stderr, str(err)
+        usage()
+    for (o, a) in opts:
+        if o == "-l": legacy = True
+        elif o == "-n": nfiles = int(a)
+        elif o == "-s": size = int(a)
+        elif o == "-d": tmpdir = a
+        else: usage()
+
+    logging.basicConfig(level = logging.ERROR)
+    total = nfiles * size
+    work = tempfile.mkdtemp(dir = tmpdir)
+    try:
+        pkg = os.path.join(work, "bench.tar")
+        start = time.time()
+        hashes = MakePackage(pkg, nfiles, size * kMB)
+        print "Generated %d x %d MB package in %.1fs" % (nfiles, size, time.time() - start)
+
+        runs = [("chunked", Installer.ExtractEntry)]
+        if legacy:
+            runs.append(("whole file", LegacyExtractEntry))
+        for (label, extract) in runs:
+            root = os.path.join(work, "root")
+            os.mkdir(root)
+            (elapsed, rss) = Extract(pkg, root, hashes, extract)
+            print "%-12s %8.1f MB/s  peak RSS %8.1f MB" % (label, total / elapsed, rss / 1024.0)
+            shutil.rmtree(root)
+    finally:
+        shutil.rmtree(work)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
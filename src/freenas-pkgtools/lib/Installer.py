@@ -5,6 +5,7 @@ import subprocess
 import stat
 import json
 import tarfile
+import tempfile
 import hashlib
 import logging
 
@@ -19,6 +20,9 @@ import Configuration
 debug = 0
 verbose = False
 
+# How much of a file is held in memory while extracting it
+EXTRACT_CHUNK_SIZE = 1024 * 1024
+
 log = logging.getLogger('freenasOS.Installer')
 
 class InstallerConfigurationException(Exception):
@@ -361,20 +365,7 @@ def ExtractEntry(tf, entry, root, prefix = None, mFileHash = None):
     # symlink, or hard link.
     if entry.isfile():
         fileData = tf.extractfile(entry)
-        # Is this a problem?  Keeping the file in memory?
-        # Note that we write the file out later, so this allows
-        # us to not worry about the buffer.
-        buffer = fileData.read()
-        hash = hashlib.sha256(buffer).hexdigest()
-        # PKGNG sets hash to "-" if it's not computed.
-        if mFileHash != "-":
-            if hash != mFileHash:
-                log.error("%s hash does not match manifest" % entry.name)
         type = "file"
-        # First we try to create teh file.
-        # If that doesn't work, we try to create a
-        # new file (how would this get cleaned up?),
-        # and then rename it in place.
         # We remove any flags on it -- if there are
         # supposed to be any, SetPosix() will get them.
         # (We hope.)
@@ -382,20 +373,38 @@ def ExtractEntry(tf, entry, root, prefix = None, mFileHash = None):
             os.lchflags(full_path, 0)
         except:
             pass
-        newfile = None
+        # The file is read, hashed, and written a chunk at a time
+        # (base-os files can be hundreds of MB), into a new file in
+        # the same directory which is then renamed in place.  So
+        # nothing ever sees a partially written file, and a busy
+        # executable is replaced instead of written to.
+        (fd, newfile) = tempfile.mkstemp(dir = dirname, prefix = ".%s." % fname)
         try:
-            f = open(full_path, "w")
-        except:
-            newfile = full_path + ".new"
-            f = open(newfile, "w")
-        f.write(buffer)
-        f.close()
-        if newfile is not None:
+            sha256 = hashlib.sha256()
+            with os.fdopen(fd, "wb") as f:
+                while True:
+                    chunk = fileData.read(EXTRACT_CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    sha256.update(chunk)
+                    f.write(chunk)
+            fileData.close()
+            hash = sha256.hexdigest()
+            # PKGNG sets hash to "-" if it's not computed.
+            if mFileHash != "-":
+                if hash != mFileHash:
+                    log.error("%s hash does not match manifest" % entry.name)
             try:
                 os.rename(newfile, full_path)
             except:
                 os.rename(full_path, "%s.old" % full_path)
                 os.rename(newfile, full_path)
+        except:
+            try:
+                os.unlink(newfile)
+            except os.error:
+                pass
+            raise
         SetPosix(full_path, meta)
     elif entry.isdir():
         # If the directory already exists, we don't care.